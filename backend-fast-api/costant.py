@@ -3,5 +3,93 @@ from os.path import join
 
 CACHE_DB_PATH = join(getcwd(), 'cache', 'cache.db')
 CONVERSATION_DB_PATH = join(getcwd(), 'session_data', 'conversation.db')
+RETRIEVAL_CACHE_DB_PATH = join(getcwd(), 'cache', 'retrieval.db')
+TRANSLATION_CACHE_DB_PATH = join(getcwd(), 'cache', 'translation.db')
+RATE_LIMIT_DB_PATH = join(getcwd(), 'cache', 'rate_limit.db')
+LOCAL_INDEX_DIR = join(getcwd(), 'local_index')
+TELEMETRY_PATH = join(getcwd(), 'logs', 'telemetry.jsonl')
 CACHE_EXP_DAY = 30
-OPENSEARCH_INDEX_NAME = 'test_all_mini_cosine'
\ No newline at end of file
+CACHE_CLEAN_INTERVAL_SEC = 24 * 3600 # cache_db.clean_cache runs at startup and then with this interval
+OPENSEARCH_INDEX_NAME = 'test_all_mini_cosine'
+SEARCH_POOL_SIZE = 12 # threads shared by every rag instance to run OpenSearch queries concurrently
+SEARCH_TIMEOUT_SEC = 5 # max time to wait for a single OpenSearch query
+OPENSEARCH_MODEL_ID = 'mXgYKo8BlLTTsnWvtjbF' # all-MiniLM-L12-v2 deployed on the cluster
+SEARCH_FIELDS = ['text_en_embedding', 'text_it_embedding', 'category_en_embedding'] # order matters, see rag.launch_searches
+FIELD_LANGS = {'text_en_embedding': 'en', 'text_it_embedding': 'it', 'category_en_embedding': 'en'} # language of the text embedded in each field
+SEARCH_PLANS = { # fields searched for each question language, see search_planner; strict searches (only_3of3) need a hit in every planned field
+    'en': ['text_en_embedding', 'category_en_embedding'],
+    'it': ['text_it_embedding', 'category_en_embedding'],
+    'unknown': SEARCH_FIELDS
+}
+DEEPL_TARGET_LANGS = {'en': 'EN-US', 'it': 'IT'}
+SEARCH_PLAN_TRANSLATE = False # if True the fields in the other language are searched with the DeepL translation (a DeepL call per new question), else with the question
+LANGUAGE_CACHE_SIZE = 4096 # detected question languages kept in memory
+LANGUAGE_DETECT_MIN_WORDS = 3 # shorter questions without stopwords are searched on every field
+OPENSEARCH_TRANSPORT_PROFILE = { # see opensearch_transport.client_options, every key can be overridden by "opensearch_transport" in settings.json
+    'pool_size': 32, # connections per host: SEARCH_POOL_SIZE search threads + the FastAPI threadpool and event loop requests
+    'http_compress': True, # gzip request bodies, ask for gzip responses
+    'timeout': 10, # default request timeout, searches use SEARCH_TIMEOUT_SEC
+    'max_retries': 1,
+    'retry_on_timeout': True,
+    'retry_on_status': [502, 503, 504],
+    'backoff_base': 0.1, # retry wait: random in [0, min(backoff_max, backoff_base * 2^attempt)] seconds
+    'backoff_max': 1.0,
+    'sniff_on_start': False, # sniffing needs the cluster nodes reachable from here, not the case behind a load balancer
+    'sniff_on_connection_fail': False,
+    'sniffer_timeout': None # seconds between periodic sniffs, None disables them
+}
+SEARCH_TEMPLATES_ENABLED = True # neural searches send a stored template id and params, see query_builder
+SEARCH_TEMPLATES_RETRY_SEC = 30 # a failed templates registration is retried after this wait, doubled on every failure
+SEARCH_TEMPLATES_RETRY_MAX_SEC = 900
+SEARCH_MODES = ['knn', 'local', 'msearch', 'concurrent', 'sequential']
+EMBEDDING_CACHE_SIZE = 2048 # question embeddings kept in memory
+LOCAL_EMBEDDING_MODEL = 'sentence-transformers/all-MiniLM-L12-v2' # MUST be the model deployed on the cluster
+BEDROCK_MAX_CONCURRENCY = 256 # Bedrock calls in flight at the same time, per process
+BEDROCK_CREDENTIALS_DURATION_SEC = 3600 # lifetime of the STS session token
+BEDROCK_REFRESH_MARGIN_SEC = 600 # the credentials are refreshed this long before they expire
+BEDROCK_REFRESH_RETRY_SEC = 30 # wait before retrying a failed refresh
+BEDROCK_CONNECT_TIMEOUT_SEC = 5
+BEDROCK_READ_TIMEOUT_SEC = 300 # a long answer can take minutes, the stream is read with the same timeout
+BEDROCK_MAX_ATTEMPTS = 3 # botocore retries, throttling is prevented by BEDROCK_LIMITER
+BEDROCK_RPS = 10 # Bedrock calls per second, see rate_limiter
+BEDROCK_RPS_BURST = 20
+BEDROCK_TPM = 400000 # estimated input + max output tokens per minute
+RATE_LIMIT_SHARED = False # True: the Bedrock limits are shared by every worker (SQLite in RATE_LIMIT_DB_PATH), otherwise per process
+RATE_LIMIT_MAX_QUEUE = 64 # Bedrock calls waiting for the limiter, per process, the others are rejected (HTTP 429)
+RATE_LIMIT_MAX_WAIT_SEC = 20 # calls that should wait longer are rejected
+ANSWER_CACHE_THRESHOLD = 0.92 # min cosine similarity between 2 questions to reuse the cached answer
+RETRIEVAL_CACHE_SIZE = 1024 # search_doc results kept in memory (per process) and in SQLite (shared)
+RETRIEVAL_CACHE_TTL_SEC = 3600
+TRANSLATION_CACHE_SIZE = 4096 # translations kept in memory, per process
+TRANSLATION_CACHE_MAX_ROWS = 100000 # translations kept in SQLite (shared)
+TRANSLATION_BATCH_SIZE = 50 # max texts per DeepL request
+FUSION_STRATEGIES = ['votes', 'rrf', 'max', 'sum'] # see fusion.rank_fusion
+FUSION_STRATEGY = 'votes'
+FUSION_RRF_K = 60
+CONVERSATION_SESSION_CACHE_SIZE = 256 # hot conversations kept in memory, per process
+SQLITE_BUSY_TIMEOUT_SEC = 10 # max time a writer waits for the database lock
+SQLITE_CACHED_STATEMENTS = 256 # prepared statements kept by each connection
+CONVERSATION_PAGE_SIZE = 100 # conversations per page, see conversation_db.get_conversation_page
+CONVERSATION_PAGE_MAX_SIZE = 1000
+CHARS_PER_TOKEN = 4 # rough token estimate, see util.estimate_tokens
+HISTORY_KEEP_TURNS = 3 # last turns (question + answer) always sent verbatim to Claude
+HISTORY_TOKEN_BUDGET = 6000 # history tokens not covered by the digest above which the older turns are condensed
+CONDENSE_MODEL_ID = 'anthropic.claude-3-haiku-20240307-v1:0' # model that writes the conversation digest
+CONDENSE_MAX_TOKENS = 1000
+CONDENSE_POOL_SIZE = 2 # background threads condensing conversations, per process
+CONTEXT_CITED_DOCS = 3 # docs cited in the previous answers sent again with the question, see rag.select_context_docs
+CHAT_DOCS_MAX = 50 # docs stored per chat, the least recently used are evicted
+TELEMETRY_MAX_BYTES = 50 * 1024 * 1024 # the telemetry file is rotated and gzipped above this size
+TELEMETRY_BACKUP_COUNT = 20 # rotated telemetry files kept, 0 keeps all
+TELEMETRY_QUEUE_SIZE = 10000 # events waiting to be written, the new ones are dropped when full
+TELEMETRY_BATCH_SIZE = 512
+ROUTER_ENABLED = True # False sends every turn to the strong tier, see model_router
+ROUTER_FAST_MODEL_ID = 'anthropic.claude-3-haiku-20240307-v1:0'
+ROUTER_FAST_MAX_TOKENS = 1000
+ROUTER_STRONG_MODEL_ID = 'anthropic.claude-3-sonnet-20240229-v1:0'
+ROUTER_STRONG_MAX_TOKENS = 3000
+ROUTER_FAST_MAX_DOCS = 3 # more docs: the answer has to combine or choose between them
+ROUTER_FAST_MIN_MARGIN = 0.03 # min _score gap between the best and the second doc (1 / (2 - cosine) scale)
+ROUTER_FAST_MIN_TOP_SCORE = 0.75 # min _score of the best doc
+ROUTER_FAST_MAX_HISTORY = 4 # max messages before the question (2 turns)
+ROUTER_FAST_MAX_QUESTION_TOKENS = 60
@@ -1,8 +1,14 @@
-from sqlite3 import connect
+from sqlite3 import Connection, Cursor
 from costant import *
-from pandas import DataFrame
-from datetime import date, datetime
-from lib_ import util
+from lib_ import util, synchronized
+from db_pool import sqlite_pool
+from threading import RLock, Thread, Event
+from hashlib import sha256
+from typing import TYPE_CHECKING
+import numpy as np
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
 
 class cache_db:
     '''
@@ -74,8 +80,17 @@ class cache_db:
     def __init__(self) -> None:
         if not util.create_operational_folder():
             raise Exception('Cache.__init__: cannot create operational folders')
-        self.conn = connect(CACHE_DB_PATH, check_same_thread=False) # sqlite connect
-        self.cursor = self.conn.cursor()
+        # guards the answers embedding matrix, every thread has its own SQLite connection (see sqlite_pool)
+        self.lock = RLock()
+        self.pool = sqlite_pool(CACHE_DB_PATH)
+        # answers embedding matrix, loaded on first lookup and reloaded when the usable answers change:
+        # add_answer, vote_answer and clean_cache bump the generation in answer_cache_meta (also from another process),
+        # the hit/miss counters and last_used are written without touching it
+        self.answer_ids: list[str] = []
+        self.answer_matrix: np.ndarray = None
+        self.answer_matrix_generation = None
+        self.cleaner: Thread = None
+        self.stopped = Event()
 
         self.cursor.execute(
             '''CREATE TABLE IF NOT EXISTS cache (
@@ -89,8 +104,43 @@ class cache_db:
                     negative_vote INTEGER
                 )'''
         )
+        self.cursor.execute(
+            '''CREATE TABLE IF NOT EXISTS answer_cache (
+                    id TEXT PRIMARY KEY,
+                    question TEXT,
+                    embedding BLOB,
+                    answer TEXT,
+                    link TEXT,
+                    last_used TEXT,
+                    time_used INTEGER,
+                    positive_vote INTEGER,
+                    negative_vote INTEGER
+                )'''
+        )
+        self.cursor.execute(
+            '''CREATE TABLE IF NOT EXISTS answer_cache_stats (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER
+                )'''
+        )
+        self.cursor.execute(
+            '''CREATE TABLE IF NOT EXISTS answer_cache_meta (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER
+                )'''
+        )
+        self.cursor.execute("INSERT OR IGNORE INTO answer_cache_meta (name, value) VALUES ('generation', 0)")
+        self.conn.commit()
+
+    @property
+    def conn(self) -> Connection:
+        return self.pool.connection()
+
+    @property
+    def cursor(self) -> Cursor:
+        return self.pool.cursor()
         
-    def retrieve_all(self, want_df: bool = False) -> DataFrame | dict:
+    def retrieve_all(self, want_df: bool = False) -> 'DataFrame | dict':
         """
         Retrieve all cached records from the database.
 
@@ -122,6 +172,7 @@ class cache_db:
         rows = self.cursor.fetchall()
 
         if want_df:
+            from pandas import DataFrame # slow import, the API never asks for a DataFrame
             # Creating the DataFrame
             df_data = []
             for row in rows:
@@ -185,34 +236,173 @@ class cache_db:
         self.conn.commit()
         return True
 
-    def clean_cache(self) -> bool:
+    @synchronized
+    def find_answer(self, embedding: list[float], threshold: float = ANSWER_CACHE_THRESHOLD) -> dict | None:
         """
-        Clean the cache by removing records older than CACHE_EXP_DAY value, specified in costant.py file.
+        Find the cached answer of the question most similar to the one represented by ``embedding``.
+
+        Args:
+            embedding (list[float]): The embedding of the question.
+            threshold (float, optional): Minimum cosine similarity between the 2 questions. Defaults to ANSWER_CACHE_THRESHOLD.
 
         Returns:
-            bool: True if the cache is successfully cleaned, False otherwise.
+            dict | None: The cached answer if found, otherwise None. The structure is:
+                {
+                    "id": str,
+                    "question": str,
+                    "answer": str,
+                    "link": str,
+                    "similarity": float
+                }
 
         Notes:
-            This function loads a JSON file containing cached records, checks the last used date
-            of each record, and removes records older than a specified threshold (CACHE_EXP_DAY).
-            The cleaned records are then saved back to the JSON file.
+            Only answers with at least as many positive as negative votes are considered.
+            Every lookup is counted as hit or miss in answer_cache_stats, a hit updates last_used and time_used.
+        """
+        self.load_answer_matrix()
+        found = None
+
+        if len(self.answer_ids):
+            query = np.asarray(embedding, dtype=np.float32)
+            query = query / np.linalg.norm(query)
+            similarities = self.answer_matrix @ query
+            best = int(np.argmax(similarities))
+
+            if similarities[best] >= threshold:
+                self.cursor.execute("SELECT id, question, answer, link FROM answer_cache WHERE id = ?", (self.answer_ids[best],))
+                row = self.cursor.fetchone()
+                if row:
+                    found = {
+                        "id": row[0],
+                        "question": row[1],
+                        "answer": row[2],
+                        "link": row[3],
+                        "similarity": float(similarities[best])
+                    }
+                    self.cursor.execute("UPDATE answer_cache SET last_used = DATE('now'), time_used = time_used + 1 WHERE id = ?", (row[0],))
+
+        self.increment_stat('hit' if found else 'miss')
+        self.conn.commit()
+        return found
 
-            The function returns True if the cache is successfully cleaned and saved,
-            and False if there is an error during the process.
+    @synchronized
+    def add_answer(self, question: str, embedding: list[float], answer: str, link: str) -> str:
         """
-        today = date.today()
-        self.cursor.execute("SELECT * FROM cache")
+        Add the answer to a question to the answer cache, an answer to the same (normalized) question is replaced.
+
+        Returns:
+            str: The id of the cached answer, it can be used to vote it (see ``vote_answer``).
+        """
+        answer_id = sha256(util.normalize_text(question).encode('utf-8')).hexdigest()
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector = vector / np.linalg.norm(vector)
+
+        self.cursor.execute(
+            "INSERT OR REPLACE INTO answer_cache (id, question, embedding, answer, link, last_used, time_used, positive_vote, negative_vote) VALUES (?, ?, ?, ?, ?, DATE('now'), 1, 0, 0)",
+            (answer_id, question, vector.tobytes(), answer, link)
+        )
+        self.bump_generation()
+        self.conn.commit()
+        return answer_id
+
+    @synchronized
+    def vote_answer(self, answer_id: str, positive: bool) -> bool:
+        """
+        Add a user vote to a cached answer, answers with more negative than positive votes are not used anymore.
+
+        Returns:
+            bool: True if the cached answer exists, False otherwise.
+        """
+        column = 'positive_vote' if positive else 'negative_vote'
+        self.cursor.execute(f"UPDATE answer_cache SET {column} = {column} + 1 WHERE id = ?", (answer_id,))
+        found = self.cursor.rowcount > 0
+        if found:
+            self.increment_stat('positive_vote' if positive else 'negative_vote')
+            self.bump_generation()
+        self.conn.commit()
+        return found
+
+    @synchronized
+    def get_answer_stats(self) -> dict:
+        """
+        Return the answer cache counters: hit, miss, positive_vote, negative_vote and the number of cached answers (size).
+        """
+        self.cursor.execute("SELECT name, value FROM answer_cache_stats")
+        stats = {'hit': 0, 'miss': 0, 'positive_vote': 0, 'negative_vote': 0}
+        stats.update(dict(self.cursor.fetchall()))
+        self.cursor.execute("SELECT COUNT(*) FROM answer_cache")
+        stats['size'] = self.cursor.fetchone()[0]
+        return stats
+
+    def increment_stat(self, name: str):
+        self.cursor.execute(
+            "INSERT INTO answer_cache_stats (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,)
+        )
+
+    def bump_generation(self):
+        '''
+        Mark the answers embedding matrix as outdated in every process, committed with the caller transaction.
+        '''
+        self.cursor.execute("UPDATE answer_cache_meta SET value = value + 1 WHERE name = 'generation'")
+
+    def load_answer_matrix(self):
+        """
+        Load the normalized embeddings of the usable cached answers in a matrix, one row per answer.
+
+        The matrix is reloaded only when an answer was added, voted or evicted, also by another process (see ``bump_generation``).
+        """
+        self.cursor.execute("SELECT value FROM answer_cache_meta WHERE name = 'generation'")
+        generation = self.cursor.fetchone()[0]
+        if self.answer_matrix_generation == generation:
+            return
+
+        self.cursor.execute("SELECT id, embedding FROM answer_cache WHERE positive_vote >= negative_vote")
         rows = self.cursor.fetchall()
+        self.answer_ids = [row[0] for row in rows]
+        if rows:
+            self.answer_matrix = np.vstack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+        else:
+            self.answer_matrix = None
+        self.answer_matrix_generation = generation
 
-        for row in rows:
-            last_used_date = datetime.strptime(row[4], '%d/%m/%Y')
-            days_difference = (today - last_used_date.date()).days
+    @synchronized
+    def clean_cache(self) -> bool:
+        """
+        Clean the cache by removing records older than CACHE_EXP_DAY value, specified in costant.py file.
+
+        Returns:
+            bool: True if the cache is successfully cleaned, False otherwise.
+
+        Notes:
+            It removes the docs and the answers not used in the last CACHE_EXP_DAY days,
+            last_used is stored as YYYY-MM-DD (DATE('now')) so the comparison is done by SQLite.
+            It runs at startup and then every CACHE_CLEAN_INTERVAL_SEC, see ``start_cleaner``.
+        """
+        expiration = f'-{CACHE_EXP_DAY} days'
+        self.cursor.execute("DELETE FROM cache WHERE last_used < DATE('now', ?)", (expiration,))
+        self.cursor.execute("DELETE FROM answer_cache WHERE last_used < DATE('now', ?)", (expiration,))
+        if self.cursor.rowcount > 0: self.bump_generation()
 
-            if days_difference >= CACHE_EXP_DAY:
-                self.cursor.execute("DELETE FROM cache WHERE id = ?", (row[0],))
-        
         self.conn.commit()
         return True
+
+    def start_cleaner(self, interval: float = CACHE_CLEAN_INTERVAL_SEC):
+        '''
+        Run ``clean_cache`` now and then every ``interval`` seconds in a daemon thread, only the first call starts it.
+        '''
+        with self.lock:
+            if self.cleaner is not None: return
+            self.cleaner = Thread(target=self.run_cleaner, args=(interval,), name='cache-cleaner', daemon=True)
+            self.cleaner.start()
+
+    def run_cleaner(self, interval: float):
+        while True:
+            try:
+                self.clean_cache()
+            except Exception as e:
+                print(f'cache_db.run_cleaner: cache not cleaned, {e}')
+            if self.stopped.wait(interval): break
         
     def retrieve_cache_by_id(self, doc_ids: list[str]) -> dict:
         """
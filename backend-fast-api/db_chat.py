@@ -1,9 +1,15 @@
-from sqlite3 import connect
-from typing import List, Dict
+from sqlite3 import Connection, Cursor, IntegrityError
+from typing import List, Dict, Iterator
 from dataclasses import dataclass
 from json import dumps, loads
 from costant import *
-from lib_ import aws, util
+from lib_ import aws, util, synchronized
+from prompts import CONDENSE_SYS_PROMPT, CONDENSE_USER_PROMPT
+from db_pool import sqlite_pool
+from threading import RLock
+from collections import OrderedDict
+from time import time
+from hashlib import sha256
 
 @dataclass
 class Message:
@@ -285,6 +291,30 @@ class Conversation:
 
         return check
 
+    @staticmethod
+    def are_new_msg_consistent(last_role: str | None, new_msgs: list[Message]) -> bool:
+        """
+        Check that ``new_msgs`` can be appended to a consistent conversation whose last message has ``last_role``,
+        without loading the previous messages.
+
+        Args:
+            last_role (str | None): The role of the last stored message, None if the conversation is empty.
+            new_msgs (list[Message]): The messages to append.
+
+        Raises:
+            ValueError: If the first message of the conversation is not from the user or if the roles do not alternate.
+
+        Returns:
+            bool: True if the messages can be appended.
+        """
+        previous = last_role if last_role is not None else 'assistant' # an empty conversation MUST start with the user
+        for msg in new_msgs:
+            if msg.role == previous:
+                raise ValueError(f'requirement not satisfied: messages are not consistent:\n\t- the first message must be from the user\n\t- the roles must alternate')
+            previous = msg.role
+
+        return True
+
     def add_message(self, addition_msg: list[Message]) -> bool:
         """
         Extend the messages of the Conversation object with additional messages.
@@ -390,6 +420,76 @@ class Conversation:
         # Create and return a new Conversation object with the extracted messages
         return cls(messages)
 
+class conversation_session:
+    """
+    Unit of work on a single conversation, see ``conversation_db.open_session``.
+
+    The conversation is loaded once, messages and docs are added in memory and ``flush``
+    writes all of them with a single transaction.
+
+    Attributes:
+        conversation_id (str): The ID of the conversation.
+        conversation (Conversation): The stored messages plus the pending ones.
+        docs (Docs): The stored docs plus the pending ones.
+        stored_messages (int): Number of messages already in the database.
+        is_new (bool): Whether the conversation is not in the database yet.
+        version (int): The ``conversation.version`` the session was loaded at, 0 for a new conversation.
+    """
+    def __init__(self, db: 'conversation_db', conversation_id: str, conversation: Conversation, docs: Docs, is_new: bool, version: int = 0) -> None:
+        self.db = db
+        self.conversation_id = conversation_id
+        self.conversation = conversation
+        self.docs = docs
+        self.stored_messages = len(conversation.messages)
+        self.is_new = is_new
+        self.version = version
+        self.pending_docs: Dict[str, dict] = {}
+        self.used_docs: set[str] = set()
+
+    def add_message(self, new_msg: List[Message] | List[dict]) -> bool:
+        """
+        Add new messages to the conversation, in memory.
+
+        Raises:
+            ValueError: If the messages are not consistent with the conversation.
+        """
+        if util.is_dict_list(new_msg):
+            new_msg = [Message.from_dict(msg) for msg in new_msg]
+
+        return self.conversation.add_message(new_msg)
+
+    def add_docs(self, new_docs: dict) -> str:
+        """
+        Add new documents to the conversation, in memory.
+
+        Returns:
+            str: The JSON string of all the documents of the conversation, the new ones included.
+        """
+        for doc_hash, content in new_docs.items():
+            if doc_hash not in self.docs.data:
+                self.pending_docs[doc_hash] = content
+        self.docs.add_data(list(new_docs.keys()), list(new_docs.values()))
+
+        return dumps(self.docs.data, indent=4, ensure_ascii=False)
+
+    def touch_docs(self, doc_hashes: list[str]):
+        """
+        Mark the docs as used in this turn, the stored docs of a conversation are evicted least recently used first.
+        """
+        self.used_docs.update(doc_hashes)
+
+    def get_messages(self) -> list[dict]:
+        return self.conversation.to_list()
+
+    def get_pending_messages(self) -> list[Message]:
+        return self.conversation.messages[self.stored_messages:]
+
+    def flush(self) -> bool:
+        """
+        Write the pending messages and docs in a single transaction.
+        """
+        return self.db.flush_session(self)
+
 class conversation_db:
     """
     ConversationDB represents a database manager for conversations.
@@ -432,16 +532,115 @@ class conversation_db:
     def __init__(self) -> None:
         if not util.create_operational_folder():
             raise Exception('Conversation.__init__: cannot create operational folders')
-        self.conn = connect(CONVERSATION_DB_PATH, check_same_thread=False)
-        self.cursor = self.conn.cursor()
+        # only guards the in memory hot conversations, every thread has its own SQLite connection (see sqlite_pool)
+        self.lock = RLock()
+        # hot conversations: id -> (Conversation, Docs), as stored in the database
+        self.sessions: OrderedDict[str, tuple[Conversation, Docs, int]] = OrderedDict() # conversation, docs, version
+        self.pool = sqlite_pool(CONVERSATION_DB_PATH)
 
+        # version is incremented by every write of the messages or docs of the conversation, see ``open_session``
         self.cursor.execute(
             '''CREATE TABLE IF NOT EXISTS conversation (
                     id TEXT PRIMARY KEY,
                     messages TEXT null,
-                    docs TEXT null
+                    docs TEXT null,
+                    version INTEGER DEFAULT 0
                 )''')
-        
+        # messages are only appended, a turn inserts its rows without reading or rewriting the previous ones
+        self.cursor.execute(
+            '''CREATE TABLE IF NOT EXISTS message (
+                    conversation_id TEXT,
+                    seq INTEGER,
+                    role TEXT,
+                    content TEXT,
+                    created_at REAL,
+                    PRIMARY KEY (conversation_id, seq)
+                )''')
+        # docs are shared by every conversation, each row is stored once (see ``add_docs``)
+        self.cursor.execute(
+            '''CREATE TABLE IF NOT EXISTS document (
+                    id TEXT PRIMARY KEY,
+                    hash TEXT,
+                    data TEXT
+                )''')
+        self.cursor.execute(
+            '''CREATE TABLE IF NOT EXISTS conversation_doc (
+                    conversation_id TEXT,
+                    hash TEXT,
+                    document_id TEXT,
+                    attributes TEXT null,
+                    last_used REAL null,
+                    PRIMARY KEY (conversation_id, hash)
+                )''')
+        # summary of the messages with seq < until_seq, see ``condense_message``
+        self.cursor.execute(
+            '''CREATE TABLE IF NOT EXISTS conversation_digest (
+                    conversation_id TEXT PRIMARY KEY,
+                    digest TEXT,
+                    until_seq INTEGER,
+                    tokens INTEGER,
+                    updated_at REAL
+                )''')
+        self.conn.commit()
+        self.migrate()
+
+    @property
+    def conn(self) -> Connection:
+        return self.pool.connection()
+
+    @property
+    def cursor(self) -> Cursor:
+        return self.pool.cursor()
+
+    def migrate(self):
+        """
+        Upgrade the database to the current schema version (``PRAGMA user_version``).
+
+        Version 1: the messages stored as JSON blob in ``conversation.messages`` are moved to the ``message`` table.
+        Version 2: the docs stored as JSON blob in ``conversation.docs`` are moved to the ``document`` and ``conversation_doc`` tables.
+        Version 3: ``message.tokens``, the token estimate of each message (see ``util.estimate_tokens``).
+        Version 4: ``conversation_doc.last_used``, to evict the least recently used docs of a conversation.
+        Version 5: ``conversation.version``, to detect the changes made by another process to a cached conversation.
+        """
+        with self.pool.transaction(): # every worker runs it at startup, only the first one migrates
+            self.cursor.execute("PRAGMA user_version")
+            version = self.cursor.fetchone()[0]
+
+            if version < 1:
+                self.cursor.execute("SELECT id, messages FROM conversation WHERE messages IS NOT NULL")
+                for conversation_id, messages in self.cursor.fetchall():
+                    rows = [(conversation_id, seq, msg['role'], msg['content'], None) for seq, msg in enumerate(loads(messages)['messages'])]
+                    self.conn.executemany("INSERT OR IGNORE INTO message (conversation_id, seq, role, content, created_at) VALUES (?, ?, ?, ?, ?)", rows)
+                self.cursor.execute("UPDATE conversation SET messages = NULL")
+                self.cursor.execute("PRAGMA user_version = 1")
+                print('conversation_db.migrate: messages moved to the message table')
+
+            if version < 2:
+                self.cursor.execute("SELECT id, docs FROM conversation WHERE docs IS NOT NULL")
+                for conversation_id, docs in self.cursor.fetchall():
+                    self.insert_docs(conversation_id, Docs.from_str(docs).data)
+                self.cursor.execute("UPDATE conversation SET docs = NULL")
+                self.cursor.execute("PRAGMA user_version = 2")
+                print('conversation_db.migrate: docs moved to the document table')
+
+            if version < 3:
+                self.cursor.execute("ALTER TABLE message ADD COLUMN tokens INTEGER")
+                self.cursor.execute("UPDATE message SET tokens = (LENGTH(content) + ? - 1) / ?", (CHARS_PER_TOKEN, CHARS_PER_TOKEN))
+                self.cursor.execute("PRAGMA user_version = 3")
+                print('conversation_db.migrate: token estimates added to the messages')
+
+            if version < 4:
+                self.cursor.execute("SELECT COUNT(*) FROM pragma_table_info('conversation_doc') WHERE name = 'last_used'")
+                if not self.cursor.fetchone()[0]: # the table was created by an older version
+                    self.cursor.execute("ALTER TABLE conversation_doc ADD COLUMN last_used REAL")
+                self.cursor.execute("PRAGMA user_version = 4")
+
+            if version < 5:
+                self.cursor.execute("SELECT COUNT(*) FROM pragma_table_info('conversation') WHERE name = 'version'")
+                if not self.cursor.fetchone()[0]:
+                    self.cursor.execute("ALTER TABLE conversation ADD COLUMN version INTEGER DEFAULT 0")
+                self.cursor.execute("PRAGMA user_version = 5")
+
     def get_or_create_chat(self, conversation_id: str, conversation: Conversation = Conversation([])) -> Conversation:
         """
         Retrieve an existing conversation by its ID from the database, or create a new one if it doesn't exist.
@@ -455,11 +654,15 @@ class conversation_db:
         """
         chat = self.get_conversation(conversation_id)
         if not chat:
-            self.cursor.execute("INSERT INTO conversation (id, messages) VALUES (?, ?)", (conversation_id, conversation.to_string()))
-            self.conn.commit()
-            return conversation
-        else:
-            return chat['chat']
+            with self.pool.transaction():
+                self.cursor.execute("INSERT OR IGNORE INTO conversation (id) VALUES (?)", (conversation_id,))
+                created = self.cursor.rowcount > 0
+                if created: self.insert_messages(conversation_id, 0, conversation.messages)
+
+            if created: return conversation
+            chat = self.get_conversation(conversation_id) # created by another thread in the meantime
+
+        return chat['chat']
 
     def get_conversation(self, conversation_id: str) -> dict:
         """
@@ -471,22 +674,200 @@ class conversation_db:
         Returns:
             dict: A dictionary containing the conversation messages and associated documents if found, otherwise an empty dictionary.
         """
-        self.cursor.execute("SELECT messages, docs FROM conversation WHERE id = ?", (conversation_id,))
+        self.cursor.execute("SELECT 1 FROM conversation WHERE id = ?", (conversation_id,))
         row = self.cursor.fetchone()
         if row:
-            docs = Docs({})
-
-            if row[1] != None: # if conversation contains documents
-                docs = Docs(loads(row[1])) # load them
-            
             to_return = {
-                'chat': Conversation.from_string(row[0]),
-                'docs': docs
+                'chat': Conversation(self.get_messages(conversation_id)),
+                'docs': Docs(self.get_doc_data(conversation_id))
             }
             return to_return
         else:
             return {}
+
+    def get_messages(self, conversation_id: str) -> list[Message]:
+        self.cursor.execute("SELECT role, content FROM message WHERE conversation_id = ? ORDER BY seq", (conversation_id,))
+        return [Message(role, content) for role, content in self.cursor.fetchall()]
+
+    def get_doc_data(self, conversation_id: str) -> Dict[str, dict]:
+        """
+        Rebuild the docs of a conversation from its references, in the order they were added.
+        """
+        self.cursor.execute(
+            '''SELECT conversation_doc.hash, document.data, conversation_doc.attributes
+                FROM conversation_doc JOIN document ON document.id = conversation_doc.document_id
+                WHERE conversation_doc.conversation_id = ?
+                ORDER BY conversation_doc.rowid''',
+            (conversation_id,)
+        )
+        docs = {}
+        for doc_hash, data, attributes in self.cursor.fetchall():
+            docs[doc_hash] = {'data': data, **(loads(attributes) if attributes else {})}
+        return docs
+
+    def insert_docs(self, conversation_id: str, new_docs: Dict[str, dict]):
+        """
+        Store ``new_docs`` by reference: the ``data`` of each doc is stored once in the ``document`` table,
+        content addressed, the other keys (e.g. the similarity of this retrieval) are stored in the link.
+        As ``Docs.add_data``, docs already linked to the conversation are not replaced.
+        """
+        now = time()
+        Docs(new_docs) # validation
+        documents, links = [], []
+        for doc_hash, content in new_docs.items():
+            data = content.get('data', '')
+            document_id = sha256(f'{doc_hash}|{data}'.encode('utf-8')).hexdigest()
+            attributes = {key: value for key, value in content.items() if key != 'data'}
+            documents.append((document_id, doc_hash, data))
+            links.append((conversation_id, doc_hash, document_id, dumps(attributes, ensure_ascii=False) if attributes else None, now))
+
+        self.cursor.executemany("INSERT OR IGNORE INTO document (id, hash, data) VALUES (?, ?, ?)", documents)
+        self.cursor.executemany("INSERT OR IGNORE INTO conversation_doc (conversation_id, hash, document_id, attributes, last_used) VALUES (?, ?, ?, ?, ?)", links)
+
+    def touch_docs(self, conversation_id: str, doc_hashes: list[str]):
+        now = time()
+        self.cursor.executemany("UPDATE conversation_doc SET last_used = ? WHERE conversation_id = ? AND hash = ?", [(now, conversation_id, doc_hash) for doc_hash in doc_hashes])
+
+    def evict_docs(self, conversation_id: str, max_docs: int = CHAT_DOCS_MAX) -> int:
+        """
+        Unlink the least recently used docs of a conversation beyond ``max_docs``, the shared ``document`` rows are kept.
+
+        Returns:
+            int: The number of docs unlinked.
+        """
+        self.cursor.execute(
+            '''DELETE FROM conversation_doc WHERE conversation_id = ? AND hash NOT IN (
+                    SELECT hash FROM conversation_doc WHERE conversation_id = ? ORDER BY last_used DESC, rowid DESC LIMIT ?
+                )''',
+            (conversation_id, conversation_id, max_docs)
+        )
+        return self.cursor.rowcount
+
+    def bump_version(self, conversation_id: str) -> int:
+        """
+        Increment the version of a conversation, in the caller transaction, and return the version before the increment.
+        """
+        self.cursor.execute("SELECT version FROM conversation WHERE id = ?", (conversation_id,))
+        version = self.cursor.fetchone()[0]
+        self.cursor.execute("UPDATE conversation SET version = ? WHERE id = ?", (version + 1, conversation_id))
+        return version
+
+    def insert_messages(self, conversation_id: str, first_seq: int, messages: list[Message]):
+        now = time()
+        self.cursor.executemany(
+            "INSERT INTO message (conversation_id, seq, role, content, created_at, tokens) VALUES (?, ?, ?, ?, ?, ?)",
+            [(conversation_id, first_seq + i, msg.role, msg.content, now, util.estimate_tokens(msg.content)) for i, msg in enumerate(messages)]
+        )
+
+    def count_tokens(self, conversation_id: str, from_seq: int = 0) -> int:
+        """
+        Return the estimated tokens of the messages of a conversation, starting from ``from_seq``.
+        """
+        self.cursor.execute("SELECT COALESCE(SUM(tokens), 0) FROM message WHERE conversation_id = ? AND seq >= ?", (conversation_id, from_seq))
+        return self.cursor.fetchone()[0]
+
+    def get_digest(self, conversation_id: str) -> dict | None:
+        """
+        Return the digest of a conversation, None if the conversation was never condensed.
+
+        Returns:
+            dict | None: {"digest": str, "until_seq": int}, the digest summarizes the messages with seq < until_seq.
+        """
+        self.cursor.execute("SELECT digest, until_seq FROM conversation_digest WHERE conversation_id = ?", (conversation_id,))
+        row = self.cursor.fetchone()
+        return {'digest': row[0], 'until_seq': row[1]} if row else None
+
+    def set_digest(self, conversation_id: str, digest: str, until_seq: int) -> bool:
+        """
+        Store the digest of a conversation, unless a digest covering more messages is already stored.
+        """
+        with self.pool.transaction():
+            self.cursor.execute(
+                '''INSERT INTO conversation_digest (conversation_id, digest, until_seq, tokens, updated_at) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(conversation_id) DO UPDATE SET digest = excluded.digest, until_seq = excluded.until_seq, tokens = excluded.tokens, updated_at = excluded.updated_at
+                    WHERE excluded.until_seq > conversation_digest.until_seq''',
+                (conversation_id, digest, until_seq, util.estimate_tokens(digest), time())
+            )
+            return self.cursor.rowcount > 0
     
+    def open_session(self, conversation_id: str) -> conversation_session:
+        """
+        Open a unit of work on a conversation, the conversation is created by ``flush`` if it doesn't exist.
+
+        Hot conversations are kept in memory (``CONVERSATION_SESSION_CACHE_SIZE``): only ``conversation.version`` is read,
+        to detect the changes made by another process (e.g. docs added and evicted, the count doesn't change), and the conversation is not loaded again.
+        """
+        self.cursor.execute("SELECT version FROM conversation WHERE id = ?", (conversation_id,))
+        row = self.cursor.fetchone()
+        version = row[0] if row else None
+
+        with self.lock:
+            cached = self.sessions.get(conversation_id)
+            if cached and version is not None and cached[2] == version:
+                self.sessions.move_to_end(conversation_id)
+            else:
+                cached = None
+
+        if cached:
+            conversation, docs, _ = cached
+        elif version is not None:
+            # loaded after reading the version: at worst newer than it, the next open_session loads it again
+            conversation, docs = Conversation(self.get_messages(conversation_id)), Docs(self.get_doc_data(conversation_id))
+            self.cache_session(conversation_id, conversation, docs, version)
+        else:
+            conversation, docs = Conversation([]), Docs({})
+
+        # the session works on copies, the cached objects always match the database
+        return conversation_session(self, conversation_id, Conversation(list(conversation.messages)), Docs(dict(docs.data)), version is None, version or 0)
+
+    def flush_session(self, session: conversation_session) -> bool:
+        """
+        Write the pending messages and docs of ``session`` in a single transaction.
+
+        If the conversation was changed in the meantime (e.g. by another thread or process) the session is rebased:
+        the pending changes are applied on top of the stored conversation, if still consistent.
+
+        Raises:
+            ValueError: If the pending messages are not consistent with the stored conversation.
+        """
+        pending_messages = session.get_pending_messages()
+        try:
+            with self.pool.transaction():
+                self.cursor.execute("INSERT OR IGNORE INTO conversation (id) VALUES (?)", (session.conversation_id,))
+                self.insert_messages(session.conversation_id, session.stored_messages, pending_messages)
+                self.insert_docs(session.conversation_id, session.pending_docs)
+                self.touch_docs(session.conversation_id, list(session.used_docs))
+                evicted = self.evict_docs(session.conversation_id)
+                previous = self.bump_version(session.conversation_id)
+                if evicted: session.docs = Docs(self.get_doc_data(session.conversation_id))
+        except IntegrityError:
+            with self.lock: self.sessions.pop(session.conversation_id, None)
+            stored = Conversation(self.get_messages(session.conversation_id))
+            Conversation.are_new_msg_consistent(stored.messages[-1].role if stored.messages else None, pending_messages)
+
+            session.conversation = Conversation(stored.messages + pending_messages)
+            session.stored_messages = len(stored.messages)
+            return self.flush_session(session)
+
+        session.stored_messages = len(session.conversation.messages)
+        session.is_new = False
+        session.pending_docs = {}
+        session.used_docs = set()
+        if previous == session.version:
+            session.version = previous + 1
+            self.cache_session(session.conversation_id, Conversation(list(session.conversation.messages)), Docs(dict(session.docs.data)), session.version)
+        else:
+            # changed by another thread or process since the session was opened: its docs may be missing from the session
+            with self.lock: self.sessions.pop(session.conversation_id, None)
+        return True
+
+    @synchronized
+    def cache_session(self, conversation_id: str, conversation: Conversation, docs: Docs, version: int):
+        self.sessions[conversation_id] = (conversation, docs, version)
+        self.sessions.move_to_end(conversation_id)
+        while len(self.sessions) > CONVERSATION_SESSION_CACHE_SIZE:
+            self.sessions.popitem(last=False)
+
     def get_all_conversation(self) -> Dict[str, Conversation]:
         """
         Retrieve all conversations from the database.
@@ -496,14 +877,82 @@ class conversation_db:
         """
         conversations = {}
 
-        self.cursor.execute("SELECT id, messages FROM conversation",)
-        rows = self.cursor.fetchall()
-        
-        for r in rows:
-            conversations[r[0]] = Conversation.from_string(r[1])
+        self.cursor.execute("SELECT id FROM conversation")
+        for r in self.cursor.fetchall():
+            conversations[r[0]] = []
+
+        self.cursor.execute("SELECT conversation_id, role, content FROM message ORDER BY conversation_id, seq")
+        for r in self.cursor.fetchall():
+            if r[0] in conversations:
+                conversations[r[0]].append(Message(r[1], r[2]))
+
+        for conversation_id, messages in conversations.items():
+            conversations[conversation_id] = Conversation(messages)
 
         return conversations
 
+    def get_conversation_page(self, limit: int = CONVERSATION_PAGE_SIZE, after: str = None, summary: bool = False) -> dict:
+        """
+        Retrieve a page of conversations, ordered by ID, with keyset pagination.
+
+        Args:
+            limit (int, optional): Max number of conversations in the page.
+            after (str, optional): The ``next_after`` value of the previous page, None for the first page.
+            summary (bool, optional): If True only the summary of each conversation is returned, the messages are not read.
+
+        Returns:
+            dict: The page, with the structure:
+                {
+                    "conversations": [
+                        {"id": str, "messages": [{"role": str, "content": str}]} # or, with summary:
+                        {"id": str, "message_count": int, "last_activity": float | None}
+                    ],
+                    "next_after": str | None # None if this is the last page
+                }
+                last_activity is the time of the last message, None for empty conversations and for the ones migrated from the old schema.
+        """
+        if limit < 1: raise Exception('conversation_db.get_conversation_page: limit MUST be greater than 0')
+
+        if summary:
+            self.cursor.execute(
+                '''SELECT conversation.id, COUNT(message.seq), MAX(message.created_at)
+                    FROM conversation LEFT JOIN message ON message.conversation_id = conversation.id
+                    WHERE conversation.id > ?
+                    GROUP BY conversation.id ORDER BY conversation.id LIMIT ?''',
+                (after or '', limit)
+            )
+            conversations = [{'id': r[0], 'message_count': r[1], 'last_activity': r[2]} for r in self.cursor.fetchall()]
+        else:
+            self.cursor.execute("SELECT id FROM conversation WHERE id > ? ORDER BY id LIMIT ?", (after or '', limit))
+            conversations = [{'id': r[0], 'messages': []} for r in self.cursor.fetchall()]
+
+            if conversations:
+                # the messages are stored consistent, they are not validated again
+                by_id = {conversation['id']: conversation['messages'] for conversation in conversations}
+                self.cursor.execute(
+                    "SELECT conversation_id, role, content FROM message WHERE conversation_id BETWEEN ? AND ? ORDER BY conversation_id, seq",
+                    (conversations[0]['id'], conversations[-1]['id'])
+                )
+                for r in self.cursor.fetchall():
+                    if r[0] in by_id: by_id[r[0]].append({'role': r[1], 'content': r[2]})
+
+        return {
+            'conversations': conversations,
+            'next_after': conversations[-1]['id'] if len(conversations) == limit else None
+        }
+
+    def iter_conversations(self, after: str = None, summary: bool = False, page_size: int = CONVERSATION_PAGE_SIZE) -> Iterator[dict]:
+        """
+        Iterate over the conversations, ordered by ID, reading one page at a time (see ``get_conversation_page``).
+
+        No cursor is kept open between pages, so the iteration can be resumed by a different thread.
+        """
+        while True:
+            page = self.get_conversation_page(limit=page_size, after=after, summary=summary)
+            yield from page['conversations']
+            after = page['next_after']
+            if after is None: break
+
     def get_docs(self, conversation_id: str) -> Docs:
         """
         Retrieve the documents associated with a conversation from the database.
@@ -514,15 +963,14 @@ class conversation_db:
         Returns:
             Docs or None: The Docs object containing the documents associated with the conversation if found, else None.
         """
-        self.cursor.execute("SELECT docs FROM conversation WHERE id = ?", (conversation_id))
-        row = self.cursor.fetchone()
+        docs = self.get_doc_data(conversation_id)
 
-        if row[0]:
-            return Docs.from_str(row[0])
+        if docs:
+            return Docs(docs)
         else:
             return None
 
-    def add_docs(self, conversation_id: str, new_docs: dict) -> Docs:
+    def add_docs(self, conversation_id: str, new_docs: dict) -> str:
         """
         Add new documents to a conversation in the database.
 
@@ -531,25 +979,15 @@ class conversation_db:
             new_docs (dict): A dictionary where the keys are document hashes and the values are dictionaries representing document contents.
 
         Returns:
-            bool: True if the documents are successfully added to the conversation and the conversation is updated in the database, False otherwise.
+            str: The JSON string of all the documents of the conversation, the new ones included.
         """
-        temp = self.get_conversation(conversation_id)
-
-        if not temp['chat']: # chat not exist
-            self.get_or_create_chat(conversation_id) # create the chat without any msg
-            old_docs = Docs(new_docs) # create the docs obj
-        else:
-            ids = list(new_docs.keys())
-            contents = list(new_docs.values()) # reorg data to add it
-            old_docs: Docs = temp['docs'] # load past docs into variable
-            old_docs.add_data(ids, contents) # add new datas
-        
-        old_docs = dumps(dict(old_docs), indent=4, ensure_ascii=False)
+        with self.pool.transaction():
+            self.cursor.execute("INSERT OR IGNORE INTO conversation (id) VALUES (?)", (conversation_id,)) # create the chat if not exist
+            self.insert_docs(conversation_id, new_docs)
+            self.evict_docs(conversation_id)
+            self.bump_version(conversation_id)
 
-        self.cursor.execute("UPDATE conversation SET docs = ? WHERE id = ?", (old_docs, conversation_id))
-        self.conn.commit()
-        
-        return old_docs
+        return dumps(self.get_doc_data(conversation_id), indent=4, ensure_ascii=False)
 
     def add_message(self, conversation_id: str, new_msg: List[Message] | List[dict]):
         """
@@ -562,26 +1000,27 @@ class conversation_db:
         Returns:
             bool: True if the new messages are successfully added to the conversation and the conversation is updated in the database, False otherwise.
         """
-        # Retrieve the current conversation
-        current_conversation_obj = self.get_conversation(conversation_id)
-        
-        if current_conversation_obj['chat']:
-            current_conversation_obj: Conversation = current_conversation_obj['chat']
-
-            if util.is_dict_list(new_msg):
-                new_msg = [Message.from_dict(msg) for msg in new_msg]
-
-            # Add the new messages to the existing messages
-            current_conversation_obj.add_message(new_msg)
-            # Serialize the updated Conversation object to JSON
-            updated_conversation = current_conversation_obj.to_string()
-            # Update the conversation in the database
-            self.cursor.execute("UPDATE conversation SET messages = ? WHERE id = ?", (updated_conversation, conversation_id))
-            self.conn.commit()
-            return True
-        else:
-            print("Conversation not found.")
-            return False
+        if util.is_dict_list(new_msg):
+            new_msg = [Message.from_dict(msg) for msg in new_msg]
+        assert isinstance(new_msg, list) and all(isinstance(msg, Message) for msg in new_msg), "Each message must be a Message object"
+
+        # Only the existence of the conversation and its last message are read, in the same transaction of the insert
+        with self.pool.transaction():
+            self.cursor.execute("SELECT 1 FROM conversation WHERE id = ?", (conversation_id,))
+            if not self.cursor.fetchone():
+                print("Conversation not found.")
+                return False
+
+            self.cursor.execute("SELECT seq, role FROM message WHERE conversation_id = ? ORDER BY seq DESC LIMIT 1", (conversation_id,))
+            last = self.cursor.fetchone()
+            last_seq, last_role = last if last else (-1, None)
+
+            Conversation.are_new_msg_consistent(last_role, new_msg)
+            # Append the new messages
+            self.insert_messages(conversation_id, last_seq + 1, new_msg)
+            self.bump_version(conversation_id)
+
+        return True
 
     def get_multiple_conversations(self, conversation_ids: List[str]) -> List[Conversation]:
         """
@@ -612,22 +1051,52 @@ class conversation_db:
         """
         # Check if the conversation exists before attempting to delete it
         if self.get_conversation(conversation_id):
-            self.cursor.execute("DELETE FROM conversation WHERE id = ?", (conversation_id,))
-            self.conn.commit()
+            with self.lock: self.sessions.pop(conversation_id, None)
+            with self.pool.transaction():
+                self.cursor.execute("DELETE FROM message WHERE conversation_id = ?", (conversation_id,))
+                self.cursor.execute("DELETE FROM conversation_doc WHERE conversation_id = ?", (conversation_id,))
+                self.cursor.execute("DELETE FROM conversation_digest WHERE conversation_id = ?", (conversation_id,))
+                self.cursor.execute("DELETE FROM conversation WHERE id = ?", (conversation_id,))
             return True
         else:
             return False
 
-    def condense_message(self, aws: aws, id: str, n: int = 5):
-        raise Exception('uninplemented...')
-        all_msg: list = self.get_conversation(id).messages
-        selected_msg = all_msg[-n:]
+    def condense_message(self, aws: aws, id: str, n: int = HISTORY_KEEP_TURNS, bedrock_runtime = None, model_id: str = CONDENSE_MODEL_ID) -> dict | None:
+        """
+        Condense the older messages of a conversation into its digest, the last ``n`` turns are left out.
 
-        # ask claude to condense the selected_msg into one
-        # msg = aws.call_claude_3()
-        msg = [{}]
-        self.delete_chat(id)
-        return self.new_chat(id, msg)
+        The new digest summarizes the previous digest plus the messages not covered yet, it's written by ``model_id``.
+        It's slow (a Claude call): it's meant to run in background, see ``rag.schedule_condense``.
+
+        Args:
+            aws (aws): The aws instance used to call Claude.
+            id (str): The ID of the conversation.
+            n (int, optional): Number of last turns (question + answer) not condensed.
+
+        Returns:
+            dict | None: The new digest (see ``get_digest``), None if there was nothing to condense.
+        """
+        digest = self.get_digest(id) or {'digest': '', 'until_seq': 0}
+        self.cursor.execute("SELECT seq, role, content FROM message WHERE conversation_id = ? AND seq >= ? ORDER BY seq", (id, digest['until_seq']))
+        rows = self.cursor.fetchall()
+
+        selected_msg = rows[:max(0, len(rows) - 2 * n)]
+        while selected_msg and selected_msg[-1][1] != 'assistant': # condense whole turns only, the verbatim part starts with the user
+            selected_msg.pop()
+        if not selected_msg:
+            return None
+
+        # ask claude to condense the selected_msg and the previous digest into one
+        messages = ''.join(f'<message role="{role}">{content}</message>' for _, role, content in selected_msg)
+        new_digest = aws.call_claude_3(
+            system_prompt=CONDENSE_SYS_PROMPT,
+            messages=[{'role': 'user', 'content': CONDENSE_USER_PROMPT.format(digest=digest['digest'], messages=messages)}],
+            bedrock_runtime=bedrock_runtime, model_id=model_id, max_tokens=CONDENSE_MAX_TOKENS
+        ).strip()
+
+        until_seq = selected_msg[-1][0] + 1
+        self.set_digest(id, new_digest, until_seq)
+        return {'digest': new_digest, 'until_seq': until_seq}
 
 def test():
     print('this text func might be outdated')
@@ -682,6 +1151,41 @@ def test_docs():
         print(convs['chat'])
         print(convs['docs'])
 
+def test_concurrency(n_threads: int = 16, n_turns: int = 50):
+    """
+    Stress test: ``n_threads`` threads add turns to a shared conversation and to their own one,
+    while reading the shared conversation. Every turn MUST be stored once, with consecutive seq.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    chat_handler = conversation_db()
+    shared_id = 'test_concurrency_shared'
+    chat_handler.delete_chat(shared_id)
+    chat_handler.get_or_create_chat(shared_id)
+
+    def worker(n: int):
+        own_id = f'test_concurrency_{n}'
+        chat_handler.delete_chat(own_id)
+        chat_handler.get_or_create_chat(own_id)
+        for i in range(n_turns):
+            turn = [{'role': 'user', 'content': f'question {n}-{i}'}, {'role': 'assistant', 'content': f'answer {n}-{i}'}]
+            assert chat_handler.add_message(shared_id, turn)
+            assert chat_handler.add_message(own_id, turn)
+            chat_handler.get_conversation(shared_id)
+        return len(chat_handler.get_conversation(own_id)['chat'].messages)
+
+    start = time()
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        own_lengths = list(executor.map(worker, range(n_threads)))
+    elapsed = time() - start
+
+    shared = chat_handler.get_conversation(shared_id)['chat'] # validated by Conversation
+    assert len(shared.messages) == n_threads * n_turns * 2, 'lost messages in the shared conversation'
+    assert all(length == n_turns * 2 for length in own_lengths), 'lost messages in the own conversations'
+    print(f'{n_threads * n_turns * 4} messages added by {n_threads} threads in {elapsed:.2f}s')
+
+    chat_handler.delete_chat(shared_id)
+    for n in range(n_threads): chat_handler.delete_chat(f'test_concurrency_{n}')
+
 if __name__ == '__main__':
     pass
     
\ No newline at end of file
@@ -0,0 +1,76 @@
+from sqlite3 import connect, Connection, Cursor
+from threading import local, Lock
+from contextlib import contextmanager
+from costant import *
+
+class sqlite_pool:
+    '''
+    Per thread SQLite connections to a single database file, shared by the storage classes
+    (conversation_db, cache_db, retrieval_cache).
+
+    SQLite connections and cursors MUST NOT be shared between threads: every thread (FastAPI threadpool,
+    ``asyncio.to_thread`` workers) gets its own connection, opened on first use and reused afterwards.
+
+    Every connection uses:
+    - WAL journal: readers don't block the writer and the writer doesn't block readers
+    - synchronous=NORMAL: safe with WAL, a commit doesn't wait for an fsync
+    - a busy timeout: a writer waits for the lock instead of failing with "database is locked"
+    - a prepared statements cache
+    '''
+    def __init__(self, path: str, busy_timeout: float = SQLITE_BUSY_TIMEOUT_SEC, cached_statements: int = SQLITE_CACHED_STATEMENTS) -> None:
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self.local = local()
+        self.lock = Lock()
+        self.connections: list[Connection] = []
+
+    def connection(self) -> Connection:
+        '''
+        Return the connection of the current thread.
+        '''
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = connect(self.path, timeout=self.busy_timeout, cached_statements=self.cached_statements)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.cursor = conn.cursor()
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def cursor(self) -> Cursor:
+        '''
+        Return the cursor of the current thread.
+        '''
+        self.connection()
+        return self.local.cursor
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Run the block in a write transaction, committed at the end or rolled back on error.
+
+        The write lock is taken at the beginning (BEGIN IMMEDIATE), so the values read in the block
+        can't be changed by other connections before the block writes.
+        '''
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.local.cursor
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+    def close(self):
+        '''
+        Close every connection, the pool can't be used anymore by the threads that already used it.
+        '''
+        with self.lock:
+            for conn in self.connections:
+                try: conn.close()
+                except Exception: pass
+            self.connections = []
@@ -0,0 +1,155 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, TYPE_CHECKING
+from asyncio import to_thread
+from lib_ import util
+from costant import *
+
+if TYPE_CHECKING:
+    from opensearchpy import OpenSearch, AsyncOpenSearch
+
+class opensearch_embedder:
+    '''
+    Compute embeddings with the model deployed on the OpenSearch cluster, through the ML Commons predict API.
+
+    It is the same model used by the ingest pipeline and by the ``neural`` queries,
+    therefore the returned vectors can be used in plain ``knn`` queries against the index.
+    '''
+    def __init__(self, client: 'OpenSearch', model_id: str = OPENSEARCH_MODEL_ID, get_async_client: Callable[[], 'AsyncOpenSearch'] = None) -> None:
+        self.client = client
+        self.model_id = model_id
+        self.get_async_client = get_async_client
+
+    def __call__(self, texts: list[str]) -> list[list[float]]:
+        '''
+        Embed ``texts`` with a single model inference call.
+
+        Returns:
+            list[list[float]]: The embedding of each text, in the same order of ``texts``.
+        '''
+        response = self.client.transport.perform_request('POST', self.predict_path(), body=self.predict_body(texts))
+        return self.unpack_predict_result(response)
+
+    async def acall(self, texts: list[str]) -> list[list[float]]:
+        '''
+        Asyncio version of ``__call__``, it requires ``get_async_client``.
+        '''
+        response = await self.get_async_client().transport.perform_request('POST', self.predict_path(), body=self.predict_body(texts))
+        return self.unpack_predict_result(response)
+
+    def predict_path(self) -> str:
+        return f'/_plugins/_ml/_predict/text_embedding/{self.model_id}'
+
+    def predict_body(self, texts: list[str]) -> dict:
+        return {
+            'text_docs': texts,
+            'return_number': True,
+            'target_response': ['sentence_embedding']
+        }
+
+    def unpack_predict_result(self, response: dict) -> list[list[float]]:
+        return [res['output'][0]['data'] for res in response['inference_results']]
+
+class local_embedder:
+    '''
+    Compute embeddings in process with sentence-transformers, useful to avoid the cluster model inference at all.
+
+    sentence-transformers is an optional dependency, it is only imported when this class is used.
+    The model MUST be the one deployed on the cluster, otherwise the vectors are not comparable with the index ones.
+    '''
+    def __init__(self, model_name: str = LOCAL_EMBEDDING_MODEL) -> None:
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise Exception('local_embedder.__init__: sentence-transformers is required, pip install sentence-transformers')
+        self.model = SentenceTransformer(model_name)
+
+    def __call__(self, texts: list[str]) -> list[list[float]]:
+        return self.model.encode(texts).tolist()
+
+class embedding_cache:
+    '''
+    In memory LRU cache of embeddings, keyed by the normalized text.
+
+    Any callable that takes a list of texts and returns a list of vectors can be used as ``embedder``,
+    see ``opensearch_embedder`` and ``local_embedder``.
+    '''
+    def __init__(self, embedder: Callable[[list[str]], list[list[float]]], max_size: int = EMBEDDING_CACHE_SIZE) -> None:
+        self.embedder = embedder
+        self.max_size = max_size
+        self.data: OrderedDict[str, list[float]] = OrderedDict()
+        self.lock = Lock()
+
+    def embed(self, text: str) -> list[float]:
+        '''
+        Return the embedding of ``text``, the embedder is called only on a cache miss.
+        '''
+        return self.embed_many([text])[0]
+
+    def embed_many(self, texts: list[str]) -> list[list[float]]:
+        '''
+        Return the embedding of each text in ``texts``, the missing ones are computed with a single embedder call.
+        '''
+        keys = [util.normalize_text(text) for text in texts]
+        found, missing = self.lookup(keys)
+        if missing:
+            found.update(self.store(missing, self.embedder(missing)))
+
+        return [found[key] for key in keys]
+
+    async def aembed(self, text: str) -> list[float]:
+        '''
+        Asyncio version of ``embed``.
+        '''
+        return (await self.aembed_many([text]))[0]
+
+    async def aembed_many(self, texts: list[str]) -> list[list[float]]:
+        '''
+        Asyncio version of ``embed_many``: the embedder ``acall`` is awaited if available, otherwise the embedder runs in a thread.
+        '''
+        keys = [util.normalize_text(text) for text in texts]
+        found, missing = self.lookup(keys)
+        if missing:
+            if getattr(self.embedder, 'get_async_client', None) is not None:
+                vectors = await self.embedder.acall(missing)
+            else:
+                vectors = await to_thread(self.embedder, missing)
+            found.update(self.store(missing, vectors))
+
+        return [found[key] for key in keys]
+
+    def lookup(self, keys: list[str]) -> tuple[dict[str, list[float]], list[str]]:
+        '''
+        Return the cached embeddings among ``keys`` and the list of the missing keys, without duplicates.
+        '''
+        with self.lock:
+            found = {key: self.data[key] for key in keys if key in self.data}
+            for key in found: self.data.move_to_end(key)
+
+        missing = list(dict.fromkeys(key for key in keys if key not in found))
+        return found, missing
+
+    def store(self, keys: list[str], vectors: list[list[float]]) -> dict[str, list[float]]:
+        '''
+        Add the embeddings to the cache, evicting the least recently used ones above ``max_size``.
+        '''
+        stored = dict(zip(keys, vectors))
+        with self.lock:
+            self.data.update(stored)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+        return stored
+
+def test():
+    calls = []
+    def fake_embedder(texts: list[str]) -> list[list[float]]:
+        calls.append(texts)
+        return [[float(len(text))] for text in texts]
+
+    cache = embedding_cache(fake_embedder, max_size=2)
+    print(cache.embed('How do I detach a volume?'))
+    print(cache.embed('  how do I   DETACH a volume?'))
+    print(f'embedder calls: {len(calls)}') # expected 1
+
+if __name__ == '__main__':
+    test()
@@ -23,7 +23,6 @@ from json import loads, dumps
 from os import makedirs
 
 a = aws(load_bedrock=True)
-bedrock = a.bedrock
 
 def gen_q_from_doc(answer: str = '', category: str = '') -> str:
     if answer == '':
@@ -46,7 +45,7 @@ def gen_q_from_doc(answer: str = '', category: str = '') -> str:
     }]
     
     try:
-        res = a.call_claude_3(system_prompt=EVALUATE_PROMPT_GEN_Q_SYS, messages=msg, bedrock_runtime=bedrock)
+        res = a.call_claude_3(system_prompt=EVALUATE_PROMPT_GEN_Q_SYS, messages=msg, bedrock_runtime=a.bedrock)
         print(res)
         temp = loads(res)
     except Exception as e:
@@ -0,0 +1,143 @@
+from time import perf_counter
+from random import Random
+from costant import *
+
+class rank_fusion:
+    '''
+    Fuse the hits of several searches (one per query field) into a single deduplicated ranking.
+
+    Every hit is visited once: votes, best score and fusion score are accumulated per doc hash,
+    therefore the cost is linear in the total number of hits, whatever ``k`` or the number of fields.
+
+    Strategies (the fusion score used to rank the docs):
+    - votes: the best raw score across the result sets, same ranking of the original 2 of 3 selection
+    - rrf: reciprocal rank fusion, sum of 1 / (rrf_k + rank) over the result sets
+    - max: the best min-max normalized score across the result sets
+    - sum: the sum of the min-max normalized scores (CombSUM), docs found by more searches are favoured
+
+    With every strategy only the docs found by at least ``min_votes`` result sets are returned.
+    '''
+    def __init__(self, strategy: str = FUSION_STRATEGY, rrf_k: int = FUSION_RRF_K) -> None:
+        if strategy not in FUSION_STRATEGIES: raise Exception(f'rank_fusion.__init__: invalid strategy, supported strategies: {", ".join(FUSION_STRATEGIES)}')
+        self.strategy = strategy
+        self.rrf_k = rrf_k
+
+    def fuse(self, results: list[list[dict]], min_votes: int = 2, top_n: int = None) -> list[dict]:
+        '''
+        Args:
+            results (list[list[dict]]): The hits of each search, as returned by ``rag.unpack_query_result``.
+            min_votes (int): Min number of result sets a doc MUST be found in.
+            top_n (int): Max number of docs returned, all the selected docs if None.
+
+        Returns:
+            list[dict]: The selected docs, best first, as ``{'_score': best raw score, **_source}``.
+        '''
+        # hash -> [votes, last result set that voted, best raw score, best hit, fusion score]
+        table: dict[str, list] = {}
+        for set_index, hits in enumerate(results):
+            if not hits: continue
+            if self.strategy in ['max', 'sum']:
+                scores = [hit['_score'] for hit in hits]
+                low, high = min(scores), max(scores)
+                scale = high - low
+
+            for rank, hit in enumerate(hits):
+                if self.strategy == 'votes': score = hit['_score']
+                elif self.strategy == 'rrf': score = 1 / (self.rrf_k + rank + 1)
+                else: score = (hit['_score'] - low) / scale if scale else 1.0
+
+                doc_hash = hit['_source']['hash']
+                entry = table.get(doc_hash)
+                if entry is None:
+                    table[doc_hash] = [1, set_index, hit['_score'], hit, score]
+                    continue
+
+                if entry[1] != set_index: # a doc returned twice by the same search is voted once
+                    entry[0] += 1
+                    entry[1] = set_index
+                if hit['_score'] > entry[2]:
+                    entry[2] = hit['_score']
+                    entry[3] = hit
+                if self.strategy in ['rrf', 'sum']: entry[4] += score
+                elif score > entry[4]: entry[4] = score
+
+        selected = [entry for entry in table.values() if entry[0] >= min_votes]
+        selected.sort(key=lambda entry: entry[4], reverse=True)
+        if top_n is not None: selected = selected[:top_n]
+
+        return [{'_score': entry[2], **entry[3]['_source']} for entry in selected]
+
+def legacy_2of3(res_1: list[dict], res_2: list[dict], res_3: list[dict]) -> list[dict]:
+    '''
+    The set algebra selection replaced by ``rank_fusion``, kept as reference for ``benchmark``.
+    '''
+    all_res = res_1 + res_2 + res_3
+    hash_set_1 = set(record['_source']['hash'] for record in res_1)
+    hash_set_2 = set(record['_source']['hash'] for record in res_2)
+    hash_set_3 = set(record['_source']['hash'] for record in res_3)
+    hash_in_3of3 = hash_set_1.intersection(hash_set_2, hash_set_3)
+    intersection_12_3 = hash_set_1.union(hash_set_2).intersection(hash_set_3)
+    intersection_23_1 = hash_set_2.union(hash_set_3).intersection(hash_set_1)
+    intersection_31_2 = hash_set_3.union(hash_set_1).intersection(hash_set_2)
+    hash_in_2of3 = intersection_12_3.symmetric_difference(intersection_23_1).union(intersection_12_3.symmetric_difference(intersection_31_2))
+    selected_hashes = hash_in_2of3.union(hash_in_3of3)
+
+    selected_records = [{'_score': record['_score'], **record['_source']} for record in all_res if record['_source']['hash'] in selected_hashes]
+    selected_records = sorted(selected_records, key=lambda x: x['_score'], reverse=True)
+    unique_res, added_hashes = [], set()
+    for obj in selected_records:
+        if obj['hash'] not in added_hashes:
+            unique_res.append(obj)
+            added_hashes.add(obj['hash'])
+    return sorted(unique_res, key=lambda x: x['_score'], reverse=True)
+
+def fake_results(n_fields: int, k: int, n_docs: int, seed: int = 0) -> list[list[dict]]:
+    '''
+    ``n_fields`` result sets of ``k`` hits each, drawn from a knowledge base of ``n_docs`` docs.
+    '''
+    rng = Random(seed)
+    results = []
+    for _ in range(n_fields):
+        hits = [{'_score': rng.uniform(0.5, 1.0), '_source': {'hash': f'h{doc}', 'text_en': f'doc {doc}'}} for doc in rng.sample(range(n_docs), k)]
+        results.append(sorted(hits, key=lambda hit: hit['_score'], reverse=True))
+    return results
+
+def benchmark(repeat: int = 200):
+    '''
+    Compare ``rank_fusion`` (votes strategy) with the set algebra selection, for growing ``k`` and number of fields.
+    '''
+    fusion = rank_fusion('votes')
+    for k in [11, 50, 200, 1000]:
+        results = fake_results(3, k, n_docs=k * 3)
+        assert fusion.fuse(results, min_votes=2) == legacy_2of3(*results), 'rank_fusion does not match the set algebra selection'
+
+        start = perf_counter()
+        for _ in range(repeat): legacy_2of3(*results)
+        legacy_time = (perf_counter() - start) / repeat * 1000
+
+        start = perf_counter()
+        for _ in range(repeat): fusion.fuse(results, min_votes=2)
+        fusion_time = (perf_counter() - start) / repeat * 1000
+        print(f'3 fields, k={k}: set algebra {legacy_time:.3f} ms, rank_fusion {fusion_time:.3f} ms')
+
+    for n_fields in [3, 6, 12]:
+        results = fake_results(n_fields, 50, n_docs=150)
+        for strategy in FUSION_STRATEGIES:
+            fusion = rank_fusion(strategy)
+            start = perf_counter()
+            for _ in range(repeat): fusion.fuse(results, min_votes=2)
+            print(f'{n_fields} fields, k=50, {strategy}: {(perf_counter() - start) / repeat * 1000:.3f} ms')
+
+def test():
+    res_1 = [{'_score': 0.9, '_source': {'hash': 'a'}}, {'_score': 0.8, '_source': {'hash': 'b'}}, {'_score': 0.7, '_source': {'hash': 'c'}}]
+    res_2 = [{'_score': 0.95, '_source': {'hash': 'b'}}, {'_score': 0.6, '_source': {'hash': 'd'}}]
+    res_3 = [{'_score': 0.85, '_source': {'hash': 'c'}}, {'_score': 0.5, '_source': {'hash': 'b'}}]
+
+    print(rank_fusion('votes').fuse([res_1, res_2, res_3], min_votes=2)) # b (0.95), c (0.85)
+    print(rank_fusion('votes').fuse([res_1, res_2, res_3], min_votes=3)) # b
+    print(rank_fusion('rrf').fuse([res_1, res_2, res_3], min_votes=1, top_n=2)) # b, then a or c
+    print(rank_fusion('sum').fuse([res_1, res_2, res_3], min_votes=1, top_n=2))
+    benchmark()
+
+if __name__ == '__main__':
+    test()
@@ -1,13 +1,60 @@
-from boto3 import setup_default_session, client, Session
+from boto3 import Session
 from botocore.config import Config
 from json import load, loads, dumps
-from opensearchpy import OpenSearch
-from langdetect import detect
 from os import makedirs
 from os.path import dirname
 from costant import *
 from secrets import choice
 from string import ascii_letters, digits
+from re import sub
+from asyncio import get_running_loop, shield, wrap_future
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from inspect import getgeneratorstate, GEN_CREATED
+from functools import partial, wraps, lru_cache
+from typing import Iterator, AsyncIterator, TYPE_CHECKING
+from threading import Thread, Lock, RLock, Event
+from time import time
+from rate_limiter import rate_limiter
+
+# opensearchpy (and opensearch_transport) are imported when the first client is created, see aws.get_opensearch
+if TYPE_CHECKING:
+    from opensearchpy import OpenSearch, AsyncOpenSearch
+
+def synchronized(method):
+    """
+    Decorator for the storage classes methods (conversation_db, cache_db, retrieval_cache): serialize the access to their in memory state.
+    SQLite connections are not shared between threads, see ``db_pool.sqlite_pool``.
+
+    The methods are called both from FastAPI threadpool and from the threads used by the async API,
+    the lock is reentrant because some methods call each other.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+LAZY_LOCK = RLock() # reentrant: a lazy attribute can use another one while it's built
+
+def lazy_property(method):
+    """
+    Decorator for the expensive attributes (clients, SQLite databases, ...): the value is built on first access,
+    under a lock so every thread gets the same instance, and stored in the instance ``__dict__``.
+
+    Importing public_api or creating a ``rag`` doesn't open any connection, the first request that needs it does.
+    """
+    name = method.__name__
+    @property
+    @wraps(method)
+    def wrapper(self):
+        try:
+            return self.__dict__[name]
+        except KeyError:
+            with LAZY_LOCK:
+                if name not in self.__dict__:
+                    self.__dict__[name] = method(self)
+                return self.__dict__[name]
+    return wrapper
 
 class util:
     @staticmethod
@@ -82,12 +129,13 @@ class util:
         return True
 
     @staticmethod
+    @lru_cache(maxsize=None)
     def load_settings() -> dict:
         '''
-        Load settings from the 'settings.json' file.
+        Load settings from the 'settings.json' file, it is read once per process.
 
         Returns:
-            dict: A dictionary containing the loaded settings.
+            dict: A dictionary containing the loaded settings, shared by every caller: DO NOT modify it.
         '''
         return util.load_json_file('settings.json')
     
@@ -102,6 +150,8 @@ class util:
         Returns:
             str: The detected language code (e.g., 'en' for English).
         '''
+        from langdetect import detect, DetectorFactory # slow import (language profiles), only when a language is detected
+        DetectorFactory.seed = 0 # same text, same language
         try:
             detected_language = detect(text)
             return detected_language
@@ -124,6 +174,31 @@ class util:
         characters = ascii_letters + digits
         return ''.join(choice(characters) for _ in range(length))
 
+    @staticmethod
+    def normalize_text(text: str, strip_punctuation: bool = False) -> str:
+        '''
+        Normalize a text to be used as cache key: lowercase, single spaces and no leading/trailing spaces.
+
+        Args:
+            text (str): The text to normalize.
+            strip_punctuation (bool): Whether to remove the punctuation too (default is False).
+
+        Returns:
+            str: The normalized text.
+        '''
+        text = text.lower()
+        if strip_punctuation:
+            text = sub(r'[^\w\s]', ' ', text)
+        return sub(r'\s+', ' ', text).strip()
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        '''
+        Estimate the number of tokens of a text, without a tokenizer: ~``CHARS_PER_TOKEN`` chars per token.
+        It's used to budget the conversation history, not to bill.
+        '''
+        return -(-len(text) // CHARS_PER_TOKEN)
+
     @staticmethod
     def is_str_list(data) -> bool:
         '''
@@ -150,76 +225,175 @@ class util:
         '''
         return all(isinstance(item, dict) for item in data) if isinstance(data, list) else False
 
+# boto3 has no asyncio support: Bedrock calls awaited by the async API run here, never on the event loop
+BEDROCK_EXECUTOR = ThreadPoolExecutor(max_workers=BEDROCK_MAX_CONCURRENCY, thread_name_prefix='bedrock')
+
+class bedrock_provider:
+    '''
+    Process wide Bedrock runtime client, shared by every ``aws`` instance (rag, evaluate_prompt, ...).
+
+    The client is built with temporary STS credentials (``duration`` seconds) on the first ``client`` call,
+    then a background thread builds a new one ``margin`` seconds before the credentials expire and swaps it in:
+    a request never waits for STS, the calls in flight keep using the previous client until they end.
+    If a refresh fails it's retried every ``BEDROCK_REFRESH_RETRY_SEC`` while the current credentials are still valid.
+
+    botocore clients are thread safe, one client (and its connection pool of ``BEDROCK_MAX_CONCURRENCY``
+    connections, same size of ``BEDROCK_EXECUTOR``) serves every thread of the process.
+    '''
+    def __init__(self, duration: int = BEDROCK_CREDENTIALS_DURATION_SEC, margin: int = BEDROCK_REFRESH_MARGIN_SEC) -> None:
+        self.duration = duration
+        self.margin = margin
+        self.bedrock = None
+        self.expiration = 0.0
+        self.refreshes = 0
+        self.lock = Lock()
+        self.stopped = Event()
+        self.refresher: Thread = None
+
+    def client(self):
+        '''
+        Return the current Bedrock runtime client.
+
+        Notes:
+            Only the first call (or a call after the credentials expired, e.g. STS unreachable for the whole margin)
+            builds the client synchronously.
+        '''
+        if self.bedrock is None or time() >= self.expiration:
+            with self.lock:
+                if self.bedrock is None or time() >= self.expiration:
+                    self.refresh()
+            self.start()
+        return self.bedrock
+
+    def refresh(self):
+        '''
+        Get new temporary credentials and swap in a client that uses them.
+        '''
+        settings = util.load_settings()
+        region = settings['bedrock_region']
+        session = Session(
+            aws_access_key_id=settings['access_key'],
+            aws_secret_access_key=settings['secret_key'],
+            region_name=region
+        )
+        credentials = session.client('sts').get_session_token(DurationSeconds=self.duration)['Credentials']
+
+        session = Session(
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken'],
+            region_name=region
+        )
+        self.bedrock = session.client('bedrock-runtime', config=Config(
+            region_name=region,
+            retries={
+                'max_attempts': BEDROCK_MAX_ATTEMPTS,
+                'mode': 'standard'
+            },
+            max_pool_connections=BEDROCK_MAX_CONCURRENCY,
+            connect_timeout=BEDROCK_CONNECT_TIMEOUT_SEC,
+            read_timeout=BEDROCK_READ_TIMEOUT_SEC,
+            tcp_keepalive=True
+        ))
+        self.expiration = credentials['Expiration'].timestamp()
+        self.refreshes += 1
+
+    def start(self):
+        if self.refresher is not None: return
+        with self.lock:
+            if self.refresher is None:
+                self.refresher = Thread(target=self.run, name='bedrock-refresher', daemon=True)
+                self.refresher.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while True:
+            wait = max(self.expiration - self.margin - time(), BEDROCK_REFRESH_RETRY_SEC)
+            if self.stopped.wait(wait): break
+            try:
+                with self.lock: self.refresh()
+            except Exception as e:
+                print(f'bedrock_provider.run: refresh failed, retry in {BEDROCK_REFRESH_RETRY_SEC} s, {e}')
+
+BEDROCK = bedrock_provider()
+
+# admission control of every Claude call of the process (or of every worker, see RATE_LIMIT_SHARED)
+BEDROCK_LIMITER = rate_limiter(
+    {'requests': (BEDROCK_RPS, BEDROCK_RPS_BURST), 'tokens': (BEDROCK_TPM / 60, BEDROCK_TPM)},
+    path=RATE_LIMIT_DB_PATH if RATE_LIMIT_SHARED else None
+)
+
+OPENSEARCH_CLIENT: 'OpenSearch' = None # shared by every handler of the process, see aws.get_opensearch
+OPENSEARCH_LOCK = Lock()
+
 class aws:
     def __init__(self, load_bedrock: bool = False, load_opensearch: bool = False) -> None:
         self.settings = util.load_settings()
-        if load_bedrock: self.bedrock = self.get_bedrock()
+        if load_bedrock: self.get_bedrock()
         if load_opensearch: self.opensearch = self.get_opensearch()
     
-    def get_opensearch(self) -> OpenSearch:
+    def get_opensearch(self, shared: bool = True) -> 'OpenSearch':
         ''' 
         Get the OpenSearch client for interacting with an OpenSearch service.
 
+        Args:
+            shared (bool): Return the client shared by the whole process (created on the first call), a new one if False.
+
         Returns:
             OpenSearch: An OpenSearch client instance.
 
         Notes:
-            This function initializes and returns an OpenSearch client with the specified configuration 
-            parameters, including the OpenSearch URL, username, and password. It is used for interacting 
-            with an OpenSearch service.
-        '''
-        return OpenSearch(
-            hosts=[self.settings['opensearch_url']],
-            http_auth=(self.settings['username_opensearch'], self.settings['password_opensearch']),
-            verify_certs=False
-        )
+            The client is configured with the URL and credentials of settings.json and the transport profile
+            (pool size, compression, timeouts, retries with jittered backoff, sniffing), see ``opensearch_transport.client_options``.
+            The client is thread safe: sharing it shares its connection pool, a new handler doesn't open new connections.
+        '''
+        from opensearchpy import OpenSearch
+        from opensearch_transport import client_options
+        global OPENSEARCH_CLIENT
+        if not shared:
+            return OpenSearch(**client_options(self.settings))
+        if OPENSEARCH_CLIENT is None:
+            with OPENSEARCH_LOCK:
+                if OPENSEARCH_CLIENT is None: OPENSEARCH_CLIENT = OpenSearch(**client_options(self.settings))
+        return OPENSEARCH_CLIENT
     
-    # for local test only
-    def get_bedrock(self):
+    def get_opensearch_async(self) -> 'AsyncOpenSearch':
         ''' 
-        Get the Bedrock client session.
+        Get the asyncio OpenSearch client for interacting with an OpenSearch service.
 
         Returns:
-            Session: The Bedrock client session for making requests.
+            AsyncOpenSearch: An AsyncOpenSearch client instance, same configuration of ``get_opensearch``.
 
         Notes:
-            This function retrieves the Bedrock client session based on the configured bedrock_region
-            and temporary session credentials obtained using AWS STS.
+            The client MUST be used, and closed, within the same event loop, therefore it's not shared.
         '''
-        region = self.settings['bedrock_region']
-        session = setup_default_session(
-            aws_access_key_id=self.settings['access_key'],
-            aws_secret_access_key=self.settings['secret_key'],
-            region_name=region
-        )
-        
-        sts_client = client('sts')
-        # Get a session token
-        session_token = sts_client.get_session_token(
-            DurationSeconds=3600
-        )
+        from opensearchpy import AsyncOpenSearch
+        from opensearch_transport import client_options
+        return AsyncOpenSearch(**client_options(self.settings, use_async=True))
 
-        # Create a session with the temporary credentials
-        session = Session(
-            aws_access_key_id=session_token['Credentials']['AccessKeyId'],
-            aws_secret_access_key=session_token['Credentials']['SecretAccessKey'],
-            aws_session_token=session_token['Credentials']['SessionToken'],
-            region_name=region
-        )
-        
-        client_session = session.client('bedrock-runtime', config=Config(
-            region_name=region,
-            retries={
-                'max_attempts': 5,
-                'mode': 'standard'
-            }
-        ))
-        return client_session
+    @property
+    def bedrock(self):
+        return self.get_bedrock()
+
+    def get_bedrock(self):
+        ''' 
+        Get the Bedrock runtime client.
+
+        Returns:
+            The Bedrock runtime client shared by the whole process, see ``bedrock_provider``.
+
+        Notes:
+            Don't keep the returned client for longer than a request: it's replaced when the credentials are refreshed,
+            read ``aws.bedrock`` again instead.
+        '''
+        return BEDROCK.client()
 
     def call_claude_3(self,
             system_prompt, messages: list[dict], bedrock_runtime = None, 
             model_id: str = 'anthropic.claude-3-sonnet-20240229-v1:0', 
-            temperature: float = 0.0, max_tokens: int = 3000
+            temperature: float = 0.0, max_tokens: int = 3000, limit: bool = True
         ) -> str:
         ''' 
         Call the Anthropic Claude-3 model for text generation.
@@ -231,10 +405,14 @@ class aws:
             model_id (str): The ID of the model to use. Defaults to 'anthropic.claude-3-opus-20240229-v1:0'.
             temperature (float): The temperature parameter for text generation. Defaults to 0.0.
             max_tokens (int): The maximum number of tokens to generate. Defaults to 3000.
+            limit (bool): Whether to wait for ``BEDROCK_LIMITER`` before the call, False if already admitted.
 
         Returns:
             str: The generated text response.
 
+        Raises:
+            RateLimitExceeded: If the call is not admitted by ``BEDROCK_LIMITER``.
+
         Notes:
             This function calls the Anthropic Claude-3 model for text generation using the provided system_prompt and messages.
             If bedrock_runtime is not provided, it is retrieved based on the configured bedrock_region.
@@ -258,7 +436,119 @@ class aws:
         if bedrock_runtime == None:
             bedrock_runtime = self.get_bedrock()
 
-        body=dumps(
+        reserved = self.estimate_claude_3_tokens(system_prompt, messages, max_tokens)
+        if limit: BEDROCK_LIMITER.acquire(requests=1, tokens=reserved)
+        text = ''
+        try:
+            body = self.build_claude_3_body(system_prompt, messages, temperature, max_tokens)
+            response = bedrock_runtime.invoke_model(body=body, modelId=model_id)
+            response_body = loads(response.get('body').read())
+            text = response_body['content'][0]['text']
+        finally:
+            BEDROCK_LIMITER.release(tokens=max_tokens - util.estimate_tokens(text)) # output tokens reserved but not generated, all of them if the call failed
+        return text
+
+    async def acall_claude_3(self,
+            system_prompt, messages: list[dict], bedrock_runtime = None, 
+            model_id: str = 'anthropic.claude-3-sonnet-20240229-v1:0', 
+            temperature: float = 0.0, max_tokens: int = 3000
+        ) -> str:
+        ''' 
+        Asyncio version of ``call_claude_3``, same arguments and return value.
+
+        Notes:
+            The blocking boto3 call runs on ``BEDROCK_EXECUTOR``, so the event loop keeps serving other requests
+            while the model is generating; up to ``BEDROCK_MAX_CONCURRENCY`` calls are in flight at the same time.
+            The wait for ``BEDROCK_LIMITER`` happens in the event loop, it doesn't hold an executor thread.
+        '''
+        await BEDROCK_LIMITER.aacquire(requests=1, tokens=self.estimate_claude_3_tokens(system_prompt, messages, max_tokens))
+        loop = get_running_loop()
+        return await loop.run_in_executor(
+            BEDROCK_EXECUTOR,
+            partial(self.call_claude_3, system_prompt, messages, bedrock_runtime, model_id, temperature, max_tokens, False)
+        )
+
+    def call_claude_3_stream(self,
+            system_prompt, messages: list[dict], bedrock_runtime = None, 
+            model_id: str = 'anthropic.claude-3-sonnet-20240229-v1:0', 
+            temperature: float = 0.0, max_tokens: int = 3000, limit: bool = True
+        ) -> Iterator[str]:
+        ''' 
+        Streaming version of ``call_claude_3``, same arguments.
+
+        Yields:
+            str: The chunks of the generated text, as soon as Bedrock sends them.
+
+        Notes:
+            It uses Bedrock response stream API (invoke_model_with_response_stream), the request is sent on the first ``next``.
+        '''
+        if bedrock_runtime == None:
+            bedrock_runtime = self.get_bedrock()
+
+        if limit: BEDROCK_LIMITER.acquire(requests=1, tokens=self.estimate_claude_3_tokens(system_prompt, messages, max_tokens))
+        generated = []
+        try:
+            body = self.build_claude_3_body(system_prompt, messages, temperature, max_tokens)
+            response = bedrock_runtime.invoke_model_with_response_stream(body=body, modelId=model_id)
+            for event in response.get('body'):
+                chunk = loads(event['chunk']['bytes'])
+                if chunk['type'] == 'content_block_delta' and chunk['delta']['type'] == 'text_delta':
+                    generated.append(chunk['delta']['text'])
+                    yield chunk['delta']['text']
+        finally:
+            BEDROCK_LIMITER.release(tokens=max_tokens - util.estimate_tokens(''.join(generated))) # all of them if the invoke failed
+
+    async def acall_claude_3_stream(self,
+            system_prompt, messages: list[dict], bedrock_runtime = None, 
+            model_id: str = 'anthropic.claude-3-sonnet-20240229-v1:0', 
+            temperature: float = 0.0, max_tokens: int = 3000
+        ) -> AsyncIterator[str]:
+        ''' 
+        Asyncio version of ``call_claude_3_stream``, each chunk is read from the stream on ``BEDROCK_EXECUTOR``.
+
+        When the consumer stops early or is cancelled the stream is closed on ``BEDROCK_EXECUTOR`` (see ``close_claude_3_stream``).
+        '''
+        await BEDROCK_LIMITER.aacquire(requests=1, tokens=self.estimate_claude_3_tokens(system_prompt, messages, max_tokens))
+        stream = self.call_claude_3_stream(system_prompt, messages, bedrock_runtime, model_id, temperature, max_tokens, False)
+        pending: Future = None
+        try:
+            while True:
+                pending = BEDROCK_EXECUTOR.submit(next, stream, None)
+                chunk = await wrap_future(pending)
+                if chunk is None: break
+                yield chunk
+        finally:
+            await shield(get_running_loop().run_in_executor(BEDROCK_EXECUTOR, self.close_claude_3_stream, stream, pending, max_tokens))
+
+    @staticmethod
+    def close_claude_3_stream(stream: Iterator[str], pending: Future, max_tokens: int):
+        '''
+        Close a ``call_claude_3_stream`` generator (and its Bedrock response) from a thread, after the read in progress if any:
+        a generator can't be closed while another thread runs it.
+        A generator never started doesn't run its finally, its reserved output tokens are released here.
+        '''
+        if pending is not None: wait([pending]) # cancelled before running or done, the result doesn't matter
+        if getgeneratorstate(stream) == GEN_CREATED:
+            BEDROCK_LIMITER.release(tokens=max_tokens)
+        stream.close()
+
+    @staticmethod
+    def estimate_claude_3_tokens(system_prompt, messages: list[dict], max_tokens: int) -> int:
+        '''
+        Tokens reserved on ``BEDROCK_LIMITER`` for a call: estimated input tokens (text only) plus ``max_tokens``.
+        '''
+        texts = [system_prompt] if isinstance(system_prompt, str) else []
+        for message in messages:
+            content = message['content']
+            if isinstance(content, str): texts.append(content)
+            else: texts.extend(block.get('text', '') for block in content)
+        return util.estimate_tokens(''.join(texts)) + max_tokens
+
+    def build_claude_3_body(self, system_prompt, messages: list[dict], temperature: float, max_tokens: int) -> str:
+        '''
+        Build the JSON body of an Anthropic Claude-3 request for Bedrock.
+        '''
+        return dumps(
             {
                 "anthropic_version": "bedrock-2023-05-31",
                 "max_tokens": max_tokens,
@@ -268,18 +558,18 @@ class aws:
             }
         )
 
-        response = bedrock_runtime.invoke_model(body=body, modelId=model_id)
-        response_body = loads(response.get('body').read())
-        return response_body['content'][0]['text']
-
-from chromadb import Collection, PersistentClient, ClientAPI
-from lib_ import util
+if TYPE_CHECKING:
+    from chromadb import Collection, ClientAPI
 
 class chroma_wrapper:
+    '''
+    chromadb is only imported when a chroma_wrapper is created, the API doesn't use it.
+    '''
     def __init__(self, persist_directory: str) -> None:
         self.client = self.create_or_load_db(persist_directory)
 
-    def create_or_load_db(self, persist_directory: str) -> ClientAPI:
+    def create_or_load_db(self, persist_directory: str) -> 'ClientAPI':
+        from chromadb import PersistentClient
         return PersistentClient(path=persist_directory)
 
     def reset_db(self) -> bool:
@@ -291,7 +581,7 @@ class chroma_wrapper:
         '''
         return self.client.reset()
 
-    def create_collection(self, name: str) -> Collection:
+    def create_collection(self, name: str) -> 'Collection':
         """
         Create a new collection in the database with the specified name.
 
@@ -312,7 +602,7 @@ class chroma_wrapper:
             metadata={"hnsw:space": "cosine"} # l2 is the default
         )
     
-    def get_collection(self, name: str, create_if_fail: bool = False) -> Collection:
+    def get_collection(self, name: str, create_if_fail: bool = False) -> 'Collection':
         """
         Retrieve a collection from the database by its name.
 
@@ -432,7 +722,7 @@ class chroma_wrapper:
             raise ValueError(f'load_data: `data` must be of type list[dict] and must contains the following keys in each dict: document, metadata and id')
 
     def query(self, query_texts: list[str], k: float, where: dict = {}, where_doc: dict = {}, 
-              collection: Collection = None, collection_name: str = '', include: list[str] =["documents"] ):
+              collection: 'Collection' = None, collection_name: str = '', include: list[str] =["documents"] ):
         """
         Query a Chroma collection with the specified query texts. Either pass collection or collection_name. [Full docs about where and where_doc clause](https://docs.trychroma.com/usage-guide#using-where-filters)
 
@@ -476,7 +766,7 @@ class chroma_wrapper:
             include=include
         )
 
-    def get_doc_by_id(self, ids: list[str], collection: Collection = None, collection_name: str = '', where: dict = {}, include: list[str] =["documents"]):
+    def get_doc_by_id(self, ids: list[str], collection: 'Collection' = None, collection_name: str = '', where: dict = {}, include: list[str] =["documents"]):
         """
         Retrieve documents from a Chroma collection by their IDs.
 
@@ -506,7 +796,7 @@ class chroma_wrapper:
             include=include
         )
 
-    def update_data(self, ids: list[str], metadatas: list[dict] = [], docs: list[str] = [], collection: Collection = None, collection_name: str = ''):
+    def update_data(self, ids: list[str], metadatas: list[dict] = [], docs: list[str] = [], collection: 'Collection' = None, collection_name: str = ''):
         """
         Update data in a Chroma collection.
 
@@ -533,7 +823,7 @@ class chroma_wrapper:
             documents=docs,
         )
     
-    def delete_data(self, ids: list[str], where: dict = {}, where_doc: dict = {}, collection: Collection = None, collection_name: str = ''):
+    def delete_data(self, ids: list[str], where: dict = {}, where_doc: dict = {}, collection: 'Collection' = None, collection_name: str = ''):
         """
         Delete data from a Chroma collection.
 
@@ -0,0 +1,128 @@
+from os import makedirs
+from os.path import join, exists
+from json import load, dumps, loads
+from typing import Callable
+import numpy as np
+from lib_ import aws
+from opensearch import opensearch_data_handler
+from embedding import opensearch_embedder
+from retrieval_cache import retrieval_cache
+from costant import *
+
+# text field embedded in each kNN field, same mapping of the ingest pipeline (see opensearch_dev_tools/create_index_allmini.md)
+FIELD_SOURCES = {
+    'text_en_embedding': 'text_en',
+    'text_it_embedding': 'text',
+    'category_en_embedding': 'category_en'
+}
+
+class local_vector_engine:
+    '''
+    In process alternative to the OpenSearch kNN index, the whole knowledge base (db.json) fits in memory.
+
+    The embeddings of the 3 kNN fields are stored, normalized, in a single contiguous float32 array
+    of shape (fields, docs, dimension), saved as .npy and memory mapped when loaded.
+    A search computes the cosine similarity of every doc, for every field, with a single matrix multiply.
+
+    The results have the same shape of an OpenSearch search response, therefore ``rag.unpack_query_result``
+    and ``rag.search_doc`` work unchanged.
+    '''
+    def __init__(self, index_dir: str = LOCAL_INDEX_DIR) -> None:
+        self.index_dir = index_dir
+        self.embeddings_file = join(index_dir, 'embeddings.npy')
+        self.records_file = join(index_dir, 'records.json')
+        self.matrix: np.ndarray = None
+        self.records: list[dict] = []
+
+    def is_built(self) -> bool:
+        return exists(self.embeddings_file) and exists(self.records_file)
+
+    def build(self, embedder: Callable[[list[str]], list[list[float]]], db_file: str = 'db.json', batch_size: int = 64) -> bool:
+        '''
+        Embed every db.json record for every kNN field and save the index files, then load them.
+
+        Args:
+            embedder: Any callable that takes a list of texts and returns a list of vectors, see embedding.py.
+                It MUST be the model used to embed the questions.
+            db_file (str): The knowledge base file.
+            batch_size (int): Number of texts embedded with a single embedder call.
+        '''
+        with open(db_file, 'r', encoding='utf-8') as f:
+            records = [opensearch_data_handler.prepare_record(record) for record in load(f)]
+
+        fields = []
+        for field in SEARCH_FIELDS:
+            texts = [record[FIELD_SOURCES[field]] for record in records]
+            vectors = []
+            for i in range(0, len(texts), batch_size):
+                vectors.extend(embedder(texts[i:i + batch_size]))
+            fields.append(np.asarray(vectors, dtype=np.float32))
+
+        matrix = np.ascontiguousarray(np.stack(fields)) # (fields, docs, dimension)
+        matrix /= np.linalg.norm(matrix, axis=2, keepdims=True)
+
+        makedirs(self.index_dir, exist_ok=True)
+        np.save(self.embeddings_file, matrix)
+        open(self.records_file, 'w', encoding='utf-8').write(dumps(records, ensure_ascii=False))
+        print(f'local_vector_engine: {len(records)} docs indexed in {self.index_dir}')
+
+        retrieval_cache().invalidate() # cached search results are outdated, in every worker
+        return self.load()
+
+    def load(self) -> bool:
+        '''
+        Memory map the embeddings and load the records.
+
+        Raises:
+            Exception: If the index was never built.
+        '''
+        if not self.is_built():
+            raise Exception(f'local_vector_engine.load: index not found in {self.index_dir}, build it first')
+
+        self.matrix = np.load(self.embeddings_file, mmap_mode='r')
+        self.records = loads(open(self.records_file, 'r', encoding='utf-8').read())
+        if self.matrix.shape[:2] != (len(SEARCH_FIELDS), len(self.records)):
+            raise Exception('local_vector_engine.load: embeddings and records do not match, rebuild the index')
+        return True
+
+    def search(self, vector: list[float], k: int = 9, fields: list[str] = SEARCH_FIELDS) -> list[dict]:
+        '''
+        Retrieve the top ``K`` documents nearest to ``vector`` for each kNN field in ``fields``.
+
+        Return:
+            A list with a search response for each field, in the same order of ``fields``.
+            Scores follow OpenSearch nmslib cosinesimil scoring: 1 / (1 + (1 - cosine similarity))
+        '''
+        if self.matrix is None:
+            self.load()
+
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / np.linalg.norm(query)
+
+        n_fields, n_docs, dimension = self.matrix.shape
+        similarities = (self.matrix.reshape(n_fields * n_docs, dimension) @ query).reshape(n_fields, n_docs)
+        k = min(k, n_docs)
+
+        responses = []
+        for field in fields:
+            row = similarities[SEARCH_FIELDS.index(field)]
+            top = np.argpartition(-row, k - 1)[:k]
+            top = top[np.argsort(-row[top])]
+            responses.append({
+                'hits': {
+                    'hits': [{
+                        '_index': 'local',
+                        '_id': str(doc),
+                        '_score': float(1 / (2 - row[doc])),
+                        '_source': self.records[doc]
+                    } for doc in top]
+                }
+            })
+        return responses
+
+def build_index():
+    engine = local_vector_engine()
+    engine.build(opensearch_embedder(aws().get_opensearch()))
+
+if __name__ == '__main__':
+    build_index()
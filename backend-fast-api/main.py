@@ -1,41 +1,227 @@
 from prompts import *
-from lib_ import util, aws
-from deepl import Translator
+from lib_ import util, aws, lazy_property
 from xml.dom.minidom import parseString
 from costant import *
 from db_cache import cache_db
-from db_chat import conversation_db
+from db_chat import conversation_db, conversation_session
 from opensearch import opensearch_data_handler
+from embedding import embedding_cache, opensearch_embedder
+from retrieval_cache import retrieval_cache
+from translation import translation_service, deepl_backend
+from local_search import local_vector_engine
+from fusion import rank_fusion
+from search_planner import search_planner, SearchPlan
+from model_router import model_router
+from telemetry import TELEMETRY
 from json import dumps, loads
 from os.path import exists
 from re import sub, findall, DOTALL
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Lock
+from asyncio import to_thread, shield
+from contextlib import aclosing
+from time import perf_counter
+from typing import AsyncIterator
+
+# shared by every rag instance, the OpenSearch client is thread safe
+SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=SEARCH_POOL_SIZE, thread_name_prefix='opensearch-search')
+# conversations are condensed in background, the user facing request never waits for it (see rag.schedule_condense)
+CONDENSE_EXECUTOR = ThreadPoolExecutor(max_workers=CONDENSE_POOL_SIZE, thread_name_prefix='condense')
 
 class rag:
-    def __init__(self, debug_mode: bool = False, lang: str = 'en') -> None:
+    def __init__(self, debug_mode: bool = False, lang: str = 'en', search_mode: str = 'knn') -> None:
         self.debug_mode = debug_mode
+        if search_mode not in SEARCH_MODES: raise Exception(f'rag.__init__: invalid search_mode, supported modes: {", ".join(SEARCH_MODES)}')
+        else: self.search_mode = search_mode
         lang = lang.lower()
         if lang not in ['en', 'it']: raise Exception('rag.__init__: invalid lang, supported lang: EN, IT')
         else: self.lang = lang
 
+        # clients and databases are created on first use, see lazy_property
         self.settings = util.load_settings()
-        self.aws = aws(load_bedrock=True, load_opensearch=False)
-        self.bedrock = self.aws.bedrock
-        self.opensearch = opensearch_data_handler()
-        self.cache_handler = cache_db()
-        self.chat_handler = conversation_db()
+        self.aws = aws()
+        self.local_engine = None
+        if self.search_mode == 'local':
+            self.local_engine = local_vector_engine()
+            self.local_engine.load()
+        self.fusion = rank_fusion(FUSION_STRATEGY)
+        self.planner = search_planner(self.translate)
+        self.router = model_router()
+        self.condensing: set[str] = set() # chats being condensed
+        self.condensing_lock = Lock()
+
+    @property
+    def bedrock(self):
+        return self.aws.bedrock # the process wide client, replaced when the credentials are refreshed
+
+    @lazy_property
+    def opensearch(self) -> opensearch_data_handler:
+        return opensearch_data_handler()
+
+    @lazy_property
+    def embeddings(self) -> embedding_cache:
+        return embedding_cache(opensearch_embedder(self.opensearch.client, get_async_client=self.opensearch.get_async_client))
+
+    @lazy_property
+    def cache_handler(self) -> cache_db:
+        cache_handler = cache_db()
+        cache_handler.start_cleaner() # evicts the docs and answers not used for CACHE_EXP_DAY days
+        return cache_handler
+
+    @lazy_property
+    def retrieval_cache(self) -> retrieval_cache:
+        return retrieval_cache()
+
+    @lazy_property
+    def chat_handler(self) -> conversation_db:
+        return conversation_db()
+
+    @lazy_property
+    def translator(self) -> translation_service:
+        return translation_service(deepl_backend(self.settings['deepl_api']))
+
+    def open_storage(self):
+        '''
+        Create the SQLite backed lazy properties now (connection, schema, migrations), blocking:
+        the async API calls it in a thread at startup, so the event loop never creates them on first use.
+        '''
+        self.chat_handler, self.retrieval_cache, self.cache_handler, self.translator
+
+    def translate(self, query: str, target_lang: str = 'EN-US') -> str:
+        result = self.translator.translate(query, target_lang)
+        if self.debug_mode: print(result)
+        return result
+
+    def translate_batch(self, texts: list[str], target_lang: str = 'EN-US') -> list[str]:
+        '''
+        Translate several texts with at most one DeepL request per ``TRANSLATION_BATCH_SIZE`` texts not cached yet.
+        '''
+        return self.translator.translate_batch(texts, target_lang)
+
+    def launch_searches(self, question: str, k: int = 11) -> tuple[list[dict] | None, ...]:
+        '''
+        Run the field searches planned for the question language (see ``search_planner``) and return their hits,
+        in the order of ``SEARCH_FIELDS``; an English or Italian question skips the text field of the other language.
+
+        Depending on ``search_mode``:
+        - knn: each query text is embedded once (and cached), the ``knn`` queries are sent in a single ``_msearch`` request
+        - local: each query text is embedded once (and cached), the fields are searched in process, see ``local_vector_engine``
+        - msearch: the queries are sent in a single ``_msearch`` request, if the request fails the concurrent mode is used
+        - concurrent: the queries are sent in parallel, see ``launch_concurrent_searches``
+        - sequential: the queries are sent one after the other
+        A query that fails is returned as None, so the caller can go on with the partial results.
+
+        Raises:
+            Exception: If every search failed.
+        '''
+        plan = self.planner.plan(question)
+        if plan.pending: self.planner.resolve(plan) # DeepL, only with SEARCH_PLAN_TRANSLATE and a field in another language
+
+        if self.search_mode in ['knn', 'local', 'msearch']:
+            try:
+                if self.search_mode == 'local':
+                    vectors = self.embeddings.embed_many(plan.texts) # one embedder call, duplicated texts embedded once
+                    responses = self.search_local(plan, vectors, k)
+                elif self.search_mode == 'knn':
+                    vectors = self.embeddings.embed_many(plan.texts) # one embedder call, duplicated texts embedded once
+                    responses = self.opensearch.multi_search_by_vectors(vectors=vectors, k=k, fields=plan.fields)
+                else:
+                    responses = self.opensearch.multi_search_by_fields(question=plan.texts, k=k, fields=plan.fields)
+                return self.unpack_multi_search_results(responses)
+            except Exception as e:
+                print(f'launch_searches: {self.search_mode} search failed ({e}), falling back to concurrent searches')
+
+        return self.launch_concurrent_searches(plan=plan, k=k)
+
+    async def alaunch_searches(self, question: str, k: int = 11) -> tuple[list[dict] | None, ...]:
+        '''
+        Asyncio version of ``launch_searches``: knn and msearch modes use the AsyncOpenSearch client, local mode runs in the event loop,
+        the translation, the other modes (and the fallback) run in a thread.
+        '''
+        plan = self.planner.plan(question)
+        if plan.pending: await to_thread(self.planner.resolve, plan)
+
+        if self.search_mode in ['knn', 'local', 'msearch']:
+            try:
+                if self.search_mode == 'local':
+                    vectors = await self.embeddings.aembed_many(plan.texts)
+                    responses = self.search_local(plan, vectors, k) # sub-millisecond, no need of a thread
+                elif self.search_mode == 'knn':
+                    vectors = await self.embeddings.aembed_many(plan.texts)
+                    responses = await self.opensearch.amulti_search_by_vectors(vectors=vectors, k=k, fields=plan.fields)
+                else:
+                    responses = await self.opensearch.amulti_search_by_fields(question=plan.texts, k=k, fields=plan.fields)
+                return self.unpack_multi_search_results(responses)
+            except Exception as e:
+                print(f'alaunch_searches: {self.search_mode} search failed ({e}), falling back to concurrent searches')
+
+        return await to_thread(self.launch_concurrent_searches, plan=plan, k=k)
+
+    def search_local(self, plan: SearchPlan, vectors: list[list[float]], k: int) -> list[dict]:
+        '''
+        Search the planned fields of the local index, the fields with the same query text share a single matrix multiply.
+        '''
+        groups: dict[str, list[int]] = {}
+        for i, text in enumerate(plan.texts):
+            groups.setdefault(text, []).append(i)
+
+        responses = [None] * len(plan.fields)
+        for indexes in groups.values():
+            fields = [plan.fields[i] for i in indexes]
+            for i, response in zip(indexes, self.local_engine.search(vector=vectors[indexes[0]], k=k, fields=fields)):
+                responses[i] = response
+        return responses
+
+    def unpack_multi_search_results(self, responses: list[dict | None]) -> tuple[list[dict] | None, ...]:
+        '''
+        Unpack the hits of each ``_msearch`` response, failed searches stay None.
 
-    def translate(self, query: str, target_lang: str = 'EN-US'):
-        translator = Translator(self.settings['deepl_api'])
+        Raises:
+            Exception: If every search failed.
+        '''
+        results = tuple(self.unpack_query_result(res) if res is not None else None for res in responses)
+        if all(res is None for res in results):
+            raise Exception('launch_searches: every search failed')
+        return results
+
+    def launch_concurrent_searches(self, plan: SearchPlan, k: int = 11) -> tuple[list[dict] | None, ...]:
+        '''
+        Run the planned field searches with one request each and return their hits, in the order of ``plan.fields``.
+
+        Unless ``search_mode`` is sequential the queries are sent in parallel through ``SEARCH_EXECUTOR``,
+        therefore the retrieval latency is the one of the slowest query, capped at ``SEARCH_TIMEOUT_SEC``.
+        A query that fails or times out is returned as None, so the caller can go on with the partial results.
+
+        Raises:
+            Exception: If every search failed.
+        '''
+        field_searches = {
+            'text_en_embedding': self.opensearch.search_by_text_en,
+            'text_it_embedding': self.opensearch.search_by_text_it,
+            'category_en_embedding': self.opensearch.search_by_category_en
+        }
+        searches = [field_searches[field] for field in plan.fields]
+
+        if self.search_mode == 'sequential':
+            return tuple(self.unpack_query_result(search(question=text, k=k)) for search, text in zip(searches, plan.texts))
+
+        futures = [SEARCH_EXECUTOR.submit(search, question=text, k=k) for search, text in zip(searches, plan.texts)]
+        wait(futures, timeout=SEARCH_TIMEOUT_SEC)
+
+        results = []
+        for search, future in zip(searches, futures):
+            if future.done() and future.exception() is None:
+                results.append(self.unpack_query_result(future.result()))
+            else:
+                future.cancel() # no-op if already running, the request timeout will stop it
+                reason = 'timed out' if not future.done() else future.exception()
+                print(f'launch_concurrent_searches: {search.__name__} {reason}, going on with partial results')
+                results.append(None)
 
-        result = translator.translate_text(query, target_lang=target_lang)
-        if self.debug_mode: print(result.text)
-        return result.text
+        if all(res is None for res in results):
+            raise Exception('launch_concurrent_searches: every search failed')
 
-    def launch_searches(self, question: str, k: int = 11):
-        res_1 = self.unpack_query_result(self.opensearch.search_by_text_en(question=question, k=k))
-        res_2 = self.unpack_query_result(self.opensearch.search_by_text_it(question=question, k=k))
-        res_3 = self.unpack_query_result(self.opensearch.search_by_category_en(question=question, k=k))
-        return res_1, res_2, res_3
+        return tuple(results)
 
     def extract_hash_from_result(self, res: list[dict]) -> set[str]:
         return set(record['hash'] for record in res)
@@ -55,51 +241,51 @@ class rag:
 
     def search_doc(self, question: str, only_3of3: bool = False, k: int = 11) -> list[dict]:
         '''
-        Return the docs that exist in at least 2/3 of the result sets
-        This means docs that exist in:
-        - 3 out of 3 sets
-        - 2 out of 3 sets
-        are returned as list of dict
-        '''
-        res_1, res_2, res_3 = self.launch_searches(question=question, k=k)
-        all_res = res_1 + res_2 + res_3
-
-        # Create sets of hashes from each set of records
-        hash_set_1 = set(record['_source']['hash'] for record in res_1)
-        hash_set_2 = set(record['_source']['hash'] for record in res_2)
-        hash_set_3 = set(record['_source']['hash'] for record in res_3)
-
-        # Find the docs in common in all 3 searches
-        hash_in_3of3 = hash_set_1.intersection(hash_set_2, hash_set_3)
-
-        if not only_3of3:
-            # Find the union of pairs of sets
-            union_12 = hash_set_1.union(hash_set_2)
-            union_23 = hash_set_2.union(hash_set_3)
-            union_31 = hash_set_3.union(hash_set_1)
-
-            # Find the intersection of pairs of sets
-            intersection_12_3 = union_12.intersection(hash_set_3)
-            intersection_23_1 = union_23.intersection(hash_set_1)
-            intersection_31_2 = union_31.intersection(hash_set_2)
-
-            # Find Symmetric Difference of Intersections
-            intersection_12_3_23 = intersection_12_3.symmetric_difference(intersection_23_1)
-            intersection_12_3_31 = intersection_12_3.symmetric_difference(intersection_31_2)
-
-            # Combine both symmetric differences to get the final selected set of hashes
-            hash_in_2of3 = intersection_12_3_23.union(intersection_12_3_31)
-            selected_hashes = hash_in_2of3.union(hash_in_3of3)
-        else:
-            selected_hashes = hash_in_3of3
-
-        # Filter records that have hashes present in the selected hashes
-        
-        selected_records = [{'_score': record['_score'], **record['_source']} for record in all_res if record['_source']['hash'] in selected_hashes]
-        # delete duplicate, by default there are duplicates because docs must be in 2 or 3 results sets, therefore the are for sure 2 or 3 duplicate docs
-        unique_res = self.get_unique_output(selected_records, selected_hashes) 
-        # unique output randomly mixes the docs order, but we want it to be in order of score
-        unique_res = self.sort_objects_by_score(unique_res)
+        Return the docs that exist in at least 2 of the result sets (all of them if ``only_3of3``),
+        one result set for each planned field search (see ``launch_searches``), as list of dict
+
+        Results are cached by normalized question, see ``retrieval_cache``
+        '''
+        docs = self.retrieval_cache.get(question, k, only_3of3)
+        if docs is not None:
+            return docs
+
+        results = self.launch_searches(question=question, k=k)
+        docs = self.select_docs(results, only_3of3=only_3of3)
+        if None not in results: # partial results are not cached
+            self.retrieval_cache.put(question, k, only_3of3, docs)
+        return docs
+
+    async def asearch_doc(self, question: str, only_3of3: bool = False, k: int = 11) -> list[dict]:
+        '''
+        Asyncio version of ``search_doc``, the retrieval cache is used in a thread: even a memory hit checks the SQLite generation.
+        '''
+        docs = await to_thread(self.retrieval_cache.get, question, k, only_3of3)
+        if docs is not None:
+            return docs
+
+        results = await self.alaunch_searches(question=question, k=k)
+        docs = self.select_docs(results, only_3of3=only_3of3)
+        if None not in results: # partial results are not cached
+            await to_thread(self.retrieval_cache.put, question, k, only_3of3, docs)
+        return docs
+
+    def select_docs(self, results: tuple[list[dict] | None, ...], only_3of3: bool = False) -> list[dict]:
+        '''
+        Select the docs to return from the result sets of ``launch_searches``, see ``search_doc``.
+
+        Docs MUST be found by at least 2 result sets. With ``only_3of3`` they MUST be found by every planned field search:
+        3 of 3 for a question of unknown language, 2 of 2 for an English or Italian one (``SEARCH_PLANS`` has 2 fields),
+        that's the same threshold as the non strict mode but on one result set less.
+        When some searches failed the docs MUST be found by every available result set.
+        '''
+        available = [res for res in results if res is not None]
+        planned = len(results) # one result set per planned field, the failed ones are None
+        if len(available) < planned: min_votes = len(available)
+        elif only_3of3: min_votes = planned
+        else: min_votes = min(2, planned)
+
+        unique_res = self.fusion.fuse(available, min_votes=min_votes)
         if self.debug_mode: print(len(unique_res)); print(unique_res)
 
         return unique_res
@@ -182,51 +368,33 @@ class rag:
             raise Exception('analyze_similarity_scores: len(score_list) MUST be EQUAL len(texts) ')
         
         self._log_curr_message_id = chat_id + '-' + util.generate_random_string(10) # change for every new message
-        file_path = 'simil-score.json'
-        if not exists(file_path):
-            # Create the file if it doesn't exist
-            with open(file_path, "w", encoding='utf-8') as file:
-                file.write(dumps([]))
-                input()
-
-        data = []
-        for i, score in enumerate(score_list):
-            data.append({
-                'id': self._log_curr_message_id,
-                'doc': delete_simil_score_from_text(texts[i]),
-                'score': score,
-                'question': question
-            })
-        # print(data)
-        previuos_data: list = loads(open(file_path, 'r', encoding='utf-8').read())
-        previuos_data.extend(data)
-        open(file_path, 'w', encoding='utf-8').write(dumps(previuos_data, indent=4, ensure_ascii=False))
-
-    def log_claude_res(self, answer: str):
-        file_path = 'simil-score.json'
-
-        previuos_data: list = loads(open(file_path, 'r', encoding='utf-8').read())
-        new_data = []
-        for obj in previuos_data:
-            if obj['id'] == self._log_curr_message_id:
-                obj['answer'] = answer
-        
-            new_data.append(obj)
-        
-        open(file_path, 'w', encoding='utf-8').write(dumps(new_data, indent=4, ensure_ascii=False))
+        # O(1): the event is queued and appended to the telemetry file by a background thread, see telemetry_sink
+        TELEMETRY.emit(
+            'similarity_scores',
+            id=self._log_curr_message_id,
+            chat_id=chat_id,
+            question=question,
+            docs=[{'doc': delete_simil_score_from_text(text), 'score': score} for score, text in zip(score_list, texts)]
+        )
+        return self._log_curr_message_id
+
+    def log_claude_res(self, answer: str, message_id: str = ''):
+        '''
+        Log Claude answer, it's joined to the similarity scores by message id when the telemetry is read (see telemetry.load_similarity_scores).
+        '''
+        # turns are served concurrently, the caller should pass the id returned by log_similarity_scores
+        if message_id == '': message_id = self._log_curr_message_id
+        TELEMETRY.emit('claude_answer', id=message_id, answer=answer)
 
-    def get_similar_docs(self, query_text: str, chat_id: str):
+    def get_similar_docs(self, query_text: str, chat_id: str, similar_docs: list[dict] = None):
         chat_docs = dict()
         chat_docs_link = dict()
         cache_docs_used = dict()
-        ##### for score analysis
-        score_list = []
-        text_list = []
 
-        similar_docs = self.search_doc(question=query_text, only_3of3=True) 
+        if similar_docs is None:
+            similar_docs = self.search_doc(question=query_text, only_3of3=True) 
 
         for obj in similar_docs:
-            score_list.append(obj['_score'])
             additional_data = ''
             if len(obj['required_role']):
                 additional_data += f'<required-role>{",".join(obj['required_role'])}</required-role>'
@@ -235,6 +403,8 @@ class rag:
                 data = f"<doc similarity=\"{obj['_score']}\"><category>{obj['category_en']}</category><text>{obj['text_en']}</text>{additional_data}</doc>"
             else:
                 data = f"<doc><category>{obj['category']}</category><text>{obj['text']}</text>{additional_data}</doc>"
+            # the similarity is kept out of the stored doc, so the doc is stored once for every conversation (see conversation_db.add_docs)
+            doc_xml = sub(r' similarity="[^"]*"', '', data)
             cache_docs_used[obj['hash']] = {
                 'data': data,
                 'link': obj['link'],
@@ -243,62 +413,301 @@ class rag:
                 'negative_vote': 0,
                 'time_used': 1
             }
-            docs_text = self.beautify_xml(data)
+            docs_text = self.beautify_xml(doc_xml)
             chat_docs[obj['hash']] = {
                 'data': docs_text
             }
-            text_list.append(docs_text)
+            if self.lang == 'en':
+                chat_docs[obj['hash']]['similarity'] = obj['_score']
+            chat_docs[obj['hash']]['link'] = obj['link'] # stored, not sent to Claude (see select_context_docs)
             chat_docs_link[obj['hash']] = obj['link']
-        
-        self.log_similarity_scores(query_text, score_list, text_list, chat_id)
 
         return chat_docs, chat_docs_link, cache_docs_used
 
+    def get_most_usefull_doc(self, answer: str) -> str:
+        '''
+        Return the hash of the doc cited by Claude in the <most-usefull-doc> tag, empty if none.
+        '''
+        if '<most-usefull-doc>' in answer and '</most-usefull-doc>' in answer:
+            doc_id_pattern = r'<most-usefull-doc>(.*?)<\/most-usefull-doc>'
+            found = findall(doc_id_pattern, answer, DOTALL)
+            if found: return found[0].strip()
+
+        return ''
+
     def get_most_usefull_doc_link(self, answer: str, docs_link: dict) -> str:
+        return docs_link.get(self.get_most_usefull_doc(answer), '')
+
+    def select_context_docs(self, session: conversation_session, turn_docs: dict, max_cited: int = CONTEXT_CITED_DOCS) -> dict:
+        '''
+        Select the docs to send to Claude with the question: the docs retrieved for this turn
+        plus the last ``max_cited`` docs cited by Claude in the previous answers (<most-usefull-doc>), without duplicates.
+
+        The other docs of the chat are not sent again: the previous answers in the history already contain what was used.
+
+        Returns:
+            dict: The selected docs by hash, with only the keys sent to Claude (data, similarity).
+        '''
+        selected = dict(turn_docs)
+        cited = 0
+        for message in reversed(session.conversation.messages):
+            if cited >= max_cited: break
+            if message.role != 'assistant': continue
+
+            doc_hash = self.get_most_usefull_doc(message.content)
+            if doc_hash and doc_hash not in selected and doc_hash in session.docs.data:
+                selected[doc_hash] = session.docs.data[doc_hash]
+                cited += 1
+
+        return {doc_hash: {key: value for key, value in doc.items() if key in ['data', 'similarity']} for doc_hash, doc in selected.items()}
+
+    def exec_rag(self, query_text: str, chat_id: str, custom_system_prompt: str, use_answer_cache: bool = False, details: dict = None):
+        '''
+        Answer ``query_text`` in the chat ``chat_id``, return Claude response.
+
+        Args:
+            use_answer_cache (bool): If True the first question of a chat is answered from the semantic answer cache when
+                a similar question was already answered (see ``cache_db.find_answer``), new first answers are cached.
+                It must be used only with the same ``custom_system_prompt``, the public one.
+            details (dict): If provided, it is filled with: link (most usefull doc link), cache_id and cached (bool).
+        '''
+        if details is None: details = {}
+        if use_answer_cache:
+            cached = self.find_cached_answer(query_text, chat_id)
+            if cached is not None:
+                return self.complete_cached_turn(query_text, chat_id, cached, details)
+
+        similar_docs = self.search_doc(question=query_text, only_3of3=True) # retrieve docs from Vector DB
+        turn = self.prepare_turn(query_text, chat_id, similar_docs)
+
+        route, started = turn['route'], perf_counter()
+        response = self.aws.call_claude_3(system_prompt=self.build_system_prompt(custom_system_prompt, turn), messages=turn['messages'], bedrock_runtime=self.bedrock, model_id=route.model_id, max_tokens=route.max_tokens)
+        self.router.record(turn['log_id'], route, perf_counter() - started, response)
+
+        self.complete_turn(turn, response, use_answer_cache)
+        details.update(link=turn['link'], cache_id=turn['cache_id'], cached=False)
+        return response
+
+    async def aexec_rag(self, query_text: str, chat_id: str, custom_system_prompt: str, use_answer_cache: bool = False, details: dict = None):
+        '''
+        Asyncio version of ``exec_rag``: OpenSearch and Bedrock calls don't block the event loop,
+        the storage work runs in a thread.
+        '''
+        if details is None: details = {}
+        if use_answer_cache:
+            cached = await self.afind_cached_answer(query_text, chat_id)
+            if cached is not None:
+                return await to_thread(self.complete_cached_turn, query_text, chat_id, cached, details)
+
+        similar_docs = await self.asearch_doc(question=query_text, only_3of3=True) # retrieve docs from Vector DB
+        turn = await to_thread(self.prepare_turn, query_text, chat_id, similar_docs)
+
+        route, started = turn['route'], perf_counter()
+        response = await self.aws.acall_claude_3(system_prompt=self.build_system_prompt(custom_system_prompt, turn), messages=turn['messages'], bedrock_runtime=self.bedrock, model_id=route.model_id, max_tokens=route.max_tokens)
+        self.router.record(turn['log_id'], route, perf_counter() - started, response)
+
+        await to_thread(self.complete_turn, turn, response, use_answer_cache)
+        details.update(link=turn['link'], cache_id=turn['cache_id'], cached=False)
+        return response
+
+    async def astream_exec_rag(self, query_text: str, chat_id: str, custom_system_prompt: str, use_answer_cache: bool = False, details: dict = None) -> AsyncIterator[str]:
+        '''
+        Streaming version of ``aexec_rag``: yield Claude response chunks as soon as they are generated.
+
+        The full response is added to the conversation storage when the stream ends,
+        also when the consumer stops early or is cancelled (e.g. client disconnected) the generated part is stored:
+        the Claude stream is closed and the storage runs shielded from the cancellation.
+        A cached answer is yielded as a single chunk.
+        '''
+        if details is None: details = {}
+        if use_answer_cache:
+            cached = await self.afind_cached_answer(query_text, chat_id)
+            if cached is not None:
+                yield await to_thread(self.complete_cached_turn, query_text, chat_id, cached, details)
+                return
+
+        similar_docs = await self.asearch_doc(question=query_text, only_3of3=True) # retrieve docs from Vector DB
+        turn = await to_thread(self.prepare_turn, query_text, chat_id, similar_docs)
+
+        chunks = []
+        route, started, first_chunk_latency = turn['route'], perf_counter(), None
         try:
-            if '<most-usefull-doc>' in answer and '</most-usefull-doc>' in answer:
-                doc_id_pattern = r'<most-usefull-doc>(.*?)<\/most-usefull-doc>'
-                doc = findall(doc_id_pattern, answer, DOTALL)[0].strip()
+            async with aclosing(self.aws.acall_claude_3_stream(system_prompt=self.build_system_prompt(custom_system_prompt, turn), messages=turn['messages'], bedrock_runtime=self.bedrock, model_id=route.model_id, max_tokens=route.max_tokens)) as stream:
+                async for chunk in stream:
+                    if first_chunk_latency is None: first_chunk_latency = perf_counter() - started
+                    chunks.append(chunk)
+                    yield chunk
+        finally:
+            response = ''.join(chunks)
+            if response.strip():
+                self.router.record(turn['log_id'], route, perf_counter() - started, response, first_chunk_latency)
+                # a second cancellation (e.g. server shutdown) must not lose the turn, it's completed in the thread anyway
+                await shield(to_thread(self.complete_turn, turn, response, use_answer_cache))
+                details.update(link=turn['link'], cache_id=turn['cache_id'], cached=False)
+
+    def is_first_turn(self, chat_id: str) -> bool:
+        return len(self.chat_handler.open_session(chat_id).conversation.messages) == 0
+
+    def find_cached_answer(self, query_text: str, chat_id: str) -> dict | None:
+        '''
+        Return the cached answer to a question similar to ``query_text``, only for the first question of a chat.
+        '''
+        if not self.is_first_turn(chat_id):
+            return None
+        return self.cache_handler.find_answer(self.embeddings.embed(query_text))
 
-                return docs_link[doc]
-        except:
-            pass
+    async def afind_cached_answer(self, query_text: str, chat_id: str) -> dict | None:
+        '''
+        Asyncio version of ``find_cached_answer``.
+        '''
+        if not await to_thread(self.is_first_turn, chat_id):
+            return None
+        embedding = await self.embeddings.aembed(query_text)
+        return await to_thread(self.cache_handler.find_answer, embedding)
 
-        return ''
+    def complete_cached_turn(self, query_text: str, chat_id: str, cached: dict, details: dict) -> str:
+        '''
+        Add the question and its cached answer to the conversation storage, return the answer.
+        '''
+        session = self.chat_handler.open_session(chat_id)
+        session.add_message([
+            {'role': 'user', 'content': query_text},
+            {'role': 'assistant', 'content': cached['answer']}
+        ])
+        session.flush()
+
+        details.update(link=cached['link'], cache_id=cached['id'], cached=True)
+        return cached['answer']
+
+    def prepare_turn(self, query_text: str, chat_id: str, similar_docs: list[dict]) -> dict:
+        '''
+        Add the user question and the retrieved docs to a conversation session, then build the messages to send to Claude.
+        Nothing is written until ``complete_turn``, so a failed Claude call leaves the conversation untouched.
 
-    def exec_rag(self, query_text: str, chat_id: str, custom_system_prompt: str):
-        self.chat_handler.get_or_create_chat(chat_id) # create the chat
-        chat_docs, chat_docs_link, _ = self.get_similar_docs(query_text, chat_id) # retrieve docs from Vector DB
+        Returns:
+            dict: The turn state, needed by ``complete_turn``:
+                - chat_id, question
+                - session: the ``conversation_session`` of the chat
+                - messages: the conversation not covered by the digest, the last message contains the docs
+                - digest: the digest of the older messages, empty if the conversation was never condensed
+                - digest_until_seq: first message not covered by the digest
+                - docs_link: link of each doc sent to Claude, by hash
+                - log_id: the id used to log similarity scores and answer
+                - first_turn: whether it is the first question of the chat
+                - route: the model and tokens budget of the answer, see ``model_router``
+        '''
+        session = self.chat_handler.open_session(chat_id) # load the chat once, it's created by the flush
+        chat_docs, chat_docs_link, _ = self.get_similar_docs(query_text, chat_id, similar_docs)
         # print(chat_docs)
         # self.cache_handler.add_new(cache_docs_used)
+        log_id = self.log_similarity_scores(query_text, [obj['_score'] for obj in similar_docs], [doc['data'] for doc in chat_docs.values()], chat_id)
 
-        chat_docs = self.chat_handler.add_docs(chat_id, chat_docs) # add retrieved docs to the conversation storage
+        session.add_docs(chat_docs) # add retrieved docs to the conversation
+        context_docs = self.select_context_docs(session, chat_docs)
+        session.touch_docs(list(context_docs.keys())) # the per chat docs are evicted least recently used first
+        for doc_hash in context_docs:
+            if doc_hash not in chat_docs_link: chat_docs_link[doc_hash] = session.docs.data[doc_hash].get('link', '')
         new_msg = [{ 
                 "role": "user",  # create the new message to send to update the conversation
                 "content": query_text
             }
         ]
 
-        if not self.chat_handler.add_message(chat_id, new_msg): # add new message to the conversation storage
+        if not session.add_message(new_msg): # add new message to the conversation
             raise Exception('Unable to add new msg from User')
         
-        messages = list(self.chat_handler.get_or_create_chat(chat_id)) # ri-retrieve messages
-        messages[-1]['content'] = USER_PROMPT.format(docs=chat_docs, question=query_text) # add all related docs to the last messages; the one that will be sent to Claude
-        
-        response = self.aws.call_claude_3(system_prompt=custom_system_prompt, messages=messages, bedrock_runtime=self.bedrock)
+        messages = session.get_messages()
+        first_turn = len(messages) == 1
+        digest = self.chat_handler.get_digest(chat_id) or {'digest': '', 'until_seq': 0}
+        messages = self.compact_history(messages, digest)
+        messages[-1]['content'] = USER_PROMPT.format(docs=dumps(context_docs, indent=4, ensure_ascii=False), question=query_text) # add the selected docs to the last messages; the one that will be sent to Claude
+
+        return {
+            'chat_id': chat_id,
+            'question': query_text,
+            'session': session,
+            'messages': messages,
+            'docs_link': chat_docs_link,
+            'log_id': log_id,
+            'first_turn': first_turn,
+            'digest': digest['digest'],
+            'digest_until_seq': digest['until_seq'],
+            'route': self.router.route(similar_docs, messages, query_text)
+        }
+
+    def compact_history(self, messages: list[dict], digest: dict) -> list[dict]:
+        '''
+        Drop the messages covered by the conversation digest, they are replaced by the digest in the system prompt.
+
+        The last ``HISTORY_KEEP_TURNS`` turns are never covered by the digest. The messages that exceed the token budget
+        but are not condensed yet are still sent, until the background condense (see ``schedule_condense``) completes.
+        '''
+        if 0 < digest['until_seq'] < len(messages):
+            return messages[digest['until_seq']:]
+        return messages
+
+    def build_system_prompt(self, system_prompt: str, turn: dict) -> str:
+        if turn['digest']:
+            return system_prompt + CONVERSATION_DIGEST_PROMPT.format(digest=turn['digest'])
+        return system_prompt
+
+    def schedule_condense(self, chat_id: str, from_seq: int = 0) -> bool:
+        '''
+        Condense the older messages of the chat in background when the history not covered by the digest exceeds ``HISTORY_TOKEN_BUDGET``.
+
+        Returns:
+            bool: True if the condense was scheduled.
+        '''
+        if self.chat_handler.count_tokens(chat_id, from_seq) <= HISTORY_TOKEN_BUDGET:
+            return False
+
+        with self.condensing_lock:
+            if chat_id in self.condensing: return False
+            self.condensing.add(chat_id)
+        CONDENSE_EXECUTOR.submit(self.condense, chat_id)
+        return True
 
-        self.log_claude_res(response)
-        if not self.chat_handler.add_message(chat_id, [{
-            'role': 'assistant', # add response to the converdation storage
+    def condense(self, chat_id: str):
+        try:
+            self.chat_handler.condense_message(self.aws, chat_id, HISTORY_KEEP_TURNS, bedrock_runtime=self.bedrock)
+        except Exception as e:
+            print(f'rag.condense: {chat_id} not condensed, {e}')
+        finally:
+            with self.condensing_lock: self.condensing.discard(chat_id)
+
+    def complete_turn(self, turn: dict, response: str, use_answer_cache: bool = False):
+        '''
+        Log Claude response, add it to the conversation and flush the turn to the conversation storage in a single transaction.
+        The answer to the first question is also cached.
+
+        ``turn`` is updated with: link (most usefull doc link) and cache_id (empty if not cached).
+        '''
+        self.log_claude_res(response, turn['log_id'])
+        turn['link'] = self.get_most_usefull_doc_link(response, turn['docs_link'])
+        turn['cache_id'] = ''
+        if not turn['session'].add_message([{
+            'role': 'assistant', # add response to the converdation
             'content': response
         }]):
             raise Exception('Unable to add new msg from Assistant')
+        turn['session'].flush()
+        self.schedule_condense(turn['chat_id'], turn['digest_until_seq'])
 
-        # if self.debug_mode: open('log-claude.json', 'a', encoding='utf-8').write(f'\n{"*"*30}\n{dumps(self.chat_handler.get_conversation(chat_id)['docs'], indent=4, ensure_ascii=False)}')
-        return response
+        # only answers pointing to a doc are worth caching, the others are refusals or errors
+        if use_answer_cache and turn['first_turn'] and turn['link']:
+            embedding = self.embeddings.embed(turn['question'])
+            turn['cache_id'] = self.cache_handler.add_answer(turn['question'], embedding, response, turn['link'])
+
+        # if self.debug_mode: open('log-claude.json', 'a', encoding='utf-8').write(f'\n{"*"*30}\n{dumps(self.chat_handler.get_conversation(turn['chat_id'])['docs'], indent=4, ensure_ascii=False)}')
 
-    def public_exec_rag(self, question: str, chat_id: str):
-        return self.exec_rag(question, chat_id, SYS_CLAUDE_ASSISTANT_NIVOLA_NEW)
+    def public_exec_rag(self, question: str, chat_id: str, details: dict = None):
+        return self.exec_rag(question, chat_id, SYS_CLAUDE_ASSISTANT_NIVOLA_NEW, use_answer_cache=True, details=details)
+
+    async def public_aexec_rag(self, question: str, chat_id: str, details: dict = None):
+        return await self.aexec_rag(question, chat_id, SYS_CLAUDE_ASSISTANT_NIVOLA_NEW, use_answer_cache=True, details=details)
+
+    def public_astream_exec_rag(self, question: str, chat_id: str, details: dict = None) -> AsyncIterator[str]:
+        return self.astream_exec_rag(question, chat_id, SYS_CLAUDE_ASSISTANT_NIVOLA_NEW, use_answer_cache=True, details=details)
 
     def public_create_empty_chat(self) -> str:
         chat_id = util.generate_random_string(20)
@@ -306,6 +715,52 @@ class rag:
 
         return chat_id
 
+    async def public_acreate_empty_chat(self) -> str:
+        return await to_thread(self.public_create_empty_chat)
+
+def test_stream_disconnect():
+    '''
+    A client that disconnects while the answer is streamed: the Claude stream is closed and the generated part is stored.
+    '''
+    from asyncio import run, create_task, sleep as asleep, CancelledError
+    from time import sleep
+    from types import SimpleNamespace
+
+    events = []
+    def claude_stream(*args):
+        try:
+            for i in range(100):
+                sleep(0.01)
+                yield f'chunk {i} '
+        finally:
+            events.append('stream closed')
+
+    r = rag.__new__(rag) # no clients, no storage
+    r.aws = aws.__new__(aws)
+    r.aws.call_claude_3_stream = claude_stream
+    r.aws.get_bedrock = lambda: None # rag.bedrock reads aws.bedrock, no STS call
+    r.router = SimpleNamespace(record=lambda *args: None)
+    async def asearch_doc(question, only_3of3): return []
+    r.asearch_doc = asearch_doc
+    r.prepare_turn = lambda query_text, chat_id, similar_docs: {'route': SimpleNamespace(model_id='', max_tokens=100), 'messages': [], 'log_id': None, 'link': '', 'cache_id': ''}
+    r.build_system_prompt = lambda system_prompt, turn: ''
+    r.complete_turn = lambda turn, response, use_answer_cache: events.append(f'turn stored: {response}')
+
+    async def client():
+        async for chunk in r.astream_exec_rag('question', 'chat_id', ''):
+            events.append(f'sent: {chunk}')
+
+    async def disconnect():
+        task = create_task(client())
+        await asleep(0.05)
+        task.cancel() # what StreamingResponse does when the client goes away
+        try: await task
+        except CancelledError: pass
+
+    run(disconnect())
+    print(events)
+    assert 'stream closed' in events and events[-1].startswith('turn stored: chunk 0')
+
 if __name__ == '__main__':
     # lang = input('choose "en" or "it": ').strip()
     r = rag()
@@ -0,0 +1,121 @@
+from dataclasses import dataclass, field
+from statistics import median, quantiles
+from lib_ import util
+from telemetry import TELEMETRY, read_events
+from costant import *
+
+@dataclass
+class RouteDecision:
+    """
+    The model chosen to answer a turn.
+
+    Attributes:
+        tier (str): fast (Haiku) or strong (Sonnet).
+        model_id (str): The Bedrock model id.
+        max_tokens (int): The output tokens budget.
+        reasons (list[str]): Why the turn was not routed to the fast tier, empty if it was.
+        signals (dict): The values the decision was taken on.
+    """
+    tier: str
+    model_id: str
+    max_tokens: int
+    reasons: list[str] = field(default_factory=list)
+    signals: dict = field(default_factory=dict)
+
+class model_router:
+    '''
+    Choose the model of a turn from signals already available before calling Claude:
+    - docs: number of docs retrieved for the question
+    - margin: ``_score`` difference between the best and the second best doc (the best score if only one doc)
+    - history: messages sent before the question (not covered by the conversation digest)
+    - question_tokens: estimated tokens of the question
+
+    A turn is routed to the fast tier when one doc clearly answers a short question in a short conversation,
+    every other turn goes to the strong tier. The thresholds are in costant.py (``ROUTER_*``),
+    decisions and latencies are recorded as ``model_route`` telemetry events to tune them (see ``route_stats``).
+    '''
+    def __init__(self, enabled: bool = ROUTER_ENABLED) -> None:
+        self.enabled = enabled
+
+    def route(self, docs: list[dict], messages: list[dict], question: str) -> RouteDecision:
+        '''
+        Args:
+            docs (list[dict]): The docs returned by ``rag.search_doc``, best first.
+            messages (list[dict]): The messages sent to Claude, the last one is the question.
+            question (str): The user question, without the docs.
+        '''
+        scores = [doc['_score'] for doc in docs]
+        signals = {
+            'docs': len(docs),
+            'margin': round(scores[0] - scores[1] if len(scores) > 1 else (scores[0] if scores else 0.0), 4),
+            'top_score': round(scores[0], 4) if scores else 0.0,
+            'history': len(messages) - 1,
+            'question_tokens': util.estimate_tokens(question)
+        }
+        if not self.enabled:
+            return RouteDecision('strong', ROUTER_STRONG_MODEL_ID, ROUTER_STRONG_MAX_TOKENS, ['disabled'], signals)
+
+        reasons = []
+        if signals['docs'] > ROUTER_FAST_MAX_DOCS: reasons.append('docs')
+        if signals['docs'] > 0 and signals['margin'] < ROUTER_FAST_MIN_MARGIN: reasons.append('margin')
+        if signals['docs'] > 0 and signals['top_score'] < ROUTER_FAST_MIN_TOP_SCORE: reasons.append('top_score')
+        if signals['history'] > ROUTER_FAST_MAX_HISTORY: reasons.append('history')
+        if signals['question_tokens'] > ROUTER_FAST_MAX_QUESTION_TOKENS: reasons.append('question')
+
+        if reasons:
+            return RouteDecision('strong', ROUTER_STRONG_MODEL_ID, ROUTER_STRONG_MAX_TOKENS, reasons, signals)
+        return RouteDecision('fast', ROUTER_FAST_MODEL_ID, ROUTER_FAST_MAX_TOKENS, reasons, signals)
+
+    def record(self, message_id: str, decision: RouteDecision, latency: float, answer: str, first_chunk_latency: float = None):
+        '''
+        Record the decision and the Claude call latency (seconds), joined to the other events of the message by ``message_id``.
+        '''
+        TELEMETRY.emit(
+            'model_route',
+            id=message_id,
+            tier=decision.tier,
+            model_id=decision.model_id,
+            max_tokens=decision.max_tokens,
+            reasons=decision.reasons,
+            signals=decision.signals,
+            latency_ms=round(latency * 1000, 1),
+            first_chunk_ms=round(first_chunk_latency * 1000, 1) if first_chunk_latency is not None else None,
+            answer_tokens=util.estimate_tokens(answer)
+        )
+
+def route_stats(path: str = TELEMETRY_PATH) -> dict:
+    '''
+    Summarize the recorded ``model_route`` events by tier: turns, p50 and p95 latency, answers close to the tokens budget
+    (probably truncated) and, for the strong tier, how many turns each signal excluded from the fast tier.
+    '''
+    tiers: dict[str, dict] = {}
+    for event in read_events(path):
+        if event['type'] != 'model_route': continue
+        tier = tiers.setdefault(event['tier'], {'latencies': [], 'near_budget': 0, 'reasons': {}})
+        tier['latencies'].append(event['latency_ms'])
+        if event['answer_tokens'] >= event['max_tokens'] * 0.95: tier['near_budget'] += 1
+        for reason in event['reasons']:
+            tier['reasons'][reason] = tier['reasons'].get(reason, 0) + 1
+
+    stats = {}
+    for name, tier in tiers.items():
+        latencies = tier['latencies']
+        stats[name] = {
+            'turns': len(latencies),
+            'p50_ms': median(latencies),
+            'p95_ms': quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0],
+            'near_budget': tier['near_budget'],
+            'reasons': tier['reasons']
+        }
+    return stats
+
+def test():
+    router = model_router()
+    one_doc = [{'_score': 0.86}, {'_score': 0.71}]
+    close_docs = [{'_score': 0.80}, {'_score': 0.79}, {'_score': 0.78}]
+    print(router.route(one_doc, [{'role': 'user', 'content': '...'}], 'How do I detach a volume?')) # fast
+    print(router.route(close_docs, [{'role': 'user', 'content': '...'}], 'How do I detach a volume?')) # strong: margin
+    print(router.route(one_doc, [{'role': 'user', 'content': '...'}] * 9, 'How do I detach a volume?')) # strong: history
+
+if __name__ == '__main__':
+    test()
@@ -1,15 +1,77 @@
-from opensearchpy import helpers, RequestError, TransportError, OpenSearch
 from json import load
-from lib_ import aws
+from lib_ import aws, lazy_property
+from retrieval_cache import retrieval_cache
+from query_builder import query_builder
 from json import load
 from requests.exceptions import Timeout
+from threading import Lock
+from time import time
+from asyncio import get_running_loop
 
 from costant import *
+from typing import TYPE_CHECKING
+
+# opensearchpy is imported by the methods that use it (and by aws.get_opensearch), importing this module is cheap
+if TYPE_CHECKING:
+    from opensearchpy import OpenSearch, AsyncOpenSearch
 
 class opensearch_data_handler:
     def __init__(self) -> None:
-        self.client = aws().get_opensearch() 
+        self.aws = aws()
+        self.async_client: 'AsyncOpenSearch' = None # created on first use, it must live in the event loop that uses it
         self.OPENSEARCH_INDEX_NAME = OPENSEARCH_INDEX_NAME
+        self.queries = query_builder()
+        self.templates_ready: bool = None # None until the search templates are registered, False if it failed
+        self.templates_failures = 0
+        self.templates_retry_at = 0.0
+        self.templates_lock = Lock()
+
+    @lazy_property
+    def client(self) -> 'OpenSearch':
+        return self.aws.get_opensearch()
+
+    def use_templates(self, register: bool = True) -> bool:
+        '''
+        Return True if the neural searches can use the stored search templates, they are registered on the first call.
+        A failed registration is retried after ``SEARCH_TEMPLATES_RETRY_SEC`` (doubled on every failure, up to ``SEARCH_TEMPLATES_RETRY_MAX_SEC``),
+        meanwhile the whole queries are sent. Only one thread registers them, the others don't wait.
+
+        Args:
+            register (bool): If False the templates are not registered now (e.g. from the event loop), only their state is returned.
+        '''
+        if not SEARCH_TEMPLATES_ENABLED: return False
+        if register and self.templates_retry_due() and self.templates_lock.acquire(blocking=False):
+            try:
+                self.templates_ready = self.queries.register_templates(self.client)
+                self.templates_failures = 0
+            except Exception as e:
+                self.templates_failures += 1
+                delay = min(SEARCH_TEMPLATES_RETRY_SEC * 2 ** (self.templates_failures - 1), SEARCH_TEMPLATES_RETRY_MAX_SEC)
+                self.templates_retry_at = time() + delay
+                self.templates_ready = False
+                print(f'opensearch_data_handler.use_templates: search templates not registered ({e}), sending the whole queries, retry in {delay} s')
+            finally:
+                self.templates_lock.release()
+        return bool(self.templates_ready)
+
+    def templates_retry_due(self) -> bool:
+        return SEARCH_TEMPLATES_ENABLED and not self.templates_ready and time() >= self.templates_retry_at
+
+    def get_async_client(self) -> 'AsyncOpenSearch':
+        '''
+        Return the handler AsyncOpenSearch client, it is created on the first call.
+        '''
+        if self.async_client is None:
+            self.async_client = self.aws.get_opensearch_async()
+        return self.async_client
+
+    async def aclose(self):
+        '''
+        Close the AsyncOpenSearch client connections, if it was ever created.
+        '''
+        if self.async_client is not None:
+            await self.async_client.close()
+            self.async_client = None
 
     def load_data_from_json(self):
         """Yields data from json file."""
@@ -18,21 +80,28 @@ class opensearch_data_handler:
             data = load(f)
             print("Data is being ingested...")
             for x, recipe in enumerate(data):
-                recipe['category_en'] = recipe['category_en'].replace('_', ' ')
-                if recipe['text_en'] == '':
-                    recipe['text_en'] = recipe['category_en'] 
-                if recipe['text'] == '':
-                    recipe['text'] = recipe['category'] 
-                yield {"_index": OPENSEARCH_INDEX_NAME, '_id': x, "_source": recipe}            
+                yield {"_index": OPENSEARCH_INDEX_NAME, '_id': x, "_source": self.prepare_record(recipe)}            
+
+    @staticmethod
+    def prepare_record(recipe: dict) -> dict:
+        """Clean a db.json record before indexing it, empty texts are replaced by the category."""
+        recipe['category_en'] = recipe['category_en'].replace('_', ' ')
+        if recipe['text_en'] == '':
+            recipe['text_en'] = recipe['category_en'] 
+        if recipe['text'] == '':
+            recipe['text'] = recipe['category'] 
+        return recipe
 
     def load_data(self):
         """Send multiple data to an OpenSearch client."""
 
         data = self.load_data_from_json()
         print(f"Ingesting {OPENSEARCH_INDEX_NAME} data")
+        from opensearchpy import helpers
         response = helpers.bulk(self.client, data, request_timeout=300)
         
         print(f"Data sent to your OpenSearch.")
+        retrieval_cache().invalidate() # cached search results are outdated, in every worker
         return True
 
     def empty_index(self):
@@ -45,20 +114,22 @@ class opensearch_data_handler:
         # Perform the delete by query request
         response = self.client.delete_by_query(index=OPENSEARCH_INDEX_NAME, body=query_body)
 
+        retrieval_cache().invalidate()
+
         # Check the response
         if len(response["failures"]) > 0:
             return False
 
         return True
 
-    def neural_search(self, client: OpenSearch, index_name: str = '', query_body: str = ''):
+    def neural_search(self, client: 'OpenSearch', index_name: str = '', query_body: dict | str = ''):
         """
         Perform a neural search query on the specified OpenSearch index.
 
         Args:
             client (OpenSearch): The OpenSearch client object used to perform the search.
             index_name (str): The name of the index to search. Defaults to the configured NIVOLA_TEXT_INDEX if not provided.
-            query_body (str): The query body in JSON format for the search request.
+            query_body (dict | str): The query body for the search request, see ``query_builder``.
 
         Returns:
             dict: The response from the search query.
@@ -71,8 +142,9 @@ class opensearch_data_handler:
             for x_content_parse_exception errors.
         """
         if index_name == '': index_name = self.OPENSEARCH_INDEX_NAME
+        from opensearchpy import RequestError, TransportError
         try:
-            response = client.search(index=index_name, body=query_body)
+            response = client.search(index=index_name, body=query_body, request_timeout=SEARCH_TIMEOUT_SEC)
         # TODO try to test error handling
         except RequestError as e:
             if e.error == "x_content_parse_exception":
@@ -86,6 +158,188 @@ class opensearch_data_handler:
 
         return response
 
+    def template_search(self, client: 'OpenSearch', template_request: dict, index_name: str = ''):
+        """
+        Perform a search with a stored search template, see ``query_builder.template_request``.
+        Same return value and error handling of ``neural_search``.
+        """
+        if index_name == '': index_name = self.OPENSEARCH_INDEX_NAME
+        from opensearchpy import RequestError, TransportError
+        try:
+            response = client.search_template(index=index_name, body=template_request, request_timeout=SEARCH_TIMEOUT_SEC)
+        except RequestError as e:
+            if e.error == "x_content_parse_exception":
+                raise Exception(f"Error: {e.info['error']['root_cause'][0]['reason']}")
+            else:
+                raise Exception(f"RequestError: {e.info}")
+        except TransportError as e:
+            raise Exception(f"HTTP Error: {e.status_code}, {e.error}")
+        except Timeout:
+            raise Exception("Timeout error occurred while making the request.")
+
+        return response
+
+    def multi_search(self, client: 'OpenSearch', query_bodies: list[dict], index_name: str = '', template: bool = False) -> list[dict | None]:
+        """
+        Perform multiple search queries on the specified OpenSearch index with a single ``_msearch`` request.
+
+        Args:
+            client (OpenSearch): The OpenSearch client object used to perform the search.
+            query_bodies (list[dict]): The query bodies, one for each search.
+            index_name (str): The name of the index to search. Defaults to the configured OPENSEARCH_INDEX_NAME if not provided.
+            template (bool): Whether ``query_bodies`` are search template requests (``_msearch/template``).
+
+        Returns:
+            list[dict | None]: The response of each search, in the same order of ``query_bodies``.
+                A search that failed on the cluster is returned as None, the others are still usable.
+
+        Notes:
+            The whole request fails (and raise an Exception) only when the cluster can't be reached or the request is malformed,
+            error handling is the same of ``neural_search``.
+        """
+        body = self.build_multi_search_body(query_bodies, index_name)
+        from opensearchpy import RequestError, TransportError
+        try:
+            if template: response = client.msearch_template(body=body, request_timeout=SEARCH_TIMEOUT_SEC)
+            else: response = client.msearch(body=body, request_timeout=SEARCH_TIMEOUT_SEC)
+        except RequestError as e:
+            if e.error == "x_content_parse_exception":
+                raise Exception(f"Error: {e.info['error']['root_cause'][0]['reason']}")
+            else:
+                raise Exception(f"RequestError: {e.info}")
+        except TransportError as e:
+            raise Exception(f"HTTP Error: {e.status_code}, {e.error}")
+        except Timeout:
+            raise Exception("Timeout error occurred while making the request.")
+
+        return self.unpack_multi_search(response)
+
+    async def amulti_search(self, query_bodies: list[dict], index_name: str = '', template: bool = False) -> list[dict | None]:
+        """
+        Asyncio version of ``multi_search``, it uses the handler AsyncOpenSearch client (see ``get_async_client``).
+        """
+        body = self.build_multi_search_body(query_bodies, index_name)
+        from opensearchpy import RequestError, TransportError
+        try:
+            if template: response = await self.get_async_client().msearch_template(body=body, request_timeout=SEARCH_TIMEOUT_SEC)
+            else: response = await self.get_async_client().msearch(body=body, request_timeout=SEARCH_TIMEOUT_SEC)
+        except RequestError as e:
+            if e.error == "x_content_parse_exception":
+                raise Exception(f"Error: {e.info['error']['root_cause'][0]['reason']}")
+            else:
+                raise Exception(f"RequestError: {e.info}")
+        except TransportError as e:
+            raise Exception(f"HTTP Error: {e.status_code}, {e.error}")
+
+        return self.unpack_multi_search(response)
+
+    def build_multi_search_body(self, query_bodies: list[dict], index_name: str = '') -> list[dict]:
+        """
+        Interleave a header, with the target index, before each query body, as required by ``_msearch``.
+        """
+        if index_name == '': index_name = self.OPENSEARCH_INDEX_NAME
+        body = []
+        for query_body in query_bodies:
+            body.append({'index': index_name})
+            body.append(query_body)
+        return body
+
+    def unpack_multi_search(self, response: dict) -> list[dict | None]:
+        """
+        Split an ``_msearch`` response in the response of each search, the failed ones are replaced by None.
+        """
+        responses = []
+        for res in response['responses']:
+            if 'error' in res:
+                print(f"multi_search: a search failed, {res['error']}")
+                responses.append(None)
+            else:
+                responses.append(res)
+        return responses
+
+    def build_neural_queries(self, questions: list[str], k: int, fields: list[str], template: bool = False) -> list[dict]:
+        """
+        Build a ``neural`` query body for each kNN field in ``fields``, with the question of the same position in ``questions``;
+        the cluster embeds the question once per query. With ``template`` the search template requests are built instead.
+        """
+        if template:
+            return [self.queries.template_request('neural', field, question, k) for field, question in zip(fields, questions)]
+        return [self.queries.build('neural', field, question, k) for field, question in zip(fields, questions)]
+
+    def build_knn_queries(self, vectors: list[list[float]], k: int, fields: list[str]) -> list[dict]:
+        """
+        Build a plain ``knn`` query body for each kNN field in ``fields``, with the vector of the same position in ``vectors``;
+        no model inference is needed on the cluster.
+        """
+        return [self.queries.build('knn', field, vector, k) for field, vector in zip(fields, vectors)]
+
+    def multi_search_by_fields(self, question: str | list[str], k: int = 9, fields: list[str] = SEARCH_FIELDS) -> list[dict | None]:
+        '''
+        Retrieve the top ``K`` documents semantically similar to ``question`` for each kNN field in ``fields``,
+        all the searches are sent to the cluster in a single ``_msearch`` request.
+
+        ``question`` can be a list with a question for each field (e.g. translated for the fields in another language).
+
+        Return:
+            A list with a collection of documents for each field, in the same order of ``fields``; None if that search failed
+        '''
+        questions = [question] * len(fields) if isinstance(question, str) else question
+        template = self.use_templates()
+        return self.multi_search(client=self.client, query_bodies=self.build_neural_queries(questions, k, fields, template), template=template)
+
+    def multi_search_by_vector(self, vector: list[float], k: int = 9, fields: list[str] = SEARCH_FIELDS) -> list[dict | None]:
+        '''
+        Retrieve the top ``K`` documents nearest to ``vector`` for each kNN field in ``fields``,
+        all the searches are sent to the cluster in a single ``_msearch`` request.
+
+        Unlike ``multi_search_by_fields`` the cluster doesn't run the embedding model, ``vector`` must be computed
+        with the same model of the index (see embedding.py).
+
+        Return:
+            A list with a collection of documents for each field, in the same order of ``fields``; None if that search failed
+        '''
+        return self.multi_search_by_vectors(vectors=[vector] * len(fields), k=k, fields=fields)
+
+    def multi_search_by_vectors(self, vectors: list[list[float]], k: int = 9, fields: list[str] = SEARCH_FIELDS) -> list[dict | None]:
+        '''
+        Same of ``multi_search_by_vector``, each field is searched with the vector of the same position in ``vectors``.
+        '''
+        return self.multi_search(client=self.client, query_bodies=self.build_knn_queries(vectors, k, fields))
+
+    async def amulti_search_by_fields(self, question: str | list[str], k: int = 9, fields: list[str] = SEARCH_FIELDS) -> list[dict | None]:
+        '''
+        Asyncio version of ``multi_search_by_fields``.
+        '''
+        questions = [question] * len(fields) if isinstance(question, str) else question
+        # registered at startup (public_api lifespan), a failed registration is retried in a thread: this search sends the whole queries
+        if self.templates_retry_due(): get_running_loop().run_in_executor(None, self.use_templates)
+        template = self.use_templates(register=False)
+        return await self.amulti_search(query_bodies=self.build_neural_queries(questions, k, fields, template), template=template)
+
+    async def amulti_search_by_vector(self, vector: list[float], k: int = 9, fields: list[str] = SEARCH_FIELDS) -> list[dict | None]:
+        '''
+        Asyncio version of ``multi_search_by_vector``.
+        '''
+        return await self.amulti_search_by_vectors(vectors=[vector] * len(fields), k=k, fields=fields)
+
+    async def amulti_search_by_vectors(self, vectors: list[list[float]], k: int = 9, fields: list[str] = SEARCH_FIELDS) -> list[dict | None]:
+        '''
+        Asyncio version of ``multi_search_by_vectors``.
+        '''
+        return await self.amulti_search(query_bodies=self.build_knn_queries(vectors, k, fields))
+
+    def search_by_field(self, field: str, question: str, k: int = 9):
+        '''
+        Retrieve the top ``K`` documents semantically similar to ``question`` based on the kNN ``field``,
+        with the stored search template if available (see ``use_templates``).
+
+        Return:
+            A collection of documents
+        '''
+        if self.use_templates():
+            return self.template_search(client=self.client, template_request=self.queries.template_request('neural', field, question, k))
+        return self.neural_search(client=self.client, query_body=self.queries.build('neural', field, question, k))
+
     def search_by_text_en(self, question: str, k: int = 9):
         '''
         Retrieve the top ``K`` documents semantically similar to ``question`` based on ``text_en`` field in a kNN index.
@@ -93,21 +347,7 @@ class opensearch_data_handler:
         Return:
             A collection of documents
         '''
-        query_body = \
-        '''{
-            "_source": { "exclude": [ "category_en_embedding", "text_en_embedding", "text_it_embedding"] },
-            "query": {
-                "neural": {
-                "text_en_embedding": {
-                    "query_text": "'''+question+'''",
-                    "model_id": "mXgYKo8BlLTTsnWvtjbF",
-                    "k":'''+str(k)+'''
-                }
-                }
-            }
-            }
-        '''
-        return self.neural_search(client=self.client, query_body=query_body)
+        return self.search_by_field('text_en_embedding', question, k)
 
     def search_by_text_it(self, question: str, k: int = 9):
         '''
@@ -116,21 +356,7 @@ class opensearch_data_handler:
         Return:
             A collection of documents
         '''
-        query_body = \
-        '''{
-            "_source": { "exclude": [ "category_en_embedding", "text_en_embedding", "text_it_embedding"] },
-            "query": {
-                "neural": {
-                "text_it_embedding": {
-                    "query_text": "'''+question+'''",
-                    "model_id": "mXgYKo8BlLTTsnWvtjbF",
-                    "k":'''+str(k)+'''
-                }
-                }
-            }
-            }
-        '''
-        return self.neural_search(client=self.client, query_body=query_body)
+        return self.search_by_field('text_it_embedding', question, k)
 
     def search_by_category_en(self, question: str, k: int = 9):
         '''
@@ -139,21 +365,7 @@ class opensearch_data_handler:
         Return:
             A collection of documents
         '''
-        query_body = \
-        '''{
-            "_source": { "exclude": [ "category_en_embedding", "text_en_embedding", "text_it_embedding"] },
-            "query": {
-                "neural": {
-                "category_en_embedding": {
-                    "query_text": "'''+question+'''",
-                    "model_id": "mXgYKo8BlLTTsnWvtjbF",
-                    "k":'''+str(k)+'''
-                }
-                }
-            }
-            }
-        '''
-        return self.neural_search(client=self.client, query_body=query_body)
+        return self.search_by_field('category_en_embedding', question, k)
 
 def test():
     h = opensearch_data_handler()
@@ -162,6 +374,45 @@ def test():
     # h.load_data()
     res = h.search_by_text_en('Ei yo wassup man', 9); print(res)
 
+def test_async_templates():
+    '''
+    The async searches use the templates registered at startup: ``_msearch/template`` is sent, not ``_msearch``.
+    '''
+    from asyncio import run
+
+    class fake_client:
+        def __init__(self): self.calls = []
+        def put_script(self, **kwargs): self.calls.append('put_script')
+        async def msearch(self, body, **kwargs):
+            self.calls.append('msearch'); return {'responses': [{} for _ in body[::2]]}
+        async def msearch_template(self, body, **kwargs):
+            self.calls.append('msearch_template'); return {'responses': [{} for _ in body[::2]]}
+
+    h = opensearch_data_handler()
+    h.__dict__['client'] = h.async_client = fake_client() # lazy_property reads the instance __dict__ first
+    h.use_templates() # what the lifespan does
+    run(h.amulti_search_by_fields('How do I detach a volume?', 9))
+    print(h.client.calls)
+    assert h.client.calls == ['put_script', 'msearch_template'] or not SEARCH_TEMPLATES_ENABLED
+
+def test_templates_retry():
+    '''
+    A failed templates registration disables them only until the retry: the next due call registers them.
+    '''
+    class flaky_client:
+        def __init__(self): self.failures = 1
+        def put_script(self, **kwargs):
+            if self.failures:
+                self.failures -= 1
+                raise Exception('cluster not ready')
+
+    h = opensearch_data_handler()
+    h.__dict__['client'] = flaky_client()
+    print(h.use_templates(), h.use_templates()) # failed, retry not due yet
+    h.templates_retry_at = 0 # the retry wait is over
+    print(h.use_templates())
+    assert h.use_templates() or not SEARCH_TEMPLATES_ENABLED
+
 if __name__ == '__main__':
     pass
 
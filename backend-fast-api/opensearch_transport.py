@@ -0,0 +1,90 @@
+from random import uniform
+from time import sleep
+from asyncio import sleep as asleep
+from opensearchpy import Transport, AsyncTransport, TransportError, ConnectionError, ConnectionTimeout
+from costant import *
+
+def backoff(attempt: int, base: float, cap: float) -> float:
+    '''
+    Full jitter exponential backoff: a random wait in [0, min(cap, base * 2^attempt)],
+    so the clients that failed together don't retry together.
+    '''
+    return uniform(0, min(cap, base * 2 ** attempt))
+
+def is_retryable(e: TransportError, retry_on_timeout: bool, retry_on_status: list[int]) -> bool:
+    '''
+    Same rules of the opensearch-py transport: connection errors, timeouts only if ``retry_on_timeout``, the statuses in ``retry_on_status``.
+    '''
+    if isinstance(e, ConnectionTimeout): return retry_on_timeout
+    if isinstance(e, ConnectionError): return True
+    return e.status_code in retry_on_status
+
+class retry_transport(Transport):
+    '''
+    opensearch-py Transport that waits a jittered backoff between the retries (the default one retries immediately).
+    The retries are done here, the base transport is created with max_retries=0.
+    '''
+    def __init__(self, hosts, *args, max_retries: int = 3, retry_on_timeout: bool = False, retry_on_status=(502, 503, 504),
+                 backoff_base: float = 0.1, backoff_max: float = 2.0, **kwargs) -> None:
+        super().__init__(hosts, *args, max_retries=0, retry_on_timeout=retry_on_timeout, retry_on_status=retry_on_status, **kwargs)
+        self.retries = max_retries
+        self.retry_on_timeout_ = retry_on_timeout
+        self.retry_on_status_ = list(retry_on_status)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def perform_request(self, *args, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                return super().perform_request(*args, **kwargs)
+            except TransportError as e:
+                if attempt == self.retries or not is_retryable(e, self.retry_on_timeout_, self.retry_on_status_): raise
+                sleep(backoff(attempt, self.backoff_base, self.backoff_max))
+
+class async_retry_transport(AsyncTransport):
+    '''
+    Asyncio version of ``retry_transport``, the backoff doesn't block the event loop.
+    '''
+    def __init__(self, hosts, *args, max_retries: int = 3, retry_on_timeout: bool = False, retry_on_status=(502, 503, 504),
+                 backoff_base: float = 0.1, backoff_max: float = 2.0, **kwargs) -> None:
+        super().__init__(hosts, *args, max_retries=0, retry_on_timeout=retry_on_timeout, retry_on_status=retry_on_status, **kwargs)
+        self.retries = max_retries
+        self.retry_on_timeout_ = retry_on_timeout
+        self.retry_on_status_ = list(retry_on_status)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    async def perform_request(self, *args, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                return await super().perform_request(*args, **kwargs)
+            except TransportError as e:
+                if attempt == self.retries or not is_retryable(e, self.retry_on_timeout_, self.retry_on_status_): raise
+                await asleep(backoff(attempt, self.backoff_base, self.backoff_max))
+
+def client_options(settings: dict, use_async: bool = False) -> dict:
+    '''
+    Return the OpenSearch (or AsyncOpenSearch) constructor arguments: connection from settings.json,
+    transport from ``OPENSEARCH_TRANSPORT_PROFILE`` with the keys of the optional "opensearch_transport" object of settings.json.
+    '''
+    profile = {**OPENSEARCH_TRANSPORT_PROFILE, **settings.get('opensearch_transport', {})}
+    options = {
+        'hosts': [settings['opensearch_url']],
+        'http_auth': (settings['username_opensearch'], settings['password_opensearch']),
+        'verify_certs': False,
+        'transport_class': async_retry_transport if use_async else retry_transport,
+        'http_compress': profile['http_compress'],
+        'timeout': profile['timeout'],
+        'max_retries': profile['max_retries'],
+        'retry_on_timeout': profile['retry_on_timeout'],
+        'retry_on_status': profile['retry_on_status'],
+        'backoff_base': profile['backoff_base'],
+        'backoff_max': profile['backoff_max'],
+        'sniff_on_start': profile['sniff_on_start'],
+        'sniff_on_connection_fail': profile['sniff_on_connection_fail'],
+        'sniffer_timeout': profile['sniffer_timeout']
+    }
+    # urllib3 and aiohttp connections name the pool size differently
+    if use_async: options['maxsize'] = profile['pool_size']
+    else: options['pool_maxsize'] = profile['pool_size']
+    return options
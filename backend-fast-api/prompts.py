@@ -163,6 +163,29 @@ Write the question in the json field:
 
 """
 
+CONDENSE_SYS_PROMPT = \
+"""You condense conversations between a user and a technical support assistant.
+I'll pass you the summary of the earlier part of the conversation, inside the tag <summary></summary> (it might be empty),
+and the following messages, inside the tag <messages></messages>.
+
+Write a new summary of the whole conversation that keeps:
+- the user's goal and context (services, resources, errors, constraints)
+- the questions asked and the key facts of each answer, with the links cited
+- anything the user said they already tried
+
+Write only the summary, without preamble, in the language of the conversation.
+"""
+
+CONDENSE_USER_PROMPT = \
+'''<summary>{digest}</summary>
+<messages>{messages}</messages>'''
+
+CONVERSATION_DIGEST_PROMPT = \
+'''
+
+The earlier part of this conversation was condensed in the following summary, only the last messages are sent verbatim:
+<conversation-summary>{digest}</conversation-summary>'''
+
 EVALUATE_PROMPT_GEN_Q_NORMAL = '''<doc category={cat}>{doc}</doc>'''
 
 
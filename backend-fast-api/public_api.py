@@ -1,9 +1,48 @@
 from main import rag
-from fastapi import FastAPI
+from lib_ import BEDROCK_LIMITER
+from rate_limiter import RateLimitExceeded
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse, JSONResponse
 from re import findall, DOTALL, sub, search
+from asyncio import to_thread
+from contextlib import asynccontextmanager
+from threading import Lock
+from json import dumps
+from costant import CONVERSATION_PAGE_SIZE, CONVERSATION_PAGE_MAX_SIZE
 
-app = FastAPI()
-RAG = rag(False, 'en')
+RAG: rag = None
+RAG_LOCK = Lock()
+
+def get_rag() -> rag:
+    '''
+    Return the rag instance of the process, it is created by ``lifespan`` in a thread before serving (importing this module stays cheap).
+    Blocking: call it from the event loop only once the app started, e.g. from the endpoints.
+    '''
+    global RAG
+    if RAG is None:
+        with RAG_LOCK:
+            if RAG is None: RAG = rag(False, 'en')
+    return RAG
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # rag, its OpenSearch client and its SQLite databases are built off the event loop, then the search templates are registered:
+    # the async searches only read their state, never block the event loop on it
+    rag_ = await to_thread(get_rag)
+    await to_thread(rag_.open_storage)
+    await to_thread(rag_.opensearch.use_templates)
+    yield
+    if RAG is not None and 'opensearch' in RAG.__dict__:
+        await RAG.opensearch.aclose() # the async client is bound to this event loop
+
+app = FastAPI(lifespan=lifespan)
+
+@app.exception_handler(RateLimitExceeded)
+async def rate_limit_exceeded(request: Request, e: RateLimitExceeded) -> JSONResponse:
+    '''
+    Too many Claude calls waiting: answer immediately, the client can retry after ``Retry-After`` seconds.
+    '''
+    return JSONResponse(status_code=429, content={'answer': 'Too many requests, retry later'}, headers={'Retry-After': e.retry_after_header})
 
 def deep_space_clean(text: str):
     for _ in range(3): text = sub(r'\s+', ' ', text)
@@ -27,30 +66,113 @@ def no_xml_tags(text: str) -> bool:
     # Return True if no tags are found, False otherwise
     return match is None
 
+class final_answer_stream_parser:
+    '''
+    Incremental version of ``extract_final_answer``: feed Claude response chunks as they arrive,
+    get back the part of the <final-answer> tag content that can already be forwarded to the user.
+
+    Tags split across chunks are handled by holding back the text that could be the beginning of a tag.
+    '''
+    OPEN_TAG = '<final-answer>'
+    CLOSE_TAG = '</final-answer>'
+
+    def __init__(self) -> None:
+        self.state = 'before' # before, inside or after the <final-answer> tag
+        self.buffer = '' # text received but not forwarded yet
+        self.chunks = [] # the whole response
+        self.forwarded = False
+
+    def feed(self, chunk: str) -> str:
+        '''
+        Add a chunk of the response, return the text to forward (it can be empty).
+        '''
+        self.chunks.append(chunk)
+        if self.state == 'after':
+            return ''
+
+        self.buffer += chunk
+        if self.state == 'before':
+            index = self.buffer.find(self.OPEN_TAG)
+            if index == -1:
+                # only the tail can still be the beginning of the tag
+                self.buffer = self.buffer[-(len(self.OPEN_TAG) - 1):]
+                return ''
+            self.buffer = self.buffer[index + len(self.OPEN_TAG):]
+            self.state = 'inside'
+
+        index = self.buffer.find(self.CLOSE_TAG)
+        if index != -1:
+            text = self.buffer[:index].rstrip()
+            self.buffer = ''
+            self.state = 'after'
+        else:
+            hold = self.partial_tag_len(self.buffer, self.CLOSE_TAG)
+            text = self.buffer[:len(self.buffer) - hold]
+            # trailing spaces are held back too, the final answer is stripped
+            stripped = text.rstrip()
+            self.buffer = text[len(stripped):] + self.buffer[len(self.buffer) - hold:]
+            text = stripped
+
+        if not self.forwarded:
+            text = text.lstrip()
+        if text:
+            self.forwarded = True
+        return text
+
+    def finish(self) -> str:
+        '''
+        Call it when the response is complete, return the last text to forward (it can be empty).
+
+        Like ``extract_final_answer`` a response without any xml tag is forwarded as is.
+        '''
+        if self.state == 'before':
+            answer = ''.join(self.chunks)
+            return answer if no_xml_tags(answer) else ''
+        if self.state == 'inside':
+            # closing tag never arrived, forward what is left
+            self.state = 'after'
+            return self.buffer.strip()
+        return ''
+
+    def get_response(self) -> str:
+        return ''.join(self.chunks)
+
+    @staticmethod
+    def partial_tag_len(text: str, tag: str) -> int:
+        '''
+        Length of the longest suffix of ``text`` that is a prefix of ``tag``.
+        '''
+        for length in range(min(len(text), len(tag) - 1), 0, -1):
+            if tag.startswith(text[-length:]):
+                return length
+        return 0
+
+def sse_event(event: str, data: dict) -> str:
+    '''
+    Format a Server-Sent Event
+    '''
+    return f'event: {event}\ndata: {dumps(data, ensure_ascii=False)}\n\n'
+
 @app.get("/")
-def read_root():
+async def read_root():
     return 'Alo'
 
 @app.get("/new_chat")
-def new_chat() -> dict:
+async def new_chat() -> dict:
     '''
     Create a new chat, return the chat_id
 
     chat_id can be utilized in /send_message
     '''
     res = {
-        'answer': RAG.public_create_empty_chat()
+        'answer': await get_rag().public_acreate_empty_chat()
     }
     return res
 
-@app.post("/send_message")
-def send_message(question: str, chat_id: str) -> dict:
+def extract_final_answer(answer: str, chat_id: str) -> dict:
     '''
-    Ask question about Nivola
+    Extract the text to show to the user from Claude ``answer``, it is the content of <final-answer> tag
     '''
-    answer = RAG.public_exec_rag(question, chat_id)
-    print(answer)
-    question = deep_space_clean(question)
     res = {
         'answer': 'Generic Error'
     }
@@ -80,17 +202,116 @@ def send_message(question: str, chat_id: str) -> dict:
     
     return res
 
+@app.post("/send_message")
+async def send_message(question: str, chat_id: str) -> dict:
+    '''
+    Ask question about Nivola
+
+    When the service is already overloaded the request is rejected with HTTP 429 before any work.
+    '''
+    BEDROCK_LIMITER.check()
+    details = {}
+    answer = await get_rag().public_aexec_rag(question, chat_id, details)
+    print(answer)
+    question = deep_space_clean(question)
+    res = extract_final_answer(answer, chat_id)
+    res['link'] = details.get('link', '')
+    res['cache_id'] = details.get('cache_id', '') # use it to vote the answer, see /vote_answer
+    return res
+
+@app.post("/send_message/stream")
+async def send_message_stream(question: str, chat_id: str) -> StreamingResponse:
+    '''
+    Ask question about Nivola, the answer is streamed as Server-Sent Events:
+    - token: {"text": "..."} a piece of the answer, as soon as it is generated
+    - done: {"answer": "...", "link": "...", "cache_id": "..."} the whole answer, the response is complete
+    - error: {"answer": "..."} something went wrong, with "retry_after" (seconds) if the service is overloaded
+
+    When the service is already overloaded the request is rejected with HTTP 429 before the stream starts.
+    '''
+    BEDROCK_LIMITER.check()
+
+    async def events():
+        parser = final_answer_stream_parser()
+        details = {}
+        try:
+            async for chunk in get_rag().public_astream_exec_rag(question, chat_id, details):
+                text = parser.feed(chunk)
+                if text: yield sse_event('token', {'text': text})
+
+            text = parser.finish()
+            if text: yield sse_event('token', {'text': text})
+            res = extract_final_answer(parser.get_response(), chat_id)
+            res['link'] = details.get('link', '')
+            res['cache_id'] = details.get('cache_id', '')
+            yield sse_event('done', res)
+        except RateLimitExceeded as e:
+            print(f'send_message_stream: {chat_id=} {e}')
+            yield sse_event('error', {'answer': 'Too many requests, retry later', 'retry_after': int(e.retry_after_header)})
+        except Exception as e:
+            print(f'send_message_stream: {chat_id=} {e}')
+            yield sse_event('error', {'answer': 'Generic Error'})
+
+    return StreamingResponse(events(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.post('/vote_answer')
+async def vote_answer(cache_id: str, positive: bool) -> dict:
+    '''
+    Vote an answer, cache_id is returned by /send_message
+
+    answers with more negative than positive votes are not reused anymore
+    '''
+    return {
+        'answer': await to_thread(get_rag().cache_handler.vote_answer, cache_id, positive)
+    }
+
+@app.get('/get_answer_cache_stats')
+async def get_answer_cache_stats() -> dict:
+    '''
+    return answer cache hits, misses, votes and size
+    '''
+    return await to_thread(get_rag().cache_handler.get_answer_stats)
+
+@app.get('/get_retrieval_cache_stats')
+async def get_retrieval_cache_stats() -> dict:
+    '''
+    return search results cache hits and misses of this worker
+    '''
+    return get_rag().retrieval_cache.get_stats()
+
+@app.get('/get_rate_limiter_stats')
+async def get_rate_limiter_stats() -> dict:
+    '''
+    return Claude calls admitted, rejected (HTTP 429) and waited, wait times and queue depth of this worker
+    '''
+    return BEDROCK_LIMITER.get_stats()
+
 @app.get('/get_all_conversation')
-def get_all_conversation() -> str:
+async def get_all_conversation(limit: int = None, after: str = None, summary: bool = False, stream: bool = False):
     '''
-    return all conversation from the db
+    return all conversation from the db, as before: {chat_id: conversation}
+
+    with limit, after or summary the conversations are returned ordered by id, one page at a time (limit defaults to CONVERSATION_PAGE_SIZE):
+    pass the returned next_after as after to get the next page (next_after is null on the last page)
+
+    summary: return only id, message_count and last_activity of each conversation
+    stream: return every conversation from after to the end as NDJSON (one conversation per line), limit is ignored
     '''
-    return RAG.chat_handler.get_all_conversation()
+    if stream:
+        rows = get_rag().chat_handler.iter_conversations(after=after, summary=summary)
+        return StreamingResponse((dumps(row, ensure_ascii=False) + '\n' for row in rows), media_type='application/x-ndjson')
+
+    if limit is None and after is None and not summary:
+        return await to_thread(get_rag().chat_handler.get_all_conversation)
+
+    if limit is None: limit = CONVERSATION_PAGE_SIZE
+    if limit < 1 or limit > CONVERSATION_PAGE_MAX_SIZE:
+        raise HTTPException(status_code=422, detail=f'limit MUST be between 1 and {CONVERSATION_PAGE_MAX_SIZE}')
+    return await to_thread(get_rag().chat_handler.get_conversation_page, limit, after, summary)
 
 @app.get('/get_conversation')
-def get_conversation(chat_id: str):
+async def get_conversation(chat_id: str):
     '''
     return one conversation with id: chat_id
     '''
-    return RAG.chat_handler.get_conversation(chat_id)
-
+    return await to_thread(get_rag().chat_handler.get_conversation, chat_id)
@@ -0,0 +1,78 @@
+from json import dumps
+from costant import *
+
+# the value searched by each query kind and its key in the query clause, see query_builder.build
+QUERY_KINDS = {
+    'neural': 'query_text',
+    'knn': 'vector'
+}
+SOURCE_EXCLUDE = ['category_en_embedding', 'text_en_embedding', 'text_it_embedding'] # embeddings are never returned
+
+class query_builder:
+    '''
+    Build the OpenSearch query bodies (dicts, never strings) of the field searches, and the equivalent server side search templates.
+
+    Every body is ``{"_source": ..., "query": {<kind>: {<field>: {<value key>: value, "k": k, ...}}}}``:
+    - neural: the cluster embeds ``query_text`` with ``model_id``
+    - knn: ``vector`` is already embedded
+    ``filter`` (an OpenSearch query clause, e.g. a term on category_en) is added to every clause if set.
+
+    The search templates are rendered from the same bodies, so a change here changes both:
+    after ``register_templates`` a search sends only the template id and the params (see ``template_request``).
+    '''
+    def __init__(self, model_id: str = OPENSEARCH_MODEL_ID, filter: dict = None, index_name: str = OPENSEARCH_INDEX_NAME) -> None:
+        self.model_id = model_id
+        self.filter = filter
+        self.index_name = index_name
+
+    def build(self, kind: str, field: str, value, k: int) -> dict:
+        '''
+        Args:
+            kind (str): A key of ``QUERY_KINDS``.
+            field (str): The kNN field to search, one of ``SEARCH_FIELDS``.
+            value: The question (neural) or the vector (knn).
+            k (int): Number of nearest neighbours.
+        '''
+        if kind not in QUERY_KINDS: raise Exception(f'query_builder.build: invalid kind, supported kinds: {", ".join(QUERY_KINDS)}')
+        clause = {QUERY_KINDS[kind]: value, 'k': k}
+        if kind == 'neural': clause['model_id'] = self.model_id
+        if self.filter is not None: clause['filter'] = self.filter
+        return {
+            '_source': {'exclude': SOURCE_EXCLUDE},
+            'query': {kind: {field: clause}}
+        }
+
+    def template_id(self, kind: str) -> str:
+        return f'{self.index_name}-{kind}-search'
+
+    def template_source(self, kind: str) -> str:
+        '''
+        Return the mustache source of the ``kind`` search template, params: field, value, k.
+        The value is rendered with toJson, so quotes and backslashes in the question can't break the query.
+        '''
+        source = dumps(self.build(kind, '@field@', '@value@', '@k@'))
+        return source.replace('"@field@"', '"{{field}}"').replace('"@value@"', '{{#toJson}}value{{/toJson}}').replace('"@k@"', '{{k}}')
+
+    def template_request(self, kind: str, field: str, value, k: int) -> dict:
+        '''
+        Return the body of a ``_search/template`` request (or of a ``_msearch/template`` line) equivalent to ``build``.
+        '''
+        return {'id': self.template_id(kind), 'params': {'field': field, 'value': value, 'k': k}}
+
+    def register_templates(self, client, kinds: list[str] = ['neural']) -> bool:
+        '''
+        Store the search templates of ``kinds`` on the cluster (stored scripts), it's idempotent.
+        knn templates are not registered by default: the vector is most of the payload, a template doesn't make it smaller.
+        '''
+        for kind in kinds:
+            client.put_script(id=self.template_id(kind), body={'script': {'lang': 'mustache', 'source': self.template_source(kind)}})
+        return True
+
+def test():
+    builder = query_builder()
+    print(builder.build('neural', 'text_en_embedding', 'How do I "detach" a volume?', 11))
+    print(builder.template_source('neural'))
+    print(builder.template_request('neural', 'text_it_embedding', 'Come scollego un volume?', 11))
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,232 @@
+from threading import Lock
+from time import time, sleep
+from asyncio import sleep as asleep, get_running_loop, shield, CancelledError
+from math import ceil
+from db_pool import sqlite_pool
+from costant import *
+
+class RateLimitExceeded(Exception):
+    '''
+    Raised when a call can't be admitted: the wait queue is full or the wait would exceed the max wait.
+    ``retry_after`` is the estimated number of seconds before the call could be admitted.
+    '''
+    def __init__(self, message: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, ceil(self.retry_after)))
+
+class memory_bucket_store:
+    '''
+    Buckets state of this process: {name: [tokens, updated_at]}.
+    '''
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.state: dict[str, list[float]] = {}
+
+    def update(self, names: list[str], func):
+        with self.lock:
+            return func(self.state)
+
+class sqlite_bucket_store:
+    '''
+    Buckets state shared by every worker on the same machine, updated in a single write transaction per call.
+    '''
+    def __init__(self, path: str) -> None:
+        self.pool = sqlite_pool(path)
+        self.pool.cursor().execute(
+            '''CREATE TABLE IF NOT EXISTS rate_limit_bucket (
+                    name TEXT PRIMARY KEY,
+                    tokens REAL,
+                    updated_at REAL
+                )'''
+        )
+        self.pool.connection().commit()
+
+    def update(self, names: list[str], func):
+        with self.pool.transaction() as cursor:
+            cursor.execute(f"SELECT name, tokens, updated_at FROM rate_limit_bucket WHERE name IN ({', '.join('?' * len(names))})", names)
+            state = {row[0]: [row[1], row[2]] for row in cursor.fetchall()}
+            result = func(state)
+            cursor.executemany(
+                "INSERT OR REPLACE INTO rate_limit_bucket (name, tokens, updated_at) VALUES (?, ?, ?)",
+                [(name, tokens, updated_at) for name, (tokens, updated_at) in state.items()]
+            )
+        return result
+
+class rate_limiter:
+    '''
+    Token buckets with a bounded wait queue, e.g. requests per second and tokens per minute of the Bedrock calls.
+
+    ``acquire`` reserves the amounts from every bucket at once and returns after the wait needed for the buckets to refill:
+    the reservations are served in arrival order and a burst is spread over time instead of being sent all together.
+    A call is rejected with ``RateLimitExceeded`` (without reserving anything) when it should wait more than ``max_wait``
+    seconds, or when it should wait and ``max_queue`` calls of this process are already waiting.
+
+    With ``path`` the buckets are stored in SQLite and shared by every worker, otherwise they are per process.
+
+    Args:
+        buckets (dict): {bucket name: (refill rate per second, capacity)}.
+        name (str): Prefix of the bucket names in the shared store.
+    '''
+    def __init__(self, buckets: dict[str, tuple[float, float]], max_queue: int = RATE_LIMIT_MAX_QUEUE, max_wait: float = RATE_LIMIT_MAX_WAIT_SEC, path: str = None, name: str = 'bedrock') -> None:
+        self.buckets = buckets
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.name = name
+        self.store = sqlite_bucket_store(path) if path else memory_bucket_store()
+        self.lock = Lock()
+        self.waiting = 0
+        self.stats = {'admitted': 0, 'rejected': 0, 'waited': 0, 'wait_sec_total': 0.0, 'wait_sec_max': 0.0, 'queue_max': 0}
+
+    def reserve(self, amounts: dict[str, float], max_wait: float) -> float:
+        '''
+        Reserve ``amounts`` if the wait is at most ``max_wait`` and return the wait in seconds,
+        otherwise reserve nothing and raise ``RateLimitExceeded``.
+        '''
+        names = [f'{self.name}.{bucket}' for bucket in amounts]
+
+        def update(state: dict[str, list[float]]) -> float:
+            now = time()
+            waits = {}
+            for name, (bucket, amount) in zip(names, amounts.items()):
+                rate, capacity = self.buckets[bucket]
+                tokens, updated_at = state.get(name, [capacity, now])
+                tokens = min(capacity, tokens + (now - updated_at) * rate)
+                state[name] = [tokens, now]
+                amount = min(amount, capacity) # a call bigger than the bucket waits for a full bucket
+                waits[name] = (amount - tokens) / rate if tokens < amount else 0.0
+
+            wait = max(waits.values(), default=0.0)
+            if wait > max_wait:
+                raise RateLimitExceeded(f'rate_limiter.reserve: {self.name} overloaded, wait {wait:.1f} s', wait)
+            for name, (bucket, amount) in zip(names, amounts.items()):
+                state[name][0] -= min(amount, self.buckets[bucket][1])
+            return wait
+
+        return self.store.update(names, update)
+
+    def admit(self, amounts: dict[str, float]) -> float:
+        '''
+        Reserve ``amounts`` and return the wait, the caller MUST wait it (see ``acquire`` and ``aacquire``).
+        The queue check, the reservation and the queue increment are a single critical section, so ``max_queue`` is never exceeded.
+        '''
+        with self.lock:
+            queue_full = self.waiting >= self.max_queue
+            try:
+                wait = self.reserve(amounts, 0.0 if queue_full else self.max_wait)
+            except RateLimitExceeded as e:
+                self.stats['rejected'] += 1
+                if queue_full: raise RateLimitExceeded(f'rate_limiter.admit: {self.name} queue full ({self.max_queue} calls waiting)', e.retry_after)
+                raise
+
+            self.stats['admitted'] += 1
+            if wait > 0:
+                self.waiting += 1
+                self.stats['waited'] += 1
+                self.stats['wait_sec_total'] += wait
+                self.stats['wait_sec_max'] = max(self.stats['wait_sec_max'], wait)
+                self.stats['queue_max'] = max(self.stats['queue_max'], self.waiting)
+        return wait
+
+    def done_waiting(self):
+        with self.lock: self.waiting -= 1
+
+    def acquire(self, **amounts: float) -> float:
+        '''
+        Block until the call is admitted, return the time waited.
+
+        Raises:
+            RateLimitExceeded: If the call can't be admitted.
+        '''
+        wait = self.admit(amounts)
+        if wait > 0:
+            try: sleep(wait)
+            finally: self.done_waiting()
+        return wait
+
+    async def aacquire(self, **amounts: float) -> float:
+        '''
+        Asyncio version of ``acquire``, the event loop is not blocked while waiting: the admission (a SQLite transaction
+        with the shared store) runs in a thread. If the caller is cancelled (e.g. client disconnected) the admission is undone,
+        see ``cancel``.
+        '''
+        loop = get_running_loop()
+        admission = loop.run_in_executor(None, self.admit, amounts)
+        try:
+            wait = await shield(admission)
+        except CancelledError:
+            # the admission goes on in its thread, it's undone as soon as it's done
+            def undo(future):
+                if not future.cancelled() and future.exception() is None:
+                    loop.run_in_executor(None, self.cancel, amounts, future.result())
+            admission.add_done_callback(undo)
+            raise
+
+        if wait > 0:
+            try:
+                await asleep(wait)
+            except CancelledError:
+                loop.run_in_executor(None, self.cancel, amounts, wait)
+                raise
+            self.done_waiting()
+        return wait
+
+    def cancel(self, amounts: dict[str, float], wait: float):
+        '''
+        Undo an admission whose caller went away: give back the reservation and, if it was waiting, its place in the queue.
+        '''
+        if wait > 0: self.done_waiting()
+        self.release(**amounts)
+
+    def check(self):
+        '''
+        Raise ``RateLimitExceeded`` if a call would be rejected now, nothing is reserved.
+        It lets an endpoint answer 429 before starting a streaming response.
+        '''
+        with self.lock:
+            queue_full = self.waiting >= self.max_queue
+            if queue_full: self.stats['rejected'] += 1
+        if queue_full:
+            raise RateLimitExceeded(f'rate_limiter.check: {self.name} queue full ({self.max_queue} calls waiting)', self.max_wait)
+
+    def release(self, **amounts: float):
+        '''
+        Give back part of a reservation, e.g. the output tokens reserved but not generated.
+        '''
+        amounts = {bucket: amount for bucket, amount in amounts.items() if amount > 0}
+        if not amounts: return
+        names = [f'{self.name}.{bucket}' for bucket in amounts]
+
+        def update(state: dict[str, list[float]]):
+            for name, (bucket, amount) in zip(names, amounts.items()):
+                if name in state: state[name][0] = min(self.buckets[bucket][1], state[name][0] + amount)
+
+        self.store.update(names, update)
+
+    def get_stats(self) -> dict:
+        '''
+        Return admitted, rejected, waited calls of this process, the wait times (total, average, max) and the queue depth (current, max).
+        '''
+        with self.lock:
+            average = self.stats['wait_sec_total'] / self.stats['waited'] if self.stats['waited'] else 0.0
+            return {**self.stats, 'wait_sec_avg': average, 'queue': self.waiting}
+
+def test():
+    limiter = rate_limiter({'requests': (2, 2), 'tokens': (100, 1000)}, max_queue=2, max_wait=3)
+    for i in range(8):
+        try:
+            print(i, f'wait {limiter.admit({"requests": 1, "tokens": 300}):.2f} s')
+        except RateLimitExceeded as e:
+            print(i, e, e.retry_after_header)
+    print(limiter.get_stats())
+
+    from tempfile import TemporaryDirectory
+    with TemporaryDirectory() as directory: # every run starts with full buckets
+        shared = rate_limiter({'requests': (2, 2)}, path=f'{directory}/rate_limit.db', name='test')
+        print([round(shared.reserve({'requests': 1}, 10), 2) for _ in range(4)]) # 0, 0, 0.5, 1.0
+
+if __name__ == '__main__':
+    test()
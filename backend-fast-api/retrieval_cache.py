@@ -0,0 +1,162 @@
+from sqlite3 import Connection, Cursor
+from collections import OrderedDict
+from threading import RLock
+from json import dumps, loads
+from time import time
+from lib_ import util, synchronized
+from db_pool import sqlite_pool
+from costant import *
+
+class retrieval_cache:
+    '''
+    Cache of ``rag.search_doc`` results, keyed by normalized question (case, spaces and punctuation), k and only_3of3.
+
+    It has 2 levels:
+    - memory: per process LRU, bounded to ``max_size`` entries
+    - shared: SQLite table, shared by every uvicorn worker on the same machine
+    Both levels expire entries after ``ttl`` seconds.
+
+    ``invalidate`` bumps a generation counter stored in SQLite: every process compares it at each lookup,
+    so a reload of the index (see ``opensearch_data_handler.load_data``) invalidates every worker cache.
+    '''
+    def __init__(self, max_size: int = RETRIEVAL_CACHE_SIZE, ttl: int = RETRIEVAL_CACHE_TTL_SEC) -> None:
+        if not util.create_operational_folder():
+            raise Exception('retrieval_cache.__init__: cannot create operational folders')
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = RLock()
+        self.memory: OrderedDict[str, tuple[float, list[dict]]] = OrderedDict()
+        self.generation = None
+        self.stats = {'hit': 0, 'shared_hit': 0, 'miss': 0}
+
+        self.pool = sqlite_pool(RETRIEVAL_CACHE_DB_PATH)
+        self.cursor.execute(
+            '''CREATE TABLE IF NOT EXISTS retrieval_cache (
+                    key TEXT PRIMARY KEY,
+                    docs TEXT,
+                    expires_at REAL
+                )'''
+        )
+        self.cursor.execute(
+            '''CREATE TABLE IF NOT EXISTS retrieval_cache_meta (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER
+                )'''
+        )
+        self.cursor.execute("INSERT OR IGNORE INTO retrieval_cache_meta (name, value) VALUES ('generation', 0)")
+        self.conn.commit()
+
+    @property
+    def conn(self) -> Connection:
+        return self.pool.connection()
+
+    @property
+    def cursor(self) -> Cursor:
+        return self.pool.cursor()
+
+    def build_key(self, question: str, k: int, only_3of3: bool) -> str:
+        return f'{util.normalize_text(question, strip_punctuation=True)}|{k}|{int(only_3of3)}'
+
+    @synchronized
+    def get(self, question: str, k: int, only_3of3: bool) -> list[dict] | None:
+        '''
+        Return the cached docs, None if not cached or expired.
+        Every call returns its own copy (see ``copy_docs``): the caller can change it without touching the cached docs.
+        '''
+        self.check_generation()
+        key = self.build_key(question, k, only_3of3)
+        now = time()
+
+        if key in self.memory:
+            expires_at, docs = self.memory[key]
+            if expires_at > now:
+                self.memory.move_to_end(key)
+                self.stats['hit'] += 1
+                return self.copy_docs(docs)
+            del self.memory[key]
+
+        self.cursor.execute("SELECT docs, expires_at FROM retrieval_cache WHERE key = ? AND expires_at > ?", (key, now))
+        row = self.cursor.fetchone()
+        if row:
+            docs = loads(row[0])
+            self.store_in_memory(key, row[1], docs)
+            self.stats['shared_hit'] += 1
+            return self.copy_docs(docs)
+
+        self.stats['miss'] += 1
+        return None
+
+    @synchronized
+    def put(self, question: str, k: int, only_3of3: bool, docs: list[dict]):
+        '''
+        Cache ``docs`` in both levels, expired and exceeding shared entries are deleted.
+        '''
+        self.check_generation()
+        key = self.build_key(question, k, only_3of3)
+        now = time()
+        expires_at = now + self.ttl
+        self.store_in_memory(key, expires_at, self.copy_docs(docs))
+
+        self.cursor.execute(
+            "INSERT OR REPLACE INTO retrieval_cache (key, docs, expires_at) VALUES (?, ?, ?)",
+            (key, dumps(docs, ensure_ascii=False), expires_at)
+        )
+        self.cursor.execute("DELETE FROM retrieval_cache WHERE expires_at <= ?", (now,))
+        self.cursor.execute(
+            "DELETE FROM retrieval_cache WHERE key IN (SELECT key FROM retrieval_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_size,)
+        )
+        self.conn.commit()
+
+    @synchronized
+    def invalidate(self):
+        '''
+        Drop every cached result, in every process.
+        '''
+        self.cursor.execute("UPDATE retrieval_cache_meta SET value = value + 1 WHERE name = 'generation'")
+        self.cursor.execute("DELETE FROM retrieval_cache")
+        self.conn.commit()
+        self.memory.clear()
+        self.generation = None
+
+    @synchronized
+    def get_stats(self) -> dict:
+        '''
+        Return hit (memory), shared_hit (SQLite), miss counters of this process and the number of entries in memory.
+        '''
+        return {**self.stats, 'size': len(self.memory)}
+
+    def check_generation(self):
+        '''
+        Clear the memory level if the cache was invalidated, also by another process.
+        '''
+        self.cursor.execute("SELECT value FROM retrieval_cache_meta WHERE name = 'generation'")
+        generation = self.cursor.fetchone()[0]
+        if generation != self.generation:
+            self.memory.clear()
+            self.generation = generation
+
+    @staticmethod
+    def copy_docs(docs: list[dict]) -> list[dict]:
+        '''
+        Copy the list and each doc, the docs are flat (``{'_score': float, **_source}``, see ``rank_fusion.fuse``).
+        '''
+        return [dict(doc) for doc in docs]
+
+    def store_in_memory(self, key: str, expires_at: float, docs: list[dict]):
+        self.memory[key] = (expires_at, docs)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+def test():
+    cache = retrieval_cache(max_size=2, ttl=60)
+    cache.put('How do I detach a volume?', 11, True, [{'hash': 'h1', '_score': 0.9}])
+    print(cache.get('how do i detach a volume', 11, True)) # hit
+    print(cache.get('how do i detach a volume', 9, True)) # miss, different k
+    cache.invalidate()
+    print(cache.get('how do i detach a volume', 11, True)) # miss, invalidated
+    print(cache.get_stats())
+
+if __name__ == '__main__':
+    test()
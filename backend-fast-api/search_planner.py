@@ -0,0 +1,130 @@
+from dataclasses import dataclass
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable
+from lib_ import util
+from costant import *
+
+# words frequent in the questions and almost never shared by the 2 languages
+STOPWORDS = {
+    'it': {'il', 'lo', 'la', 'gli', 'le', 'di', 'del', 'della', 'dei', 'che', 'non', 'per', 'con', 'una', 'uno', 'sono', 'come',
+           'posso', 'cosa', 'perché', 'perche', 'quando', 'dove', 'questo', 'questa', 'mio', 'mia', 'nel', 'nella', 'sul', 'ho', 'è'},
+    'en': {'the', 'of', 'and', 'to', 'is', 'are', 'for', 'with', 'not', 'how', 'what', 'why', 'when', 'where', 'can', 'do',
+           'does', 'my', 'this', 'that', 'it', 'on', 'from', 'have', 'i', 'you', 'an', 'be', 'which', 'should'}
+}
+
+@dataclass
+class SearchPlan:
+    """
+    The field searches to run for a question.
+
+    Attributes:
+        question (str): The original question.
+        lang (str): The detected language: en, it or unknown.
+        fields (list[str]): The kNN fields to search, a subset of ``SEARCH_FIELDS`` in the same order.
+        texts (list[str | None]): The query text of each field, None until translated (see ``search_planner.resolve``).
+    """
+    question: str
+    lang: str
+    fields: list[str]
+    texts: list[str | None]
+
+    @property
+    def pending(self) -> bool:
+        return None in self.texts
+
+class language_detector:
+    '''
+    Question language detection (en, it or unknown), memoized by normalized question.
+
+    The stopwords count decides most questions without any model, langdetect is only used when it's inconclusive
+    and the question has at least ``LANGUAGE_DETECT_MIN_WORDS`` words.
+    '''
+    def __init__(self, max_size: int = LANGUAGE_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self.lock = Lock()
+        self.cache: OrderedDict[str, str] = OrderedDict()
+
+    def detect(self, text: str) -> str:
+        key = util.normalize_text(text, strip_punctuation=True)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+
+        lang = self.detect_by_stopwords(key)
+        if lang is None:
+            # langdetect is unreliable on a few words (product names, acronyms): every field is searched
+            lang = util.detect_language_langdetect(text) if len(key.split()) >= LANGUAGE_DETECT_MIN_WORDS else None
+            if lang not in SEARCH_PLANS: lang = 'unknown'
+
+        with self.lock:
+            self.cache[key] = lang
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+        return lang
+
+    @staticmethod
+    def detect_by_stopwords(normalized_text: str) -> str | None:
+        '''
+        Return the language with more stopwords in the text, None if there's no stopword or it's a tie.
+        '''
+        words = normalized_text.split()
+        counts = {lang: sum(word in stopwords for word in words) for lang, stopwords in STOPWORDS.items()}
+        best = max(counts, key=counts.get)
+        if counts[best] == 0 or list(counts.values()).count(counts[best]) > 1: return None
+        return best
+
+class search_planner:
+    '''
+    Choose the field searches for a question from its language, see ``SEARCH_PLANS``:
+    the fields in the question language are searched with the question itself, the other fields (category_en for an Italian question)
+    with its translation if ``translate_fields``, else with the question as before the planner.
+    When the language is unknown every field is searched with the question.
+
+    Args:
+        translate: Any callable (text, DeepL target language) -> translation, see ``rag.translate``.
+        translate_fields (bool): Translate the question for the fields in the other language, it costs a DeepL round-trip
+            for every question not in the translation cache, see ``SEARCH_PLAN_TRANSLATE``.
+    '''
+    def __init__(self, translate: Callable[[str, str], str], detector: language_detector = None, translate_fields: bool = SEARCH_PLAN_TRANSLATE) -> None:
+        self.translate = translate
+        self.detector = detector if detector is not None else language_detector()
+        self.translate_fields = translate_fields
+
+    def plan(self, question: str) -> SearchPlan:
+        '''
+        Return the plan of ``question``, the texts that need a translation are None: call ``resolve`` before searching.
+        '''
+        lang = self.detector.detect(question)
+        fields = SEARCH_PLANS.get(lang, SEARCH_FIELDS)
+        texts = [question if lang == 'unknown' or FIELD_LANGS[field] == lang or not self.translate_fields else None for field in fields]
+        return SearchPlan(question=question, lang=lang, fields=fields, texts=texts)
+
+    def resolve(self, plan: SearchPlan) -> SearchPlan:
+        '''
+        Translate the question for the fields that need it, one translation per target language.
+        If a translation fails the field is searched with the question.
+        '''
+        translations = {}
+        for i, field in enumerate(plan.fields):
+            if plan.texts[i] is not None: continue
+            field_lang = FIELD_LANGS[field]
+            if field_lang not in translations:
+                try:
+                    translations[field_lang] = self.translate(plan.question, DEEPL_TARGET_LANGS[field_lang])
+                except Exception as e:
+                    print(f'search_planner.resolve: translation to {field_lang} failed ({e}), searching with the question')
+                    translations[field_lang] = plan.question
+            plan.texts[i] = translations[field_lang]
+        return plan
+
+def test():
+    for translate_fields in [False, True]:
+        planner = search_planner(translate=lambda text, target_lang: f'[{target_lang}] {text}', translate_fields=translate_fields)
+        for question in ['Come posso scollegare un volume dalla mia VM?', 'How do I detach a volume from my VM?', 'VPN']:
+            plan = planner.plan(question)
+            print(plan.lang, plan.fields, plan.pending, planner.resolve(plan).texts)
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,57 @@
+from subprocess import run
+from sys import executable, argv
+from time import perf_counter
+
+# third party modules first, then the repo modules in dependency order: each one is timed in a new interpreter
+IMPORTS = [
+    'boto3', 'opensearchpy', 'numpy', 'fastapi', 'langdetect', 'deepl', 'pandas', 'chromadb',
+    'costant', 'lib_', 'db_cache', 'db_chat', 'opensearch', 'main', 'public_api'
+]
+
+def import_cost(module: str) -> float | None:
+    '''
+    Time ``import module`` in a new interpreter, so the cost includes every dependency not imported yet.
+
+    Returns:
+        float | None: The import time in ms, None if the import failed (e.g. module not installed).
+    '''
+    code = f'from time import perf_counter; start = perf_counter(); import {module}; print((perf_counter() - start) * 1000)'
+    result = run([executable, '-c', code], capture_output=True, text=True)
+    if result.returncode != 0: return None
+    return float(result.stdout.strip().splitlines()[-1])
+
+def timed(label: str, func):
+    start = perf_counter()
+    try:
+        value = func()
+        print(f'{label:<32} {(perf_counter() - start) * 1000:>10.1f} ms')
+        return value
+    except Exception as e:
+        print(f'{label:<32} {(perf_counter() - start) * 1000:>10.1f} ms  failed: {e}')
+
+def profile_imports():
+    print('import (new interpreter)             time')
+    for module in IMPORTS:
+        cost = import_cost(module)
+        print(f'{module:<32} ' + (f'{cost:>10.1f} ms' if cost is not None else '    failed'))
+
+def profile_clients():
+    '''
+    Time the creation of the rag instance and of each lazy client, in the order the first request creates them.
+    '''
+    print('\nclient (first use)                   time')
+    public_api = timed('import public_api', lambda: __import__('public_api'))
+    if public_api is None: return
+    rag = timed('get_rag', public_api.get_rag)
+    if rag is None: return
+    timed('bedrock (STS + client)', lambda: rag.bedrock)
+    timed('opensearch client', lambda: rag.opensearch.client)
+    timed('embeddings', lambda: rag.embeddings)
+    timed('cache_db', lambda: rag.cache_handler)
+    timed('retrieval_cache', lambda: rag.retrieval_cache)
+    timed('conversation_db', lambda: rag.chat_handler)
+
+if __name__ == '__main__':
+    # python startup_profile.py [imports|clients], both by default
+    if len(argv) < 2 or argv[1] == 'imports': profile_imports()
+    if len(argv) < 2 or argv[1] == 'clients': profile_clients()
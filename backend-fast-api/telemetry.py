@@ -0,0 +1,211 @@
+from queue import Queue, Full, Empty
+from threading import Thread, Lock
+from os import makedirs, rename, remove, stat, fstat
+from os.path import dirname, exists
+from contextlib import contextmanager
+from glob import glob
+from gzip import open as gzip_open
+from shutil import copyfileobj
+from datetime import datetime
+from json import dumps, loads
+from time import time
+from typing import Iterator
+import atexit
+from costant import *
+
+try:
+    from fcntl import flock, LOCK_EX, LOCK_UN
+except ImportError:
+    flock = None # no fcntl (Windows): only one process per telemetry file
+
+class telemetry_sink:
+    '''
+    Append only JSONL telemetry, written by a background thread.
+
+    ``emit`` only puts the event in a bounded queue (O(1), it never blocks the request): when the queue is full
+    the event is dropped and counted in ``dropped``. The writer thread appends the queued events in batches.
+
+    When the file exceeds ``max_bytes`` it's rotated to ``<path>.<timestamp>`` and gzipped,
+    only the newest ``backup_count`` rotated files are kept (all if 0).
+    Several processes (e.g. uvicorn workers) can share the file: every batch is written, and the file rotated,
+    under an exclusive lock on ``<path>.lock`` (see ``file_lock``), a process reopens the file rotated by another one.
+
+    Every event is a JSON object with at least ``type`` and ``time``, see ``rag.log_similarity_scores``
+    and ``rag.log_claude_res``; events of the same message share the ``id`` field (see ``load_similarity_scores``).
+    '''
+    def __init__(self, path: str = TELEMETRY_PATH, max_bytes: int = TELEMETRY_MAX_BYTES, backup_count: int = TELEMETRY_BACKUP_COUNT, queue_size: int = TELEMETRY_QUEUE_SIZE, compress: bool = True) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self.queue: Queue = Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.file = None
+        self.lock_file = None
+        self.size = 0
+        self.lock = Lock()
+        self.writer: Thread = None
+
+    def emit(self, event_type: str, **fields) -> bool:
+        '''
+        Queue an event, return False if it was dropped because the queue is full.
+        '''
+        self.start()
+        try:
+            self.queue.put_nowait({'type': event_type, 'time': time(), **fields})
+            return True
+        except Full:
+            self.dropped += 1
+            return False
+
+    def start(self):
+        if self.writer is not None: return
+        with self.lock:
+            if self.writer is None:
+                self.writer = Thread(target=self.run, name='telemetry-writer', daemon=True)
+                self.writer.start()
+                atexit.register(self.close)
+
+    def close(self, timeout: float = 5):
+        '''
+        Write the queued events and stop the writer thread.
+        '''
+        if self.writer is None: return
+        try: self.queue.put(None, timeout=timeout)
+        except Full: return
+        self.writer.join(timeout)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < TELEMETRY_BATCH_SIZE:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+
+            stop = None in batch
+            try:
+                self.write([event for event in batch if event is not None])
+            except Exception as e:
+                print(f'telemetry_sink.run: {len(batch)} events not written, {e}')
+            if stop: break
+
+        if self.file: self.file.close()
+        if self.lock_file: self.lock_file.close()
+        self.file = self.lock_file = None
+        with self.lock: self.writer = None
+
+    def write(self, events: list[dict]):
+        if not events: return
+        data = ''.join(dumps(event, ensure_ascii=False) + '\n' for event in events)
+        with self.file_lock():
+            self.open_current()
+            self.file.write(data)
+            self.file.flush()
+            self.size = fstat(self.file.fileno()).st_size # also the events of the other processes
+
+            if self.size >= self.max_bytes:
+                self.rotate()
+
+    @contextmanager
+    def file_lock(self):
+        '''
+        Exclusive lock of every process writing ``path``: a process never rotates the file while another one is writing it.
+        '''
+        if flock is None:
+            yield
+            return
+        if self.lock_file is None:
+            makedirs(dirname(self.path) or '.', exist_ok=True)
+            self.lock_file = open(f'{self.path}.lock', 'a')
+        flock(self.lock_file.fileno(), LOCK_EX)
+        try:
+            yield
+        finally:
+            flock(self.lock_file.fileno(), LOCK_UN)
+
+    def open_current(self):
+        '''
+        Open ``path`` for append, again if another process rotated it since the last write.
+        '''
+        if self.file is not None:
+            try:
+                if stat(self.path).st_ino == fstat(self.file.fileno()).st_ino: return
+            except FileNotFoundError:
+                pass
+            self.file.close()
+        makedirs(dirname(self.path) or '.', exist_ok=True)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def rotate(self):
+        '''
+        Move the current file to ``<path>.<timestamp>``, gzip it and delete the oldest rotated files, called under ``file_lock``.
+        '''
+        self.file.close()
+        self.file = None
+        rotated = f'{self.path}.{datetime.now().strftime("%Y%m%d-%H%M%S-%f")}'
+        rename(self.path, rotated)
+
+        if self.compress:
+            with open(rotated, 'rb') as source, gzip_open(rotated + '.gz', 'wb') as target:
+                copyfileobj(source, target)
+            remove(rotated)
+
+        if self.backup_count:
+            for old in self.rotated_files()[:-self.backup_count]:
+                remove(old)
+
+    def rotated_files(self) -> list[str]:
+        '''
+        Return the rotated files, oldest first (the timestamp suffix sorts chronologically), the lock file is not one of them.
+        '''
+        return sorted(glob(f'{self.path}.[0-9]*'))
+
+def read_events(path: str = TELEMETRY_PATH) -> Iterator[dict]:
+    '''
+    Iterate over the events of the rotated files (oldest first) and of the current file.
+    '''
+    files = telemetry_sink(path).rotated_files() + ([path] if exists(path) else [])
+    for file in files:
+        opener = gzip_open if file.endswith('.gz') else open
+        with opener(file, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip(): yield loads(line)
+
+def load_similarity_scores(path: str = TELEMETRY_PATH) -> list[dict]:
+    '''
+    Rebuild the records of the old simil-score.json: one record per retrieved doc, with the answer joined by message id.
+
+    Returns:
+        list[dict]: [{"id": str, "doc": str, "score": float, "question": str, "answer": str}], the answer is missing if not logged.
+    '''
+    records, answers = [], {}
+    for event in read_events(path):
+        if event['type'] == 'similarity_scores':
+            for doc in event['docs']:
+                records.append({'id': event['id'], 'doc': doc['doc'], 'score': doc['score'], 'question': event['question']})
+        elif event['type'] == 'claude_answer':
+            answers[event['id']] = event['answer']
+
+    for record in records:
+        if record['id'] in answers: record['answer'] = answers[record['id']]
+    return records
+
+TELEMETRY = telemetry_sink() # shared by every rag instance of the process, one writer thread per file
+
+def test():
+    from tempfile import TemporaryDirectory
+    with TemporaryDirectory() as directory: # every run starts without rotated files
+        sink = telemetry_sink(f'{directory}/telemetry.jsonl', max_bytes=2000, backup_count=2)
+        start = time()
+        for i in range(100):
+            sink.emit('similarity_scores', id=f'chat-{i}', question='how do I detach a volume?', docs=[{'doc': '<doc>text</doc>', 'score': 0.9}])
+            sink.emit('claude_answer', id=f'chat-{i}', answer='detach it from the console')
+        print(f'200 events queued in {(time() - start) * 1000:.2f} ms, dropped: {sink.dropped}')
+        sink.close()
+        print(sink.rotated_files()) # at most 2 gz files
+        print(load_similarity_scores(sink.path)[-1])
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,188 @@
+from sqlite3 import Connection, Cursor
+from collections import OrderedDict
+from threading import RLock
+from hashlib import sha256
+from time import time
+from lib_ import util, synchronized
+from db_pool import sqlite_pool
+from costant import *
+
+class deepl_backend:
+    '''
+    DeepL API backend, a single ``deepl.Translator`` (and its HTTP connection pool) is reused for every request.
+
+    deepl is imported when the first translation is requested.
+    '''
+    def __init__(self, api_key: str) -> None:
+        self.api_key = api_key
+        self.translator = None
+
+    def translate(self, texts: list[str], target_lang: str) -> list[str]:
+        '''
+        Translate ``texts`` with a single API request, the translations are in the same order.
+        '''
+        if self.translator is None:
+            from deepl import Translator
+            self.translator = Translator(self.api_key)
+        results = self.translator.translate_text(texts, target_lang=target_lang)
+        return [result.text for result in results]
+
+class stub_backend:
+    '''
+    Offline backend for the tests: the translation is the text prefixed by the target language, every request is recorded.
+    '''
+    def __init__(self) -> None:
+        self.requests: list[tuple[list[str], str]] = []
+
+    def translate(self, texts: list[str], target_lang: str) -> list[str]:
+        self.requests.append((list(texts), target_lang))
+        return [f'[{target_lang}] {text}' for text in texts]
+
+class translation_service:
+    '''
+    Translations cached by (sha256 of the text, target language), so repeated questions and the EN/IT variants
+    of the same answer are translated only once.
+
+    The cache has 2 levels, like ``retrieval_cache``:
+    - memory: per process LRU, bounded to ``max_size`` entries
+    - shared: SQLite table, shared by every uvicorn worker, bounded to ``max_rows`` entries (least recently stored are deleted)
+    Translations don't expire.
+
+    ``translate_batch`` sends only the texts not cached, deduplicated, ``TRANSLATION_BATCH_SIZE`` texts per backend request.
+    '''
+    def __init__(self, backend, path: str = TRANSLATION_CACHE_DB_PATH, max_size: int = TRANSLATION_CACHE_SIZE, max_rows: int = TRANSLATION_CACHE_MAX_ROWS) -> None:
+        if not util.create_operational_folder():
+            raise Exception('translation_service.__init__: cannot create operational folders')
+        self.backend = backend
+        self.max_size = max_size
+        self.max_rows = max_rows
+        self.lock = RLock()
+        self.memory: OrderedDict[tuple[str, str], str] = OrderedDict()
+        self.stats = {'hit': 0, 'shared_hit': 0, 'miss': 0, 'requests': 0}
+
+        self.pool = sqlite_pool(path)
+        self.cursor.execute(
+            '''CREATE TABLE IF NOT EXISTS translation (
+                    text_hash TEXT,
+                    target_lang TEXT,
+                    translation TEXT,
+                    created_at REAL,
+                    PRIMARY KEY (text_hash, target_lang)
+                )'''
+        )
+        self.conn.commit()
+
+    @property
+    def conn(self) -> Connection:
+        return self.pool.connection()
+
+    @property
+    def cursor(self) -> Cursor:
+        return self.pool.cursor()
+
+    @staticmethod
+    def build_key(text: str, target_lang: str) -> tuple[str, str]:
+        return sha256(text.encode('utf-8')).hexdigest(), target_lang.upper()
+
+    def translate(self, text: str, target_lang: str = 'EN-US') -> str:
+        return self.translate_batch([text], target_lang)[0]
+
+    def translate_batch(self, texts: list[str], target_lang: str = 'EN-US') -> list[str]:
+        '''
+        Translate ``texts`` to ``target_lang``.
+
+        Args:
+            texts (list[str]): The texts to translate, duplicates are translated once.
+            target_lang (str): A DeepL target language code, e.g. EN-US, IT.
+
+        Returns:
+            list[str]: The translations, in the same order of ``texts``.
+
+        Notes:
+            The backend is called without holding the lock: concurrent misses of the same text can both be translated,
+            the last one stored wins.
+        '''
+        keys = [self.build_key(text, target_lang) for text in texts]
+        found = self.lookup(keys)
+
+        missing: dict[tuple[str, str], str] = {}
+        for key, text in zip(keys, texts):
+            if key not in found: missing.setdefault(key, text)
+
+        if missing:
+            missing_keys, missing_texts = list(missing.keys()), list(missing.values())
+            translations = []
+            for i in range(0, len(missing_texts), TRANSLATION_BATCH_SIZE):
+                translations.extend(self.backend.translate(missing_texts[i:i + TRANSLATION_BATCH_SIZE], target_lang))
+                self.stats['requests'] += 1
+            self.store(list(zip(missing_keys, translations)))
+            found.update(zip(missing_keys, translations))
+
+        return [found[key] for key in keys]
+
+    @synchronized
+    def lookup(self, keys: list[tuple[str, str]]) -> dict[tuple[str, str], str]:
+        '''
+        Return the cached translations of ``keys``, first from memory then from SQLite.
+        '''
+        found, shared = {}, []
+        for key in dict.fromkeys(keys):
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                found[key] = self.memory[key]
+                self.stats['hit'] += 1
+            else:
+                shared.append(key)
+
+        for key in shared:
+            self.cursor.execute("SELECT translation FROM translation WHERE text_hash = ? AND target_lang = ?", key)
+            row = self.cursor.fetchone()
+            if row:
+                found[key] = row[0]
+                self.store_in_memory(key, row[0])
+                self.stats['shared_hit'] += 1
+            else:
+                self.stats['miss'] += 1
+        return found
+
+    @synchronized
+    def store(self, items: list[tuple[tuple[str, str], str]]):
+        now = time()
+        with self.pool.transaction() as cursor:
+            cursor.executemany(
+                "INSERT OR REPLACE INTO translation (text_hash, target_lang, translation, created_at) VALUES (?, ?, ?, ?)",
+                [(key[0], key[1], translation, now) for key, translation in items]
+            )
+            cursor.execute(
+                "DELETE FROM translation WHERE rowid IN (SELECT rowid FROM translation ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_rows,)
+            )
+        for key, translation in items:
+            self.store_in_memory(key, translation)
+
+    def store_in_memory(self, key: tuple[str, str], translation: str):
+        self.memory[key] = translation
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    @synchronized
+    def get_stats(self) -> dict:
+        '''
+        Return hit (memory), shared_hit (SQLite), miss, backend requests counters of this process and the number of entries in memory.
+        '''
+        return {**self.stats, 'size': len(self.memory)}
+
+def test():
+    from tempfile import TemporaryDirectory
+    with TemporaryDirectory() as directory: # every run starts without cached translations
+        backend = stub_backend()
+        service = translation_service(backend, path=f'{directory}/translation.db', max_size=2)
+        print(service.translate('Come posso scollegare un volume?')) # miss
+        print(service.translate_batch(['Come posso scollegare un volume?', 'Ciao', 'Ciao', 'Grazie'])) # 1 hit, 2 texts sent
+        print(service.translate_batch(['Ciao'], 'IT')) # different language, miss
+        print(backend.requests)
+        print(service.get_stats())
+
+if __name__ == '__main__':
+    test()